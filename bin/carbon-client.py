@@ -37,6 +37,7 @@ except ImportError:
 
 from twisted.internet import stdio, reactor, defer
 from twisted.protocols.basic import LineReceiver
+from carbon.conf import settings
 from carbon.routers import ConsistentHashingRouter, RelayRulesRouter
 from carbon.client import CarbonClientManager
 from carbon import log, events
@@ -50,6 +51,8 @@ option_parser.add_option('--routing', default='consistent-hashing',
   help='Routing method: "consistent-hashing" (default) or "relay"')
 option_parser.add_option('--relayrules', default=default_relayrules,
   help='relay-rules.conf file to use for relay routing')
+option_parser.add_option('--protocol', default='pickle', choices=['pickle', 'binary'],
+  help='Protocol of the destination ports: "pickle" (default) or "binary"')
 
 options, args = option_parser.parse_args()
 
@@ -89,6 +92,7 @@ elif options.routing == 'relay':
     print "relay rules file %s does not exist" % options.relayrules
     raise SystemExit(1)
 
+settings['DESTINATION_PROTOCOL'] = options.protocol
 client_manager = CarbonClientManager(router)
 reactor.callWhenRunning(client_manager.startService)
 
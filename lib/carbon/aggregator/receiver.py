@@ -7,7 +7,32 @@ from carbon import events, log
 
 def process(metric, datapoint):
   increment('datapointsReceived')
+  metric = aggregate(metric, datapoint)
+  if metric is not None:
+    events.metricGenerated(metric, datapoint)
+
+
+def processBatch(datapoints):
+  """Like process, for a list of (metric, datapoint) tuples, passing on those
+  not aggregated as one batch. A datapoint that fails is logged and skipped,
+  as it would have been on its own."""
+  increment('datapointsReceived', len(datapoints))
+  passed = []
+  for (metric, datapoint) in datapoints:
+    try:
+      metric = aggregate(metric, datapoint)
+    except Exception:
+      log.err(None, "Could not aggregate datapoint %s of %s" % (datapoint, metric))
+      continue
+    if metric is not None:
+      passed.append((metric, datapoint))
+  if passed:
+    events.metricGenerated.batch(passed)
+
 
+def aggregate(metric, datapoint):
+  """Feeds datapoint to the buffers of the rules metric matches, returning
+  the rewritten metric if it is to be passed on un-aggregated too, or None"""
   for rule in RewriteRuleManager.preRules:
     metric = rule.apply(metric)
 
@@ -33,4 +58,5 @@ def process(metric, datapoint):
 
   if metric not in aggregate_metrics:
     log.msg("Couldn't match metric %s with any aggregation rule. Passing on un-aggregated." % metric)
-    events.metricGenerated(metric, datapoint)
+    return metric
+  return None
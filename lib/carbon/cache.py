@@ -12,14 +12,82 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+from array import array
+from itertools import izip
+from operator import attrgetter
 from threading import Lock
 from carbon.conf import settings
 
 
-class MetricCache(dict):
+INFINITY = float('inf')
+MAX_COMPACT_TIMESTAMP = (1 << (8 * array('I').itemsize)) - 1
+
+
+class CompactDatapoints(object):
+  """A queue of datapoints packed into typed arrays, costing 12 bytes per
+  point instead of a tuple and two float objects. Timestamps are truncated to
+  whole seconds, as whisper does when writing them."""
+  __slots__ = ('timestamps', 'values')
+
   def __init__(self):
+    self.timestamps = array('I')
+    self.values = array('d')
+
+  def append(self, datapoint):
+    "Raises a ValueError for a datapoint the arrays cannot hold"
+    try:
+      timestamp = int(datapoint[0])
+      value = float(datapoint[1])
+    except OverflowError:
+      raise ValueError("Datapoint %s out of range" % (datapoint,))
+    if not 0 <= timestamp <= MAX_COMPACT_TIMESTAMP:
+      raise ValueError("Timestamp %d out of range" % timestamp)
+    self.timestamps.append(timestamp)
+    self.values.append(value)
+
+  def __len__(self):
+    return len(self.values)
+
+  def __iter__(self):
+    return izip(self.timestamps, self.values)
+
+
+class CoalescedDatapoints(dict):
+  """A queue keeping only the last value received for each timestamp slot of
+  the metric's finest archive, so retransmitted or duplicate datapoints are
+  neither held twice nor written twice."""
+  __slots__ = ('step',)
+
+  def __init__(self, step):
+    dict.__init__(self)
+    self.step = int(step)
+
+  def append(self, datapoint):
+    timestamp = int(datapoint[0])
+    self[timestamp - (timestamp % self.step)] = float(datapoint[1])
+
+  def __iter__(self):
+    return iter(sorted(self.iteritems()))
+
+
+class CacheShard(dict):
+  """A partition of the MetricCache holding the datapoint queues of the
+  metrics that hash to it, guarded by its own lock.
+
+  Queues are also indexed by length in a bucket queue so the fullest one can
+  be found without sorting the whole shard. Held queues are left out of the
+  index until they are released.
+
+  When given a WriteAheadLogShard, it is kept up to date under the shard's
+  lock, so it never misses a datapoint stored while a queue is popped."""
+  def __init__(self, newQueue, wal=None):
     self.size = 0
     self.lock = Lock()
+    self.newQueue = newQueue
+    self.wal = wal
+    self.buckets = {} # { queue length : set(metrics) }
+    self.largest = 0
+    self.held = set()
 
   def __setitem__(self, key, value):
     raise TypeError("Use store() method instead!")
@@ -27,27 +95,191 @@ class MetricCache(dict):
   def store(self, metric, datapoint):
     try:
       self.lock.acquire()
-      self.setdefault(metric, []).append(datapoint)
-      self.size += 1
+      self._store(metric, datapoint)
+    except ValueError, e:
+      log.msg("Rejected datapoint %s of %s: %s" % (datapoint, metric, e))
     finally:
       self.lock.release()
 
-    if self.isFull():
-      log.msg("MetricCache is full: self.size=%d" % self.size)
-      state.events.cacheFull()
+  def storeBatch(self, datapoints):
+    """Stores a list of (metric, datapoint) tuples under a single lock. A
+    datapoint that cannot be stored is logged and skipped, as it would have
+    been on its own."""
+    try:
+      self.lock.acquire()
+      for (metric, datapoint) in datapoints:
+        try:
+          self._store(metric, datapoint)
+        except ValueError, e:
+          log.msg("Rejected datapoint %s of %s: %s" % (datapoint, metric, e))
+        except Exception:
+          log.err(None, "Could not store datapoint %s of %s" % (datapoint, metric))
+    finally:
+      self.lock.release()
 
-  def isFull(self):
-    return self.size >= settings.MAX_CACHE_SIZE
+  def _store(self, metric, datapoint):
+    datapoints = self.get(metric)
+    if datapoints is None:
+      # Only add the queue once the datapoint was accepted into it
+      datapoints = self.newQueue(metric)
+      datapoints.append(datapoint)
+      dict.__setitem__(self, metric, datapoints)
+      if self.wal is not None:
+        self.wal.append(metric, datapoint)
+      count = 0
+    else:
+      count = len(datapoints)
+      datapoints.append(datapoint)
+      if self.wal is not None:
+        self.wal.append(metric, datapoint)
+      if len(datapoints) == count:
+        return # coalesced into an already queued slot
+      if metric in self.held:
+        self.size += 1
+        return
+    self.size += 1
+
+    # Move the metric up one bucket. The bucket it leaves may be dropped
+    # without walking self.largest down since the next one is now in use.
+    buckets = self.buckets
+    if count:
+      bucket = buckets[count]
+      bucket.remove(metric)
+      if not bucket:
+        del buckets[count]
+    count += 1
+    try:
+      buckets[count].add(metric)
+    except KeyError:
+      buckets[count] = set([metric])
+    if count > self.largest:
+      self.largest = count
+
+  def _index(self, metric, count):
+    try:
+      self.buckets[count].add(metric)
+    except KeyError:
+      self.buckets[count] = set([metric])
+    if count > self.largest:
+      self.largest = count
+
+  def _unindex(self, metric, count):
+    bucket = self.buckets[count]
+    bucket.discard(metric)
+    if not bucket:
+      self._dropBucket(count)
+
+  def _dropBucket(self, count):
+    del self.buckets[count]
+    # The largest length can only shrink one removal at a time, which
+    # keeps this walk amortized O(1) against the stores that grew it.
+    while self.largest and self.largest not in self.buckets:
+      self.largest -= 1
 
   def pop(self, metric):
     try:
       self.lock.acquire()
       datapoints = dict.pop(self, metric)
+      if metric in self.held:
+        self.held.remove(metric)
+      else:
+        self._unindex(metric, len(datapoints))
       self.size -= len(datapoints)
+      if self.wal is not None:
+        self.wal.popped(metric)
       return datapoints
     finally:
       self.lock.release()
 
+  def popFullest(self):
+    try:
+      self.lock.acquire()
+      if not self.largest:
+        return None
+      # set.pop() resumes where it left off, unlike iterating from the start
+      # of a set that is riddled with removed entries.
+      bucket = self.buckets[self.largest]
+      metric = bucket.pop()
+      if not bucket:
+        self._dropBucket(self.largest)
+      datapoints = dict.pop(self, metric)
+      self.size -= len(datapoints)
+      if self.wal is not None:
+        self.wal.popped(metric)
+      return (metric, datapoints)
+    finally:
+      self.lock.release()
+
+  def _putBack(self, metric, datapoints, held):
+    queue = self.newQueue(metric)
+    if type(queue) is list:
+      queue.extend(datapoints)
+    else:
+      for datapoint in datapoints:
+        queue.append(datapoint)
+    newer = self.get(metric)
+    if newer is not None:
+      # Points already cached are newer than the ones put back
+      for datapoint in newer:
+        queue.append(datapoint)
+      if metric in self.held:
+        held = True
+      else:
+        self._unindex(metric, len(newer))
+      self.size -= len(newer)
+    if not queue:
+      return
+    dict.__setitem__(self, metric, queue)
+    self.size += len(queue)
+    if held:
+      self.held.add(metric)
+    else:
+      self._index(metric, len(queue))
+
+  def hold(self, metric, datapoints):
+    try:
+      self.lock.acquire()
+      self._putBack(metric, datapoints, True)
+      if self.wal is not None:
+        self.wal.unpopped(metric)
+    finally:
+      self.lock.release()
+
+  def restore(self, metric, datapoints):
+    try:
+      self.lock.acquire()
+      self._putBack(metric, datapoints, False)
+      if self.wal is not None:
+        for datapoint in datapoints:
+          self.wal.append(metric, datapoint)
+    finally:
+      self.lock.release()
+
+  def popAll(self):
+    try:
+      self.lock.acquire()
+      items = self.items()
+      dict.clear(self)
+      self.size = 0
+      self.buckets = {}
+      self.largest = 0
+      self.held = set()
+      if self.wal is not None:
+        for (metric, datapoints) in items:
+          self.wal.popped(metric)
+      return items
+    finally:
+      self.lock.release()
+
+  def release(self, metric):
+    try:
+      self.lock.acquire()
+      if metric in self.held:
+        self.held.remove(metric)
+        self._index(metric, len(self[metric]))
+    finally:
+      self.lock.release()
+
   def counts(self):
     try:
       self.lock.acquire()
@@ -56,6 +288,163 @@ class MetricCache(dict):
       self.lock.release()
 
 
+class MetricCache(object):
+  """Maps metric names to their queue of cached datapoints.
+
+  The cache is split into CACHE_SHARDS independently locked shards selected
+  by metric hash, so that the writer thread popping and counting queues only
+  ever holds a lock over a fraction of the cache while the reactor stores.
+
+  With compact enabled, queues are kept as CompactDatapoints and only turned
+  back into lists of (timestamp, value) tuples when popped or queried. When a
+  resolution function is given, queues are CoalescedDatapoints aligned to the
+  number of seconds per point it returns for each metric instead, or to one
+  second when it returns None.
+
+  A WriteAheadLog given to the cache logs every datapoint stored, and is told
+  when queues are popped or held. The writer tells it when popped datapoints
+  are safely written."""
+  def __init__(self, shards=1, compact=False, resolution=None, wal=None):
+    self.shards = []
+    self.configure(shards, compact, resolution, wal)
+
+  def configure(self, shards, compact=False, resolution=None, wal=None):
+    shards = int(shards)
+    if shards < 1:
+      raise ValueError("MetricCache needs at least one shard, got %d" % shards)
+    if self:
+      raise RuntimeError("Cannot reshard a MetricCache that holds datapoints")
+
+    if resolution is not None:
+      # Metrics matching no schema are coalesced per second, as whisper
+      # would truncate their timestamps anyway
+      newQueue = lambda metric: CoalescedDatapoints(resolution(metric) or 1)
+    elif compact:
+      newQueue = lambda metric: CompactDatapoints()
+    else:
+      newQueue = lambda metric: []
+    if wal is None:
+      self.shards = [CacheShard(newQueue) for i in range(shards)]
+    else:
+      self.shards = [CacheShard(newQueue, wal.shard()) for i in range(shards)]
+
+  def getShard(self, metric):
+    return self.shards[hash(metric) % len(self.shards)]
+
+  @property
+  def size(self):
+    return sum([shard.size for shard in self.shards])
+
+  def __len__(self):
+    return sum([len(shard) for shard in self.shards])
+
+  def __nonzero__(self):
+    for shard in self.shards:
+      if shard:
+        return True
+    return False
+
+  def __contains__(self, metric):
+    return metric in self.getShard(metric)
+
+  def get(self, metric, default=None):
+    "Returns a copy of the metric's queue as a list of datapoints"
+    datapoints = self.getShard(metric).get(metric)
+    if datapoints is None:
+      return default
+    return list(datapoints)
+
+  def store(self, metric, datapoint):
+    self.getShard(metric).store(metric, datapoint)
+
+    if self.isFull():
+      log.msg("MetricCache is full: self.size=%d" % self.size)
+      state.events.cacheFull()
+
+  def storeBatch(self, datapoints):
+    """Stores a list of (metric, datapoint) tuples, taking the lock of each
+    shard once, and checking whether the cache is full once"""
+    shards = self.shards
+    if len(shards) == 1:
+      shards[0].storeBatch(datapoints)
+    else:
+      batches = {}
+      for item in datapoints:
+        index = hash(item[0]) % len(shards)
+        try:
+          batches[index].append(item)
+        except KeyError:
+          batches[index] = [item]
+      for (index, batch) in batches.iteritems():
+        shards[index].storeBatch(batch)
+
+    if self.isFull():
+      log.msg("MetricCache is full: self.size=%d" % self.size)
+      state.events.cacheFull()
+
+  def isFull(self):
+    # Summing the shard sizes is pointless when the cache is unbounded
+    maxSize = settings.MAX_CACHE_SIZE
+    return maxSize != INFINITY and self.size >= maxSize
+
+  def pop(self, metric):
+    datapoints = self.getShard(metric).pop(metric)
+    if type(datapoints) is not list:
+      datapoints = list(datapoints)
+    return datapoints
+
+  def hold(self, metric, datapoints):
+    """Puts a popped queue back into the cache, ahead of any datapoint stored
+    since. The metric keeps receiving datapoints and answering queries, but
+    popFullest passes it over until it is released."""
+    self.getShard(metric).hold(metric, datapoints)
+
+  def release(self, metric):
+    "Makes a held metric available to popFullest again"
+    self.getShard(metric).release(metric)
+
+  def restore(self, metric, datapoints):
+    """Stores datapoints in bulk, ahead of any datapoint already cached for
+    the metric"""
+    self.getShard(metric).restore(metric, datapoints)
+
+  def popAll(self):
+    """Empties the cache, returning a list of (metric, queue) tuples where
+    queues are iterables of datapoints, but not necessarily lists"""
+    items = []
+    for shard in self.shards:
+      items.extend(shard.popAll())
+    return items
+
+  def partition(self, count):
+    """Splits the shards into count disjoint lists, so that every metric
+    belongs to exactly one of them."""
+    return [self.shards[i::count] for i in range(count)]
+
+  def popFullest(self, shards=None):
+    """Pops the longest queue in the cache, or in the given shards only, and
+    returns it as a (metric, datapoints) tuple, or None if they are empty."""
+    if shards is None:
+      shards = self.shards
+    while True:
+      shard = max(shards, key=attrgetter('largest'))
+      if not shard.largest:
+        return None
+      # Another thread may have emptied the shard since we looked at it
+      result = shard.popFullest()
+      if result is not None:
+        (metric, datapoints) = result
+        if type(datapoints) is not list:
+          result = (metric, list(datapoints))
+        return result
+
+  def counts(self):
+    counts = []
+    for shard in self.shards:
+      counts.extend(shard.counts())
+    return counts
+
+
 # Ghetto singleton
 MetricCache = MetricCache()
 
@@ -0,0 +1,650 @@
+"""A database storing the datapoints of many metrics together, in chunk
+files per partition of time, instead of one whisper file per metric.
+
+Each write appends a frame holding the metric's new datapoints to the chunk
+of the partition they fall in, so writes are sequential appends to a few
+files whatever the number of metrics. Frames compress their datapoints as
+in Facebook's Gorilla: timestamps as deltas of their deltas, values as the
+XOR of the previous one, so regular series take a few bits per datapoint.
+
+Metrics are created with the retentions, xFilesFactor and aggregationMethod
+of their schemas, kept in an append-only log. Every archive of those
+retentions, a (secondsPerPoint, points) pair, has partitions of its own in a
+directory of LOCAL_DATA_DIR, each spanning whole CHUNK_DURATIONs, about
+PARTITIONS_PER_ARCHIVE of them over its retention. As in whisper, datapoints
+are written to the first archive of their metric that covers their age.
+
+Once a partition is over, its frames are compacted in the background into
+one frame per metric, and an index of where each metric's frame is is saved
+next to it, so reads and restarts need not scan the chunk. The datapoints of
+each metric are aggregated into its next archive at the same time, and a
+partition is deleted once past the retention of its archive. Reads aggregate
+from the finer archives the intervals not aggregated yet."""
+import os
+import re
+import time
+import errno
+import struct
+from os.path import join, exists, dirname
+from threading import Lock, Thread, Event
+
+import whisper
+
+from carbon.database import TimeSeriesDatabase
+from carbon.util import pickle
+from carbon import log
+
+
+# Partitions per archive over its retention, which bounds both the number of
+# files and how long past its retention an archive's data is kept
+PARTITIONS_PER_ARCHIVE = 64
+ARCHIVE_DIRECTORY = re.compile(r'^(\d+)x(\d+)$')
+
+floatStruct = struct.Struct('>d')
+bitsStruct = struct.Struct('>Q')
+
+
+def bitLength(x):
+  "The bits of a non-negative integer, as int.bit_length() of Python 2.7"
+  if not x:
+    return 0
+  return len(bin(x)) - 2
+
+
+class BitWriter(object):
+  def __init__(self):
+    self.data = bytearray()
+    self.acc = 0
+    self.bits = 0
+
+  def write(self, value, bits):
+    "Appends the low bits of value, most significant first"
+    self.acc = (self.acc << bits) | (value & ((1 << bits) - 1))
+    self.bits += bits
+    while self.bits >= 8:
+      self.bits -= 8
+      self.data.append((self.acc >> self.bits) & 0xff)
+    self.acc &= (1 << self.bits) - 1
+
+  def getvalue(self):
+    if self.bits:
+      return str(self.data + bytearray([(self.acc << (8 - self.bits)) & 0xff]))
+    return str(self.data)
+
+
+class BitReader(object):
+  def __init__(self, data):
+    self.data = bytearray(data)
+    self.pos = 0
+    self.acc = 0
+    self.bits = 0
+
+  def read(self, bits):
+    while self.bits < bits:
+      self.acc = (self.acc << 8) | self.data[self.pos]
+      self.pos += 1
+      self.bits += 8
+    self.bits -= bits
+    value = self.acc >> self.bits
+    self.acc &= (1 << self.bits) - 1
+    return value
+
+  def readSigned(self, bits):
+    value = self.read(bits)
+    if value >= 1 << (bits - 1):
+      value -= 1 << bits
+    return value
+
+
+# Ranges of delta of deltas, by their prefix and the bits they are stored in
+DOD_RANGES = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+
+
+def encodePoints(points):
+  "Compresses (timestamp, value) points, sorted by unique timestamp"
+  writer = BitWriter()
+  (timestamp, value) = points[0]
+  previousBits = bitsStruct.unpack(floatStruct.pack(value))[0]
+  writer.write(timestamp, 32)
+  writer.write(previousBits, 64)
+  previousTimestamp, previousDelta = timestamp, 0
+  leading, trailing = None, None
+
+  for (timestamp, value) in points[1:]:
+    delta = timestamp - previousTimestamp
+    dod = delta - previousDelta
+    if dod == 0:
+      writer.write(0, 1)
+    else:
+      for (prefix, prefixBits, bits) in DOD_RANGES:
+        if -(1 << (bits - 1)) <= dod < 1 << (bits - 1):
+          writer.write(prefix, prefixBits)
+          writer.write(dod, bits)
+          break
+      else:
+        writer.write(0b1111, 4)
+        writer.write(dod, 64)
+    previousTimestamp, previousDelta = timestamp, delta
+
+    valueBits = bitsStruct.unpack(floatStruct.pack(value))[0]
+    xor = valueBits ^ previousBits
+    previousBits = valueBits
+    if xor == 0:
+      writer.write(0, 1)
+      continue
+    xorLeading = min(64 - bitLength(xor), 31)
+    xorTrailing = bitLength(xor & -xor) - 1
+    if leading is not None and xorLeading >= leading and xorTrailing >= trailing:
+      # The meaningful bits fit in those of the previous value
+      writer.write(0b10, 2)
+      writer.write(xor >> trailing, 64 - leading - trailing)
+    else:
+      leading, trailing = xorLeading, xorTrailing
+      length = 64 - leading - trailing
+      writer.write(0b11, 2)
+      writer.write(leading, 5)
+      writer.write(length & 63, 6)
+      writer.write(xor >> trailing, length)
+
+  return writer.getvalue()
+
+
+def decodePoints(data, count):
+  "Returns the count (timestamp, value) points compressed in data"
+  reader = BitReader(data)
+  timestamp = reader.read(32)
+  valueBits = reader.read(64)
+  points = [(timestamp, floatStruct.unpack(bitsStruct.pack(valueBits))[0])]
+  delta = 0
+  leading, trailing = 0, 0
+
+  for i in xrange(count - 1):
+    if reader.read(1):
+      for (prefix, prefixBits, bits) in DOD_RANGES:
+        if not reader.read(1):
+          delta += reader.readSigned(bits)
+          break
+      else:
+        delta += reader.readSigned(64)
+    timestamp += delta
+
+    if reader.read(1):
+      if reader.read(1):
+        leading = reader.read(5)
+        length = reader.read(6) or 64
+        trailing = 64 - leading - length
+      valueBits ^= reader.read(64 - leading - trailing) << trailing
+    points.append((timestamp, floatStruct.unpack(bitsStruct.pack(valueBits))[0]))
+
+  return points
+
+
+class Partition(object):
+  """The chunk file of a partition of time, with where each metric's frames
+  are in it. The first indexedEnd bytes are covered by the saved index."""
+  FRAME_HEADER = struct.Struct('!HLL') # metric length, points, data length
+  MAX_METRIC_LENGTH = 0xffff
+
+  def __init__(self, directory, start):
+    self.start = start
+    self.path = join(directory, '%d.chunk' % start)
+    self.indexPath = join(directory, '%d.index' % start)
+    self.frames = {} # metric -> [(offset, length)]
+    self.indexedEnd = 0
+    self.size = 0
+    self.fd = None
+
+    if exists(self.indexPath):
+      index = pickle.load(open(self.indexPath, 'rb'))
+      # The index only applies to the chunk it was written for
+      if exists(self.path) and index['inode'] == os.stat(self.path).st_ino:
+        self.frames = index['frames']
+        self.indexedEnd = index['end']
+    if exists(self.path):
+      self._scan()
+
+  def _scan(self):
+    "Indexes the frames past indexedEnd, truncating a torn last frame"
+    fh = open(self.path, 'rb')
+    try:
+      end = os.fstat(fh.fileno()).st_size
+      offset = self.indexedEnd
+      fh.seek(offset)
+      while offset + self.FRAME_HEADER.size <= end:
+        (metricLength, count, dataLength) = self.FRAME_HEADER.unpack(fh.read(self.FRAME_HEADER.size))
+        length = self.FRAME_HEADER.size + metricLength + dataLength
+        if offset + length > end:
+          break
+        metric = fh.read(metricLength)
+        self.frames.setdefault(metric, []).append((offset, length))
+        offset += length
+        fh.seek(offset)
+    finally:
+      fh.close()
+    if offset < end:
+      log.msg("Truncating the torn end of %s" % self.path)
+      fh = open(self.path, 'r+b')
+      try:
+        fh.truncate(offset)
+      finally:
+        fh.close()
+    self.size = offset
+
+  @classmethod
+  def frame(cls, metric, points):
+    data = encodePoints(points)
+    return cls.FRAME_HEADER.pack(len(metric), len(points), len(data)) + metric + data
+
+  def append(self, metric, points):
+    frame = self.frame(metric, points)
+    if self.fd is None:
+      self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(self.fd, frame)
+    self.frames.setdefault(metric, []).append((self.size, len(frame)))
+    self.size += len(frame)
+
+  def snapshot(self, metric):
+    """Returns an open file of the chunk and a copy of the frames of metric
+    in it, which remain readable after the lock guarding the partition is
+    released, even if the chunk is replaced by a compaction or deleted"""
+    return (open(self.path, 'rb'), list(self.frames.get(metric, ())))
+
+  @classmethod
+  def readPoints(cls, fh, frames):
+    "Returns the points of the frames, the last written winning for a timestamp"
+    values = {}
+    for (offset, length) in frames:
+      fh.seek(offset)
+      values.update(cls.readFrame(fh.read(length))[1])
+    return values
+
+  @classmethod
+  def readFrame(cls, frame):
+    (metricLength, count, dataLength) = cls.FRAME_HEADER.unpack_from(frame)
+    start = cls.FRAME_HEADER.size
+    metric = frame[start:start + metricLength]
+    return (metric, decodePoints(frame[start + metricLength:], count))
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+class ChunkDatabase(TimeSeriesDatabase):
+  """Stores metrics in chunk files under LOCAL_DATA_DIR, in a directory per
+  archive of their retentions. Not usable with USE_WRITER_PROCESSES, as
+  every process would keep its own index of the chunks."""
+  METADATA_HEADER = struct.Struct('!L')
+
+  def __init__(self, settings):
+    TimeSeriesDatabase.__init__(self, settings)
+    if settings.USE_WRITER_PROCESSES:
+      raise ValueError("The chunks database does not support USE_WRITER_PROCESSES")
+    self.directory = settings.LOCAL_DATA_DIR
+    self.duration = int(settings.CHUNK_DURATION)
+    self.lock = Lock()
+    self.metrics = {} # metric -> (retentions, xFilesFactor, aggregationMethod)
+    self.partitions = {} # (secondsPerPoint, points) -> {start -> Partition}
+    self.compactor = None
+    self.stopping = Event()
+
+    try:
+      os.makedirs(self.directory, 0755)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self.metadataPath = join(self.directory, 'metrics.log')
+    self._loadMetadata()
+    for name in os.listdir(self.directory):
+      match = ARCHIVE_DIRECTORY.match(name)
+      if match is None:
+        continue
+      archive = (int(match.group(1)), int(match.group(2)))
+      partitions = self.partitions[archive] = {}
+      for chunkName in os.listdir(join(self.directory, name)):
+        if chunkName.endswith('.chunk'):
+          start = int(chunkName[:-len('.chunk')])
+          partitions[start] = Partition(join(self.directory, name), start)
+
+  def _loadMetadata(self):
+    if not exists(self.metadataPath):
+      return
+    data = open(self.metadataPath, 'rb').read()
+    offset = 0
+    while offset + self.METADATA_HEADER.size <= len(data):
+      (length,) = self.METADATA_HEADER.unpack_from(data, offset)
+      offset += self.METADATA_HEADER.size
+      if offset + length > len(data):
+        break
+      (metric, metadata) = pickle.loads(data[offset:offset + length])
+      self.metrics[metric] = metadata
+      offset += length
+
+  def _saveMetadata(self, metric, metadata):
+    "Appends the metadata of metric to the log, the latest record winning"
+    record = pickle.dumps((metric, metadata), 2)
+    fh = open(self.metadataPath, 'ab')
+    try:
+      fh.write(self.METADATA_HEADER.pack(len(record)) + record)
+    finally:
+      fh.close()
+    self.metrics[metric] = metadata
+
+  def open(self):
+    self.stopping.clear()
+    self.compactor = Thread(target=self.compactForever, name='carbon-chunk-compactor')
+    self.compactor.setDaemon(True)
+    self.compactor.start()
+
+  def close(self):
+    if self.compactor is not None:
+      self.stopping.set()
+      self.compactor.join()
+      self.compactor = None
+    try:
+      self.lock.acquire()
+      for partitions in self.partitions.values():
+        for partition in partitions.values():
+          partition.close()
+    finally:
+      self.lock.release()
+
+  def getFilesystemPath(self, metric):
+    return '%s:%s' % (self.directory, metric)
+
+  def exists(self, metric):
+    return metric in self.metrics
+
+  def create(self, metric, retentions, xFilesFactor=None, aggregationMethod=None):
+    whisper.validateArchiveList(retentions)
+    if xFilesFactor is None:
+      xFilesFactor = 0.5
+    if aggregationMethod is None:
+      aggregationMethod = 'average'
+    retentions = [tuple(archive) for archive in retentions]
+    if len(metric) > Partition.MAX_METRIC_LENGTH:
+      raise ValueError("Metric name of %d bytes is longer than the %d bytes chunk frames allow" %
+                       (len(metric), Partition.MAX_METRIC_LENGTH))
+    try:
+      self.lock.acquire()
+      if metric in self.metrics:
+        raise whisper.InvalidConfiguration("Metric %s already exists!" % metric)
+      self._saveMetadata(metric, (retentions, xFilesFactor, aggregationMethod))
+    finally:
+      self.lock.release()
+
+  def getDuration(self, archive):
+    """Returns how long the partitions of archive span: whole CHUNK_DURATIONs,
+    about PARTITIONS_PER_ARCHIVE of them over its retention"""
+    (secondsPerPoint, points) = archive
+    return self.duration * max(1, secondsPerPoint * points // (self.duration * PARTITIONS_PER_ARCHIVE))
+
+  def _append(self, archive, metric, points):
+    """Appends the sorted points of metric to the partitions of archive they
+    fall in. Called holding the lock."""
+    partitions = self.partitions.get(archive)
+    directory = join(self.directory, '%dx%d' % archive)
+    if partitions is None:
+      if not exists(directory):
+        os.mkdir(directory, 0755)
+      partitions = self.partitions[archive] = {}
+    duration = self.getDuration(archive)
+    byPartition = {}
+    for point in points:
+      byPartition.setdefault(point[0] - point[0] % duration, []).append(point)
+    for (start, partitionPoints) in byPartition.items():
+      partition = partitions.get(start)
+      if partition is None:
+        partition = partitions[start] = Partition(directory, start)
+      partition.append(metric, partitionPoints)
+
+  def update_many(self, metric, datapoints):
+    (retentions, xFilesFactor, aggregationMethod) = self.metrics[metric]
+    now = int(time.time())
+
+    # As in whisper, datapoints go to the first archive covering their age,
+    # aligned to its precision, and the last one for an interval wins
+    byArchive = {}
+    for (timestamp, value) in datapoints:
+      timestamp = int(timestamp)
+      for (secondsPerPoint, points) in retentions:
+        if secondsPerPoint * points >= now - timestamp:
+          values = byArchive.setdefault((secondsPerPoint, points), {})
+          values[timestamp - timestamp % secondsPerPoint] = float(value)
+          break
+
+    try:
+      self.lock.acquire()
+      for (archive, values) in byArchive.items():
+        self._append(archive, metric, sorted(values.items()))
+    finally:
+      self.lock.release()
+
+  def info(self, metric):
+    (retentions, xFilesFactor, aggregationMethod) = self.metrics[metric]
+    return {
+      'aggregationMethod': aggregationMethod,
+      'xFilesFactor': xFilesFactor,
+      'maxRetention': max([secondsPerPoint * points for (secondsPerPoint, points) in retentions]),
+      'archives': [{'secondsPerPoint': secondsPerPoint, 'points': points,
+                    'retention': secondsPerPoint * points}
+                   for (secondsPerPoint, points) in retentions],
+    }
+
+  def fetch(self, metric, fromTime, untilTime):
+    "Reads like whisper.fetch(), from the archive it would pick"
+    (retentions, xFilesFactor, aggregationMethod) = self.metrics[metric]
+    now = int(time.time())
+    untilTime = min(int(untilTime), now)
+    for (index, (secondsPerPoint, points)) in enumerate(retentions):
+      if secondsPerPoint * points >= now - fromTime:
+        break
+    step = secondsPerPoint
+    fromInterval = int(fromTime - (fromTime % step)) + step
+    untilInterval = int(untilTime - (untilTime % step)) + step
+
+    values = self._archiveValues(metric, retentions[:index + 1], fromInterval, untilInterval, now)
+    return ((fromInterval, untilInterval, step),
+            [values.get(interval) for interval in xrange(fromInterval, untilInterval, step)])
+
+  def _archiveValues(self, metric, retentions, fromTime, untilTime, now):
+    """Returns the values of metric in the last archive of retentions from
+    fromTime until untilTime, by interval. The intervals past the last one
+    aggregated into it yet are aggregated from the finer archives."""
+    archive = retentions[-1]
+    (secondsPerPoint, points) = archive
+    values = self._read(archive, metric, max(fromTime, now - secondsPerPoint * points), untilTime)
+    if len(retentions) > 1:
+      if values:
+        finerFrom = max(values) + secondsPerPoint
+      else:
+        finerFrom = fromTime
+      if finerFrom < untilTime:
+        finer = self._archiveValues(metric, retentions[:-1], finerFrom, untilTime, now)
+        values.update(self._aggregate(metric, finer, retentions[-2][0], secondsPerPoint))
+    return values
+
+  def _aggregate(self, metric, values, secondsPerPoint, coarserSecondsPerPoint):
+    """Aggregates the values of metric by interval of coarserSecondsPerPoint,
+    as whisper propagates them to a lower precision archive"""
+    (retentions, xFilesFactor, aggregationMethod) = self.metrics[metric]
+    intervals = set([timestamp - timestamp % coarserSecondsPerPoint for timestamp in values])
+    aggregated = {}
+    for interval in intervals:
+      neighborValues = [values.get(t) for t in xrange(interval, interval + coarserSecondsPerPoint, secondsPerPoint)]
+      knownValues = [v for v in neighborValues if v is not None]
+      if float(len(knownValues)) / len(neighborValues) >= xFilesFactor:
+        aggregated[interval] = whisper.aggregate(aggregationMethod, knownValues, neighborValues)
+    return aggregated
+
+  def _read(self, archive, metric, fromTime, untilTime):
+    "Returns the values of metric in archive from fromTime until untilTime"
+    duration = self.getDuration(archive)
+    # Only the frames to read are collected under the lock, not read
+    sources = []
+    try:
+      self.lock.acquire()
+      for (start, partition) in self.partitions.get(archive, {}).items():
+        if start + duration > fromTime and start < untilTime and metric in partition.frames:
+          sources.append(partition.snapshot(metric))
+    finally:
+      self.lock.release()
+    values = {}
+    for (fh, frames) in sources:
+      try:
+        values.update(Partition.readPoints(fh, frames))
+      finally:
+        fh.close()
+    return dict([(timestamp, value) for (timestamp, value) in values.iteritems()
+                 if fromTime <= timestamp < untilTime])
+
+  def set_aggregation(self, metric, aggregationMethod, xFilesFactor=None):
+    if aggregationMethod not in whisper.aggregationMethods:
+      raise whisper.InvalidAggregationMethod("Unrecognized aggregation method %s" % aggregationMethod)
+    try:
+      self.lock.acquire()
+      (retentions, oldXFilesFactor, oldAggregationMethod) = self.metrics[metric]
+      if xFilesFactor is None:
+        xFilesFactor = oldXFilesFactor
+      self._saveMetadata(metric, (retentions, xFilesFactor, aggregationMethod))
+    finally:
+      self.lock.release()
+    return oldAggregationMethod
+
+  def estimateWriteSize(self, pointCount, retentions=None):
+    # Appended datapoints take a few bytes each, and creates a metadata record
+    size = Partition.FRAME_HEADER.size + 64 + pointCount * 4
+    if retentions is not None:
+      size += 128
+    return size
+
+  def compactForever(self):
+    while not self.stopping.wait(min(60, self.duration / 4.0)):
+      try:
+        self.compact()
+      except:
+        log.err()
+
+  def compact(self, now=None):
+    """Compacts the partitions over for their whole duration that have
+    unindexed frames, aggregating them into the next archives, then deletes
+    those past the retention of their archive. Finer archives go first, so
+    what they aggregate into coarser ones is compacted in the same pass."""
+    if now is None:
+      now = time.time()
+
+    # Writers add partitions meanwhile
+    try:
+      self.lock.acquire()
+      archives = [(archive, sorted(partitions.items()))
+                  for (archive, partitions) in self.partitions.items()]
+    finally:
+      self.lock.release()
+    archives.sort()
+
+    for (archive, partitions) in archives:
+      (secondsPerPoint, points) = archive
+      duration = self.getDuration(archive)
+      for (start, partition) in partitions:
+        if self.stopping.is_set():
+          return
+        end = start + duration
+        expired = end < now - secondsPerPoint * points
+        # Even an expired partition is aggregated first
+        if (expired or end + duration <= now) and partition.size > partition.indexedEnd:
+          self._compact(archive, start)
+        if expired:
+          self._delete(archive, start)
+
+  def _delete(self, archive, start):
+    try:
+      self.lock.acquire()
+      partition = self.partitions[archive].pop(start)
+      partition.close()
+    finally:
+      self.lock.release()
+    for path in (partition.path, partition.indexPath):
+      if exists(path):
+        os.remove(path)
+    log.msg("Deleted %s past its retention" % partition.path)
+
+  def _downsample(self, archive, start, metric, values):
+    """Returns the next archive of metric after archive and the points of
+    values aggregated into it, or None if archive is its last. The interval
+    straddling the start of the partition also gets the values before it."""
+    metadata = self.metrics.get(metric)
+    if metadata is None or archive not in metadata[0]:
+      return None
+    retentions = metadata[0]
+    index = retentions.index(archive)
+    if index + 1 == len(retentions):
+      return None
+    coarser = retentions[index + 1]
+    first = start - start % coarser[0]
+    if first < start:
+      values = dict(values)
+      values.update(self._read(archive, metric, first, start))
+    return (coarser, sorted(self._aggregate(metric, values, archive[0], coarser[0]).items()))
+
+  def _compact(self, archive, start):
+    """Rewrites a partition with a single frame per metric, aggregating them
+    into the next archive of each metric, then saves its index. Frames
+    appended meanwhile are carried over as they are."""
+    compactStart = time.time()
+    try:
+      self.lock.acquire()
+      partition = self.partitions[archive][start]
+      end = partition.size
+      source = open(partition.path, 'rb')
+      sourceFrames = dict([(metric, list(frames)) for (metric, frames) in partition.frames.items()])
+    finally:
+      self.lock.release()
+
+    tmpPath = partition.path + '.tmp'
+    frames = {}
+    downsampled = []
+    fh = open(tmpPath, 'wb')
+    try:
+      offset = 0
+      for (metric, metricFrames) in sourceFrames.iteritems():
+        values = Partition.readPoints(source, metricFrames)
+        frame = Partition.frame(metric, sorted(values.items()))
+        fh.write(frame)
+        frames[metric] = [(offset, len(frame))]
+        offset += len(frame)
+        coarser = self._downsample(archive, start, metric, values)
+        if coarser is not None and coarser[1]:
+          downsampled.append((metric, coarser))
+
+      try:
+        self.lock.acquire()
+        # Carry over what was appended since, unindexed
+        if partition.size > end:
+          source.seek(end)
+          fh.write(source.read(partition.size - end))
+        fh.flush()
+        os.fsync(fh.fileno())
+        index = {'inode': os.fstat(fh.fileno()).st_ino, 'end': offset, 'frames': frames}
+        indexFh = open(partition.indexPath + '.tmp', 'wb')
+        try:
+          pickle.dump(index, indexFh, 2)
+        finally:
+          indexFh.close()
+        partition.close()
+        os.rename(tmpPath, partition.path)
+        os.rename(partition.indexPath + '.tmp', partition.indexPath)
+        self.partitions[archive][start] = Partition(dirname(partition.path), start)
+        for (metric, (coarser, points)) in downsampled:
+          self._append(coarser, metric, points)
+      finally:
+        self.lock.release()
+    finally:
+      source.close()
+      fh.close()
+      if exists(tmpPath):
+        os.remove(tmpPath)
+
+    log.msg("Compacted %d metrics of %s into %d in %.2f seconds" %
+            (len(sourceFrames), partition.path, len(downsampled), time.time() - compactStart))
@@ -5,6 +5,7 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import Int32StringReceiver
 from carbon.conf import settings
 from carbon.util import pickle
+from carbon.binary import encodeFrame
 from carbon import log, state, instrumentation
 from collections import deque
 from time import time
@@ -12,6 +13,12 @@ from time import time
 
 SEND_QUEUE_LOW_WATERMARK = settings.MAX_QUEUE_SIZE * settings.QUEUE_LOW_WATERMARK_PCT
 
+# How datapoints are encoded for each DESTINATION_PROTOCOL
+encoders = {
+  'pickle' : lambda datapoints: pickle.dumps(datapoints, protocol=-1),
+  'binary' : encodeFrame,
+}
+
 
 class CarbonClientProtocol(Int32StringReceiver):
   def connectionMade(self):
@@ -58,7 +65,7 @@ class CarbonClientProtocol(Int32StringReceiver):
     reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.sendQueued)
 
   def _sendDatapoints(self, datapoints):
-      self.sendString(pickle.dumps(datapoints, protocol=-1))
+      self.sendString(self.factory.encode(datapoints))
       instrumentation.increment(self.sent, len(datapoints))
       instrumentation.increment(self.batchesSent)
       self.factory.checkQueue()
@@ -179,6 +186,7 @@ class CarbonClientFactory(ReconnectingClientFactory):
     self.attemptedRelays = 'destinations.%s.attemptedRelays' % self.destinationName
     self.fullQueueDrops = 'destinations.%s.fullQueueDrops' % self.destinationName
     self.queuedUntilConnected = 'destinations.%s.queuedUntilConnected' % self.destinationName
+    self.encode = encoders[settings.DESTINATION_PROTOCOL]
   def queueFullCallback(self, result):
     state.events.cacheFull()
     log.clients('%s send queue is full (%d datapoints)' % (self, result))
@@ -258,6 +266,23 @@ class CarbonClientFactory(ReconnectingClientFactory):
     else:
       instrumentation.increment(self.queuedUntilConnected)
 
+  def sendDatapoints(self, datapoints):
+    """Queues a list of (metric, datapoint) tuples like sendDatapoint, up to
+    MAX_QUEUE_SIZE, with a single send scheduled for all of them"""
+    instrumentation.increment(self.attemptedRelays, len(datapoints))
+    space = settings.MAX_QUEUE_SIZE - self.queueSize
+    if space < len(datapoints):
+      if not self.queueFull.called:
+        self.queueFull.callback(self.queueSize)
+      instrumentation.increment(self.fullQueueDrops, len(datapoints) - max(space, 0))
+      datapoints = datapoints[:max(space, 0)]
+    self.queue.extend(datapoints)
+
+    if self.connectedProtocol:
+      reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.connectedProtocol.sendQueued)
+    else:
+      instrumentation.increment(self.queuedUntilConnected, len(datapoints))
+
   def sendHighPriorityDatapoint(self, metric, datapoint):
     """The high priority datapoint is one relating to the carbon
     daemon itself.  It puts the datapoint on the left of the deque,
@@ -314,6 +339,9 @@ class CarbonClientFactory(ReconnectingClientFactory):
 
 class CarbonClientManager(Service):
   def __init__(self, router):
+    if settings.DESTINATION_PROTOCOL not in encoders:
+      raise ValueError("Unknown DESTINATION_PROTOCOL %s, expected one of %s" %
+                       (settings.DESTINATION_PROTOCOL, ', '.join(sorted(encoders))))
     self.router = router
     self.client_factories = {} # { destination : CarbonClientFactory() }
 
@@ -369,6 +397,18 @@ class CarbonClientManager(Service):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendDatapoint(metric, datapoint)
 
+  def sendDatapoints(self, datapoints):
+    "Routes a list of (metric, datapoint) tuples, queued per destination"
+    batches = {}
+    for item in datapoints:
+      for destination in self.router.getDestinations(item[0]):
+        try:
+          batches[destination].append(item)
+        except KeyError:
+          batches[destination] = [item]
+    for (destination, batch) in batches.iteritems():
+      self.client_factories[destination].sendDatapoints(batch)
+
   def sendHighPriorityDatapoint(self, metric, datapoint):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendHighPriorityDatapoint(metric, datapoint)
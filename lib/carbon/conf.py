@@ -21,7 +21,6 @@ from os.path import join, dirname, normpath, exists, isdir
 from optparse import OptionParser
 from ConfigParser import ConfigParser
 
-import whisper
 from carbon import log
 from carbon.exceptions import CarbonConfigException
 
@@ -31,8 +30,30 @@ from twisted.python import usage
 defaults = dict(
   USER="",
   MAX_CACHE_SIZE=float('inf'),
+  CACHE_SHARDS=1,
+  CACHE_COMPACT_DATAPOINTS=False,
+  CACHE_COALESCE_DATAPOINTS=False,
   MAX_UPDATES_PER_SECOND=500,
+  ADAPTIVE_UPDATE_RATE=False,
+  MIN_UPDATES_PER_SECOND=50,
+  UPDATE_LATENCY_TARGET=0.05,
+  UPDATE_RATE_ADJUST_INTERVAL=10,
   MAX_CREATES_PER_MINUTE=float('inf'),
+  MAX_WRITE_BYTES_PER_SECOND=float('inf'),
+  WRITER_THREADS=1,
+  USE_WRITER_PROCESSES=False,
+  WRITER_PROCESS_BATCH_SIZE=100,
+  CREATE_THREADS=0,
+  MAX_SPILL_SIZE=0,
+  ENABLE_WAL=False,
+  WAL_FLUSH_INTERVAL=1,
+  WAL_FSYNC_INTERVAL=1,
+  WAL_SEGMENT_SIZE=64 * 1024 * 1024,
+  CACHE_SNAPSHOT_ON_SHUTDOWN=False,
+  SCHEMA_MATCH_CACHE_SIZE=100000,
+  USE_FILE_INDEX=False,
+  FILE_INDEX_SCAN_THREADS=8,
+  FILE_INDEX_RECONCILE_INTERVAL=3600,
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
@@ -40,11 +61,24 @@ defaults = dict(
   UDP_RECEIVER_PORT=2003,
   PICKLE_RECEIVER_INTERFACE='0.0.0.0',
   PICKLE_RECEIVER_PORT=2004,
+  BINARY_RECEIVER_INTERFACE='0.0.0.0',
+  BINARY_RECEIVER_PORT=0,
+  METRIC_NAME_INTERN_SIZE=0,
+  INGEST_PROCESSES=0,
+  INGEST_SOCKET='',
   CACHE_QUERY_INTERFACE='0.0.0.0',
   CACHE_QUERY_PORT=7002,
   LOG_UPDATES=True,
   LOG_CACHE_HITS = True,
+  DATABASE='whisper',
+  CHUNK_DURATION=7200,
   WHISPER_AUTOFLUSH=False,
+  WHISPER_SYNC_BATCH_SIZE=0,
+  WHISPER_SYNC_WINDOW=1.0,
+  WHISPER_SYNC_THREADS=4,
+  WHISPER_OPEN_FILES=0,
+  WHISPER_MMAP=False,
+  WHISPER_VECTORIZE=False,
   WHISPER_SPARSE_CREATE=False,
   WHISPER_FALLOCATE_CREATE=False,
   WHISPER_LOCK_WRITES=False,
@@ -64,6 +98,7 @@ defaults = dict(
   RELAY_METHOD='rules',
   REPLICATION_FACTOR=1,
   DESTINATIONS=[],
+  DESTINATION_PROTOCOL='pickle',
   USE_FLOW_CONTROL=True,
   USE_INSECURE_UNPICKLER=False,
   USE_WHITELIST=False,
@@ -218,23 +253,6 @@ class CarbonCacheOptions(usage.Options):
             print "Error: missing required config %s" % storage_schemas
             sys.exit(1)
 
-        if settings.WHISPER_AUTOFLUSH:
-            log.msg("Enabling Whisper autoflush")
-            whisper.AUTOFLUSH = True
-
-        if settings.WHISPER_FALLOCATE_CREATE:
-            if whisper.CAN_FALLOCATE:
-                log.msg("Enabling Whisper fallocate support")
-            else:
-                log.err("WHISPER_FALLOCATE_CREATE is enabled but linking failed.")
-
-        if settings.WHISPER_LOCK_WRITES:
-            if whisper.CAN_LOCK:
-                log.msg("Enabling Whisper file locking")
-                whisper.LOCK = True
-            else:
-                log.err("WHISPER_LOCK_WRITES is enabled but import of fcntl module failed.")
-
         if not "action" in self:
             self["action"] = "start"
         self.handleAction()
@@ -517,6 +535,12 @@ def read_config(program, options, **kwargs):
         "LOCAL_DATA_DIR", join(settings["STORAGE_DIR"], "whisper"))
     settings.setdefault(
         "WHITELISTS_DIR", join(settings["STORAGE_DIR"], "lists"))
+    settings.setdefault(
+        "SPILL_DIR", join(settings["STORAGE_DIR"], "spill", program))
+    settings.setdefault(
+        "WAL_DIR", join(settings["STORAGE_DIR"], "wal", program))
+    settings.setdefault(
+        "SNAPSHOT_DIR", join(settings["STORAGE_DIR"], "snapshot", program))
 
     # Read configuration options from program-specific section.
     section = program[len("carbon-"):]
@@ -541,6 +565,12 @@ def read_config(program, options, **kwargs):
         settings["LOG_DIR"] = (options["logdir"] or
                               join(settings["LOG_DIR"],
                                 "%s-%s" % (program ,options["instance"])))
+        settings["SPILL_DIR"] = join(settings["SPILL_DIR"],
+                                     "%s-%s" % (program, options["instance"]))
+        settings["WAL_DIR"] = join(settings["WAL_DIR"],
+                                   "%s-%s" % (program, options["instance"]))
+        settings["SNAPSHOT_DIR"] = join(settings["SNAPSHOT_DIR"],
+                                        "%s-%s" % (program, options["instance"]))
     else:
         settings["pidfile"] = (
             options["pidfile"] or
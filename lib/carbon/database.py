@@ -0,0 +1,274 @@
+"""The databases carbon-cache writes datapoints to.
+
+A database is a subclass of TimeSeriesDatabase. Those shipped with carbon
+are registered in databases, their names mapped to the dotted paths of their
+classes, and the DATABASE setting picks one of them by name, or any other by
+the dotted path of its class."""
+import os
+import errno
+from os.path import join, dirname, sep
+from threading import Lock, local
+
+import whisper
+
+from carbon.syncer import Syncer
+from carbon.filecache import FileCache, headerCache
+from carbon.whispermap import MappedFileCache
+from carbon import log
+
+
+class TimeSeriesDatabase(object):
+  """Base class of the databases carbon-cache writes to, one instance of
+  which is created per process from the settings.
+
+  Writer threads use the database concurrently, but never for the same
+  metric at once. A process calls open() before its first write and close()
+  after its last. Metrics are created with the retentions of their storage
+  schema, a list of (secondsPerPoint, points) tuples from finest to coarsest,
+  and with the xFilesFactor and aggregationMethod of their aggregation
+  schema, either of which may be None for the database's default."""
+  # The extension of the files holding each metric under LOCAL_DATA_DIR,
+  # for a FileIndex of them, or None if the database is not made of such
+  # files
+  extension = None
+
+  def __init__(self, settings):
+    self.settings = settings
+
+  def open(self):
+    pass
+
+  def close(self):
+    pass
+
+  def getFilesystemPath(self, metric):
+    "Returns where metric is stored, as shown in logs"
+    raise NotImplementedError()
+
+  def exists(self, metric):
+    raise NotImplementedError()
+
+  def create(self, metric, retentions, xFilesFactor=None, aggregationMethod=None):
+    raise NotImplementedError()
+
+  def update_many(self, metric, datapoints):
+    "Writes the (timestamp, value) datapoints of metric, in any order"
+    raise NotImplementedError()
+
+  def info(self, metric):
+    """Returns a dict of the aggregationMethod and xFilesFactor of metric,
+    and its archives as dicts of their secondsPerPoint and points"""
+    raise NotImplementedError()
+
+  def fetch(self, metric, fromTime, untilTime):
+    """Returns ((start, end, step), values) for metric between fromTime and
+    untilTime like whisper.fetch(), for checking what was written"""
+    raise NotImplementedError()
+
+  def set_aggregation(self, metric, aggregationMethod, xFilesFactor=None):
+    "Changes how metric is aggregated, returning the former aggregationMethod"
+    raise NotImplementedError()
+
+  def invalidate(self, metric):
+    """Forgets whatever the calling writer thread has cached about metric,
+    which set_aggregation() changed"""
+    pass
+
+  def estimateWriteSize(self, pointCount, retentions=None):
+    """Returns about how many bytes writing pointCount datapoints takes,
+    after creating the metric with retentions if given. Assumes 12 bytes
+    per datapoint, as a timestamp and a value."""
+    size = pointCount * 12
+    if retentions is not None:
+      size += sum([points for (secondsPerPoint, points) in retentions]) * 12
+    return size
+
+
+class WhisperDatabase(TimeSeriesDatabase):
+  """Stores every metric in a whisper file under LOCAL_DATA_DIR, and applies
+  the WHISPER_* settings.
+
+  Each writer thread keeps its own FileCache, or MappedFileCache, of open
+  files when WHISPER_OPEN_FILES is set. With WHISPER_AUTOFLUSH and
+  WHISPER_SYNC_BATCH_SIZE, the files written are synced in batches by a
+  Syncer running between open() and close()."""
+  extension = '.wsp'
+
+  def __init__(self, settings):
+    TimeSeriesDatabase.__init__(self, settings)
+    self.dataDir = settings.LOCAL_DATA_DIR
+    self.sparseCreate = settings.WHISPER_SPARSE_CREATE
+    self.fallocateCreate = settings.WHISPER_FALLOCATE_CREATE
+    self.syncer = None
+    self.local = local()
+    self.fileCaches = [] # of every writer thread
+    self.fileCachesLock = Lock()
+    self.maxOpen = 0
+    self.mmap = False
+    self.vectorize = False
+
+    if settings.WHISPER_AUTOFLUSH:
+      if settings.WHISPER_SYNC_BATCH_SIZE:
+        log.msg("Enabling batched Whisper autoflush")
+      else:
+        log.msg("Enabling Whisper autoflush")
+        whisper.AUTOFLUSH = True
+
+    if settings.WHISPER_OPEN_FILES:
+      log.msg("Keeping up to %d Whisper files open" % settings.WHISPER_OPEN_FILES)
+      self.maxOpen = max(1, settings.WHISPER_OPEN_FILES // settings.WRITER_THREADS)
+      # The file caches bound the header cache by the open files
+      if headerCache is not None:
+        whisper.CACHE_HEADERS = True
+      else:
+        log.msg("Whisper header cache not found, headers are read on every update")
+      if settings.WHISPER_MMAP:
+        log.msg("Enabling memory mapped Whisper updates")
+        self.mmap = True
+        if settings.WHISPER_VECTORIZE:
+          try:
+            import numpy
+            log.msg("Enabling vectorized Whisper updates")
+            self.vectorize = True
+          except ImportError:
+            log.err("WHISPER_VECTORIZE is enabled but import of numpy failed.")
+    elif settings.WHISPER_MMAP:
+      log.err("WHISPER_MMAP is enabled but WHISPER_OPEN_FILES is not set.")
+
+    if settings.WHISPER_FALLOCATE_CREATE:
+      if whisper.CAN_FALLOCATE:
+        log.msg("Enabling Whisper fallocate support")
+      else:
+        log.err("WHISPER_FALLOCATE_CREATE is enabled but linking failed.")
+
+    if settings.WHISPER_LOCK_WRITES:
+      if whisper.CAN_LOCK:
+        log.msg("Enabling Whisper file locking")
+        whisper.LOCK = True
+      else:
+        log.err("WHISPER_LOCK_WRITES is enabled but import of fcntl module failed.")
+
+  def open(self):
+    if self.settings.WHISPER_AUTOFLUSH and self.settings.WHISPER_SYNC_BATCH_SIZE:
+      self.syncer = Syncer(self.settings.WHISPER_SYNC_BATCH_SIZE,
+                           self.settings.WHISPER_SYNC_WINDOW,
+                           self.settings.WHISPER_SYNC_THREADS)
+
+  def close(self):
+    try:
+      self.fileCachesLock.acquire()
+      fileCaches, self.fileCaches = self.fileCaches, []
+    finally:
+      self.fileCachesLock.release()
+    for files in fileCaches:
+      files.close()
+    self.local = local()
+
+    if self.syncer is not None:
+      self.syncer.close()
+      self.syncer = None
+
+  def getFilesystemPath(self, metric):
+    return join(self.dataDir, metric.replace('.', sep).lstrip(sep) + self.extension)
+
+  def exists(self, metric):
+    return os.path.exists(self.getFilesystemPath(metric))
+
+  def create(self, metric, retentions, xFilesFactor=None, aggregationMethod=None):
+    path = self.getFilesystemPath(metric)
+    try:
+      os.makedirs(dirname(path), 0755)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    whisper.create(path, retentions, xFilesFactor, aggregationMethod,
+                   self.sparseCreate, self.fallocateCreate)
+
+  def _fileCache(self):
+    "Returns the FileCache of the calling thread, or None"
+    if not self.maxOpen:
+      return None
+    files = getattr(self.local, 'files', None)
+    if files is None:
+      if self.mmap:
+        files = MappedFileCache(self.maxOpen, self.vectorize)
+      else:
+        files = FileCache(self.maxOpen)
+      self.local.files = files
+      try:
+        self.fileCachesLock.acquire()
+        self.fileCaches.append(files)
+      finally:
+        self.fileCachesLock.release()
+    return files
+
+  def update_many(self, metric, datapoints):
+    path = self.getFilesystemPath(metric)
+    files = self._fileCache()
+    if files is not None:
+      fh = files.update(path, datapoints)
+      if self.syncer is not None:
+        self.syncer.add(os.dup(fh.fileno()))
+    elif self.syncer is not None:
+      self._updateAndSync(path, datapoints)
+    else:
+      whisper.update_many(path, datapoints)
+
+  def _updateAndSync(self, path, datapoints):
+    """Like whisper.update_many, but leaves the sync of the file to the syncer
+    instead of waiting for it"""
+    points = [(int(t), float(v)) for (t, v) in datapoints]
+    points.sort(key=lambda p: p[0], reverse=True)
+    fh = open(path, 'r+b', whisper.BUFFERING)
+    try:
+      if whisper.CAN_FADVISE and whisper.FADVISE_RANDOM:
+        whisper.posix_fadvise(fh.fileno(), 0, 0, whisper.POSIX_FADV_RANDOM)
+      whisper.file_update_many(fh, points)
+      fh.flush()
+      self.syncer.add(os.dup(fh.fileno()))
+    finally:
+      fh.close()
+
+  def info(self, metric):
+    return whisper.info(self.getFilesystemPath(metric))
+
+  def fetch(self, metric, fromTime, untilTime):
+    return whisper.fetch(self.getFilesystemPath(metric), fromTime, untilTime)
+
+  def set_aggregation(self, metric, aggregationMethod, xFilesFactor=None):
+    path = self.getFilesystemPath(metric)
+    if xFilesFactor is None:
+      return whisper.setAggregationMethod(path, aggregationMethod)
+    return whisper.setAggregationMethod(path, aggregationMethod, xFilesFactor)
+
+  def invalidate(self, metric):
+    files = getattr(self.local, 'files', None)
+    if files is not None:
+      files.invalidate(self.getFilesystemPath(metric))
+
+  def estimateWriteSize(self, pointCount, retentions=None):
+    size = pointCount * whisper.pointSize
+    if retentions is not None:
+      size += (whisper.metadataSize +
+               whisper.archiveInfoSize * len(retentions) +
+               whisper.pointSize * sum([points for (secondsPerPoint, points) in retentions]))
+    return size
+
+
+databases = {
+  'whisper' : 'carbon.database.WhisperDatabase',
+  'chunks' : 'carbon.chunks.ChunkDatabase',
+}
+
+
+def loadDatabase(settings):
+  "Returns an instance of the database the DATABASE setting names"
+  name = settings.DATABASE
+  path = databases.get(name, name)
+  try:
+    (moduleName, className) = path.rsplit('.', 1)
+    cls = getattr(__import__(moduleName, fromlist=[className]), className)
+  except (ValueError, ImportError, AttributeError):
+    raise ValueError("Unknown DATABASE %s, expected one of %s or the path of a class" %
+                     (name, ', '.join(sorted(databases))))
+  return cls(settings)
@@ -22,8 +22,41 @@ class Event:
         log.err(None, "Exception in %s event handler: args=%s kwargs=%s" % (self.name, args, kwargs))
 
 
-metricReceived = Event('metricReceived')
-metricGenerated = Event('metricGenerated')
+class BatchEvent(Event):
+  """An event about (metric, datapoint) tuples, which can also be fired for a
+  whole list of them with batch(). Handlers added with a batchHandler get
+  the list in a single call, the others one call per datapoint."""
+  def __init__(self, name):
+    Event.__init__(self, name)
+    self.batchHandlers = {}
+
+  def addHandler(self, handler, batchHandler=None):
+    Event.addHandler(self, handler)
+    if batchHandler is not None:
+      self.batchHandlers[handler] = batchHandler
+
+  def removeHandler(self, handler):
+    Event.removeHandler(self, handler)
+    self.batchHandlers.pop(handler, None)
+
+  def batch(self, datapoints):
+    for handler in self.handlers:
+      batchHandler = self.batchHandlers.get(handler)
+      if batchHandler is not None:
+        try:
+          batchHandler(datapoints)
+        except:
+          log.err(None, "Exception in %s batch event handler: %d datapoints" % (self.name, len(datapoints)))
+      else:
+        for (metric, datapoint) in datapoints:
+          try:
+            handler(metric, datapoint)
+          except:
+            log.err(None, "Exception in %s event handler: args=%s" % (self.name, (metric, datapoint)))
+
+
+metricReceived = BatchEvent('metricReceived')
+metricGenerated = BatchEvent('metricGenerated')
 specialMetricReceived = Event('specialMetricReceived')
 specialMetricGenerated = Event('specialMetricGenerated')
 cacheFull = Event('cacheFull')
@@ -32,7 +65,8 @@ pauseReceivingMetrics = Event('pauseReceivingMetrics')
 resumeReceivingMetrics = Event('resumeReceivingMetrics')
 
 # Default handlers
-metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'),
+                          lambda datapoints: state.instrumentation.increment('metricsReceived', len(datapoints)))
 specialMetricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
 
 
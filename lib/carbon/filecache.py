@@ -0,0 +1,117 @@
+import os
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+import whisper
+
+from carbon.util import LRUCache
+
+
+class OpenFileHeaders(dict):
+  """Takes the place of whisper's header cache, which otherwise keeps the
+  header of every file read with whisper.CACHE_HEADERS set, including those
+  whisper.info() and fetch() read for cache queries. Only the headers of the
+  files open in a FileCache are kept."""
+  def __init__(self):
+    dict.__init__(self)
+    self.paths = set()
+
+  def __setitem__(self, path, header):
+    if path in self.paths:
+      dict.__setitem__(self, path, header)
+
+  def opened(self, path):
+    self.paths.add(path)
+
+  def closed(self, path):
+    self.paths.discard(path)
+    self.pop(path, None)
+
+
+# Looked up here as the name would be mangled within a class. None if whisper
+# no longer keeps its headers there, in which case they must not be cached.
+if getattr(whisper, '__headerCache', None) is not None:
+  headerCache = OpenFileHeaders()
+  setattr(whisper, '__headerCache', headerCache)
+else:
+  headerCache = None
+
+
+class FileCache(object):
+  """Keeps up to maxOpen whisper files open between updates, so that writing
+  a metric does not cost an open(), a header read and a close() each time.
+
+  Headers are kept by whisper itself, which caches them by path when
+  whisper.CACHE_HEADERS is set, in headerCache, which only holds those of
+  the files open in a FileCache. A cached handle is only reused while its
+  file still has a link, so files removed or replaced behind carbon's back
+  are reopened, while a file whose header is changed in place must be
+  invalidate()d. With whisper.LOCK set, files are unlocked after every
+  update.
+
+  A FileCache must only be used by one thread at a time."""
+  def __init__(self, maxOpen):
+    self.handles = LRUCache(maxOpen, self._close)
+
+  def __len__(self):
+    return len(self.handles)
+
+  def _close(self, path, fh):
+    if headerCache is not None:
+      headerCache.closed(path)
+    fh.close()
+
+  def open(self, path):
+    fh = self.handles.get(path)
+    if fh is not None:
+      if os.fstat(fh.fileno()).st_nlink:
+        return fh
+      self.invalidate(path)
+
+    fh = self._open(path)
+    if headerCache is not None:
+      headerCache.opened(path)
+    self.handles.put(path, fh)
+    return fh
+
+  def _open(self, path):
+    fh = open(path, 'r+b', whisper.BUFFERING)
+    if whisper.CAN_FADVISE and whisper.FADVISE_RANDOM:
+      whisper.posix_fadvise(fh.fileno(), 0, 0, whisper.POSIX_FADV_RANDOM)
+    return fh
+
+  def _write(self, fh, points):
+    whisper.file_update_many(fh, points)
+    if whisper.LOCK:
+      # whisper leaves unlocking to close()
+      fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+  def update(self, path, datapoints):
+    """Writes datapoints to the file at path like whisper.update_many(), and
+    returns its handle"""
+    points = sorted([(int(timestamp), float(value))
+                     for (timestamp, value) in datapoints],
+                    key=lambda point: point[0], reverse=True)
+    fh = self.open(path)
+    try:
+      self._write(fh, points)
+    except:
+      # The file may have changed under the cached header
+      self.invalidate(path)
+      raise
+    return fh
+
+  def invalidate(self, path):
+    "Closes the file at path, if open, and forgets its header"
+    fh = self.handles.pop(path)
+    if fh is not None:
+      self._close(path, fh)
+    elif headerCache is not None:
+      headerCache.pop(path, None)
+
+  def close(self):
+    for (path, fh) in self.handles.items():
+      self.invalidate(path)
@@ -0,0 +1,123 @@
+import os
+import time
+from os.path import exists, isdir, join
+from threading import Lock, Thread
+from Queue import Queue, Empty
+
+from carbon import log
+
+
+class FileIndex(object):
+  """Remembers which database files exist under root, so the writer can tell
+  new metrics apart with a set lookup instead of a stat() per metric.
+
+  Until the first rebuild() completes, lookups that miss fall back to
+  stat(). Files created through carbon are added as they are created, while
+  files removed behind carbon's back are only forgotten by the next rebuild()
+  or by forget()."""
+  def __init__(self, root, extension='.wsp', threads=8):
+    self.root = root
+    self.extension = extension
+    self.threads = threads
+    self.lock = Lock()
+    self.paths = set()
+    self.ready = False
+    self.added = None # files added while a rebuild is in progress
+
+  def __len__(self):
+    return len(self.paths)
+
+  def exists(self, path):
+    if path in self.paths:
+      return True
+    if self.ready:
+      return False
+    if exists(path):
+      self.add(path)
+      return True
+    return False
+
+  def add(self, path):
+    try:
+      self.lock.acquire()
+      self.paths.add(path)
+      if self.added is not None:
+        self.added.add(path)
+    finally:
+      self.lock.release()
+
+  def forget(self, path):
+    "Drops path from the index, unless it does exist on disk"
+    if exists(path):
+      return
+    try:
+      self.lock.acquire()
+      self.paths.discard(path)
+      if self.added is not None:
+        self.added.discard(path)
+    finally:
+      self.lock.release()
+
+  def scan(self):
+    """Walks the tree under root with a pool of threads, each taking one
+    top-level directory at a time, and returns the set of files found"""
+    found = set()
+    topDirs = Queue()
+    try:
+      names = os.listdir(self.root)
+    except OSError:
+      names = []
+
+    for name in names:
+      path = join(self.root, name)
+      if isdir(path):
+        topDirs.put(path)
+      elif name.endswith(self.extension):
+        found.add(path)
+
+    def walk():
+      while True:
+        try:
+          top = topDirs.get_nowait()
+        except Empty:
+          return
+        files = []
+        for (dirpath, dirnames, filenames) in os.walk(top, followlinks=True):
+          files.extend([join(dirpath, filename) for filename in filenames
+                        if filename.endswith(self.extension)])
+        found.update(files)
+
+    threads = [Thread(target=walk) for i in range(min(self.threads, topDirs.qsize()))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return found
+
+  def rebuild(self):
+    """Replaces the index with a fresh scan of the tree, keeping the files
+    added in the meantime. Does nothing if a rebuild is already running."""
+    try:
+      self.lock.acquire()
+      if self.added is not None:
+        return
+      self.added = set()
+    finally:
+      self.lock.release()
+
+    start = time.time()
+    found = None
+    try:
+      found = self.scan()
+    finally:
+      try:
+        self.lock.acquire()
+        if found is not None:
+          found.update(self.added)
+          self.paths = found
+          self.ready = True
+        self.added = None
+      finally:
+        self.lock.release()
+
+    log.msg("Indexed %d files under %s in %.2f seconds" % (len(found), self.root, time.time() - start))
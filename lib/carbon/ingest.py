@@ -0,0 +1,293 @@
+"""Ingestion worker processes, which receive datapoints in place of the
+daemon itself when INGEST_PROCESSES is set.
+
+Each worker listens on the line, pickle, binary and UDP ports with
+SO_REUSEPORT, so the kernel spreads connections and datagrams between them,
+and parses and filters what it receives with the usual receivers. The
+datapoints are forwarded in the binary format of carbon.binary to the daemon,
+which listens on a Unix socket and passes them on to its handlers as they
+come, without parsing or filtering them again.
+
+Flow control crosses the socket as control messages: when the daemon pauses
+its receivers, it tells the workers to pause theirs, and to resume them
+later. The workers send the counts of the datapoints their filters dropped
+the other way every second, to be reported by the daemon.
+
+SO_REUSEPORT only spreads connections between sockets this way on Linux, so
+INGEST_PROCESSES is refused on other platforms.
+
+Workers are started by IngestService as fresh interpreters running
+workerMain(), with the daemon's settings pickled on their stdin, rather than
+forked from the running reactor. They are restarted when they die, and exit
+when the daemon goes away. As they start after the daemon dropped its
+privileges, the ports must not be privileged ones."""
+import os
+import sys
+import socket
+from os.path import exists
+
+from twisted.application.service import Service
+from twisted.internet import reactor, tcp, udp
+from twisted.internet.protocol import ServerFactory, ClientFactory, ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+
+from carbon.conf import settings
+from carbon.exceptions import CarbonConfigException
+from carbon.util import pickle
+from carbon.binary import encodeFrame
+from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver, MetricBinaryReceiver,
+                              MetricDatagramReceiver, metricNames)
+from carbon import log, events, state, instrumentation
+
+
+if sys.platform.startswith('linux'):
+  # Not in the socket module of Python 2
+  SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+else:
+  SO_REUSEPORT = None
+
+PAUSE = 'pause'
+RESUME = 'resume'
+# Followed by "name=count" pairs of the FORWARDED_STATS counted in a worker
+STATS = 'stats'
+FORWARDED_STATS = ('blacklistMatches', 'whitelistRejects')
+
+# Run by the workers, with the path of the daemon's socket as argument
+WORKER_SCRIPT = """
+try:
+  from twisted.internet import epollreactor
+  epollreactor.install()
+except ImportError:
+  pass
+import sys
+from carbon.ingest import workerMain
+workerMain(sys.argv[1])
+"""
+
+
+class ReusePortTCPPort(tcp.Port):
+  def createInternetSocket(self):
+    s = tcp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+class ReusePortUDPPort(udp.Port):
+  def createInternetSocket(self):
+    s = udp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+# The daemon's side
+
+class IngestCoreReceiver(MetricBinaryReceiver):
+  """Receives the datapoints a worker forwards, already filtered, and
+  relays pauses and resumes of the receivers to it"""
+  MAX_LENGTH = 2 ** 24
+
+  def getPeerName(self):
+    return 'ingest worker'
+
+  def stringReceived(self, message):
+    if message.startswith(STATS):
+      for pair in message.split()[1:]:
+        (name, count) = pair.split('=')
+        if name in FORWARDED_STATS:
+          instrumentation.increment(name, int(count))
+    else:
+      MetricBinaryReceiver.stringReceived(self, message)
+
+  def metricsReceived(self, datapoints):
+    if metricNames.maxSize:
+      datapoints = metricNames.internAll(datapoints)
+    if datapoints:
+      events.metricReceived.batch(datapoints)
+
+  def pauseReceiving(self):
+    self.sendString(PAUSE)
+    self.transport.pauseProducing()
+
+  def resumeReceiving(self):
+    self.sendString(RESUME)
+    self.transport.resumeProducing()
+
+
+class IngestWorkerProcess(ProcessProtocol):
+  def __init__(self, service, worker):
+    self.service = service
+    self.worker = worker
+    self.output = ''
+
+  def connectionMade(self):
+    self.transport.write(pickle.dumps(dict(settings), protocol=-1))
+    self.transport.closeStdin()
+    log.msg("Started ingest worker %d with pid %d" % (self.worker, self.transport.pid))
+
+  def outReceived(self, data):
+    lines = (self.output + data).split('\n')
+    self.output = lines.pop()
+    for line in lines:
+      log.msg("[ingest worker %d] %s" % (self.worker, line))
+
+  errReceived = outReceived
+
+  def processEnded(self, reason):
+    self.service.workerEnded(self.worker, reason)
+
+
+class IngestService(Service):
+  """Keeps the given number of ingestion worker processes running, and
+  listens on socketPath for the datapoints they forward"""
+  def __init__(self, processes, socketPath):
+    if SO_REUSEPORT is None:
+      raise CarbonConfigException("INGEST_PROCESSES requires the SO_REUSEPORT of Linux")
+    self.processes = processes
+    self.socketPath = socketPath
+    self.port = None
+    self.workers = {} # worker -> IngestWorkerProcess
+
+  def startService(self):
+    Service.startService(self)
+    if exists(self.socketPath):
+      os.unlink(self.socketPath)
+    factory = ServerFactory()
+    factory.protocol = IngestCoreReceiver
+    self.port = reactor.listenUNIX(self.socketPath, factory, mode=0600)
+    for worker in range(self.processes):
+      self.startWorker(worker)
+
+  def startWorker(self, worker):
+    if not self.running:
+      return
+    process = self.workers[worker] = IngestWorkerProcess(self, worker)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    reactor.spawnProcess(process, sys.executable,
+                         [sys.executable, '-c', WORKER_SCRIPT, self.socketPath],
+                         env=env)
+
+  def workerEnded(self, worker, reason):
+    del self.workers[worker]
+    if self.running:
+      log.msg("Ingest worker %d ended: %s, restarting it" % (worker, reason.getErrorMessage()))
+      reactor.callLater(1, self.startWorker, worker)
+
+  def stopService(self):
+    Service.stopService(self)
+    for process in self.workers.values():
+      try:
+        process.transport.signalProcess('TERM')
+      except Exception:
+        pass
+    if self.port is not None:
+      port, self.port = self.port, None
+      return port.stopListening()
+
+
+# The worker's side
+
+class IngestForwarder(Int32StringReceiver):
+  """Forwards the datapoints received in a worker to the daemon, those of a
+  whole reactor iteration together, and the counts of those filtered out
+  every second. Pauses and resumes the receivers as the daemon says."""
+  MAX_LENGTH = 2 ** 10
+
+  def connectionMade(self):
+    self.pending = []
+    self.flushCall = None
+    events.metricReceived.addHandler(self.metricReceived, self.metricsReceived)
+    self.statsCall = LoopingCall(self.sendStats)
+    self.statsCall.start(1, now=False)
+    self.factory.connected(self)
+
+  def metricReceived(self, metric, datapoint):
+    self.metricsReceived([(metric, datapoint)])
+
+  def metricsReceived(self, datapoints):
+    self.pending.extend(datapoints)
+    if self.flushCall is None:
+      self.flushCall = reactor.callLater(0, self.flush)
+
+  def flush(self):
+    self.flushCall = None
+    pending, self.pending = self.pending, []
+    size = settings.MAX_DATAPOINTS_PER_MESSAGE
+    for i in xrange(0, len(pending), size):
+      self.sendString(encodeFrame(pending[i:i + size]))
+
+  def sendStats(self):
+    counts = [(name, instrumentation.stats.pop(name)) for name in FORWARDED_STATS
+              if name in instrumentation.stats]
+    if counts:
+      self.sendString(' '.join([STATS] + ['%s=%d' % count for count in counts]))
+
+  def stringReceived(self, message):
+    if message == PAUSE:
+      events.pauseReceivingMetrics()
+    elif message == RESUME:
+      events.resumeReceivingMetrics()
+    else:
+      log.msg("Unknown message from the daemon: %r" % message)
+
+  def connectionLost(self, reason):
+    if self.statsCall.running:
+      self.statsCall.stop()
+    log.msg("Lost the connection to the daemon, exiting: %s" % reason.getErrorMessage())
+    if reactor.running:
+      reactor.stop()
+
+
+class IngestForwarderFactory(ClientFactory):
+  protocol = IngestForwarder
+  retries = 10
+
+  def __init__(self, socketPath):
+    self.socketPath = socketPath
+
+  def clientConnectionFailed(self, connector, reason):
+    self.retries -= 1
+    if self.retries:
+      reactor.callLater(1, connector.connect)
+    else:
+      log.msg("Could not connect to %s, exiting: %s" % (self.socketPath, reason.getErrorMessage()))
+      reactor.stop()
+
+  def connected(self, forwarder):
+    "Starts listening once datapoints can be forwarded"
+    for (interface, port, protocol) in ((settings.LINE_RECEIVER_INTERFACE,
+                                         settings.LINE_RECEIVER_PORT,
+                                         MetricLineReceiver),
+                                        (settings.PICKLE_RECEIVER_INTERFACE,
+                                         settings.PICKLE_RECEIVER_PORT,
+                                         MetricPickleReceiver),
+                                        (settings.BINARY_RECEIVER_INTERFACE,
+                                         settings.BINARY_RECEIVER_PORT,
+                                         MetricBinaryReceiver)):
+      if port:
+        factory = ServerFactory()
+        factory.protocol = protocol
+        ReusePortTCPPort(int(port), factory, interface=interface, reactor=reactor).startListening()
+
+    if settings.ENABLE_UDP_LISTENER:
+      ReusePortUDPPort(int(settings.UDP_RECEIVER_PORT), MetricDatagramReceiver(),
+                       interface=settings.UDP_RECEIVER_INTERFACE, reactor=reactor).startListening()
+
+
+def workerMain(socketPath):
+  settings.update(pickle.loads(sys.stdin.read()))
+  log.logToStdout()
+  state.events = events
+  state.instrumentation = instrumentation
+
+  if settings.USE_WHITELIST:
+    from carbon.regexlist import WhiteList, BlackList
+    WhiteList.read_from(settings["whitelist"])
+    BlackList.read_from(settings["blacklist"])
+  # The daemon interns the names it is forwarded, which arrive as new strings
+  metricNames.configure(0)
+
+  reactor.connectUNIX(socketPath, IngestForwarderFactory(socketPath))
+  reactor.run()
+
@@ -1,6 +1,7 @@
 import os
 import time
 import socket
+from threading import Lock
 from resource import getrusage, RUSAGE_SELF
 
 from twisted.application.service import Service
@@ -9,6 +10,8 @@ from carbon.conf import settings
 
 
 stats = {}
+# Guards stats, which writer threads update along with the reactor
+statsLock = Lock()
 prior_stats = {}
 HOSTNAME = socket.gethostname().replace('.','_')
 PAGESIZE = os.sysconf('SC_PAGESIZE')
@@ -26,22 +29,34 @@ lastUsageTime = time.time()
 
 def increment(stat, increase=1):
   try:
-    stats[stat] += increase
-  except KeyError:
-    stats[stat] = increase
+    statsLock.acquire()
+    try:
+      stats[stat] += increase
+    except KeyError:
+      stats[stat] = increase
+  finally:
+    statsLock.release()
 
 def max(stat, newval):
   try:
-    if stats[stat] < newval:
+    statsLock.acquire()
+    try:
+      if stats[stat] < newval:
+        stats[stat] = newval
+    except KeyError:
       stats[stat] = newval
-  except KeyError:
-    stats[stat] = newval
+  finally:
+    statsLock.release()
 
 def append(stat, value):
   try:
-    stats[stat].append(value)
-  except KeyError:
-    stats[stat] = [value]
+    statsLock.acquire()
+    try:
+      stats[stat].append(value)
+    except KeyError:
+      stats[stat] = [value]
+  finally:
+    statsLock.release()
 
 
 def getCpuUsage():
@@ -73,9 +88,13 @@ def getMemUsage():
 def recordMetrics():
   global lastUsage
   global prior_stats
-  myStats = stats.copy()
+  try:
+    statsLock.acquire()
+    myStats = stats.copy()
+    stats.clear()
+  finally:
+    statsLock.release()
   myPriorStats = {}
-  stats.clear()
 
   # cache metrics
   if settings.program == 'carbon-cache':
@@ -104,6 +123,53 @@ def recordMetrics():
     record('cache.size', cache.MetricCache.size)
     record('cache.overflow', cacheOverflow)
 
+    from carbon import writer
+    record('throttle.updates', myStats.get('throttle.updates', 0))
+    record('throttle.bytes', myStats.get('throttle.bytes', 0))
+    for name, bucket in (('updates', writer.updateBucket),
+                         ('creates', writer.createBucket),
+                         ('bytes', writer.bytesBucket)):
+      tokens = bucket.tokens
+      if tokens != float('inf'):
+        record('tokens.%s' % name, tokens)
+
+    if settings.CREATE_THREADS:
+      record('pendingCreates', len(writer.pendingCreates))
+
+    if writer.wal is not None:
+      record('wal.size', writer.wal.size)
+      record('wal.segments', len(writer.wal.segments))
+
+    # Datapoints of new metrics dropped beyond the create budget, spilled or not
+    record('spill.dropped', myStats.get('spill.dropped', 0))
+    if writer.spill is not None:
+      record('spill.replayed', myStats.get('spill.replayed', 0))
+      record('spill.size', writer.spill.size)
+      record('spill.records', len(writer.spill))
+      oldest = writer.spill.oldest()
+      if oldest is None:
+        record('spill.age', 0)
+      else:
+        record('spill.age', time.time() - oldest)
+
+    if writer.fileIndex is not None:
+      record('fileIndex.size', len(writer.fileIndex))
+
+    if writer.rateController:
+      record('updateRate', writer.rateController.rate)
+      if writer.rateController.lastP99 is not None:
+        record('p99UpdateTime', writer.rateController.lastP99)
+
+    if len(writer.writerShards) > 1:
+      for worker, shards in enumerate(writer.writerShards):
+        workerUpdateTimes = myStats.get('writer.%d.updateTimes' % worker, [])
+        if workerUpdateTimes:
+          record('writer.%d.avgUpdateTime' % worker,
+                 sum(workerUpdateTimes) / len(workerUpdateTimes))
+        record('writer.%d.updateOperations' % worker, len(workerUpdateTimes))
+        record('writer.%d.queueDepth' % worker,
+               sum([shard.size for shard in shards]))
+
   # aggregator metrics
   elif settings.program == 'carbon-aggregator':
     record = aggregator_record
@@ -127,6 +193,13 @@ def recordMetrics():
 
   # common metrics
   record('metricsReceived', myStats.get('metricsReceived', 0))
+  from carbon.protocols import metricNames
+  if metricNames.maxSize:
+    (hits, misses, bytesSaved) = metricNames.takeStats()
+    if hits or misses:
+      record('metricNames.hitRate', float(hits) / (hits + misses))
+    record('metricNames.bytesSaved', bytesSaved)
+    record('metricNames.size', len(metricNames))
   record('cpuUsage', getCpuUsage())
 
   # And here preserve count of messages received in the prior periiod
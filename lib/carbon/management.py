@@ -1,7 +1,5 @@
 import traceback
-import whisper
 from carbon import log
-from carbon.storage import getFilesystemPath
 
 
 
@@ -9,9 +7,9 @@ def getMetadata(metric, key):
   if key != 'aggregationMethod':
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
+  from carbon.writer import database
   try:
-    value = whisper.info(wsp_path)['aggregationMethod']
+    value = database.info(metric)['aggregationMethod']
     return dict(value=value)
   except:
     log.err()
@@ -22,9 +20,11 @@ def setMetadata(metric, key, value):
   if key != 'aggregationMethod':
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
+  from carbon.writer import database, invalidateMetric
   try:
-    old_value = whisper.setAggregationMethod(wsp_path, value)
+    old_value = database.set_aggregation(metric, value)
+    # Writers may have cached the former aggregation
+    invalidateMetric(metric)
     return dict(old_value=old_value, new_value=value)
   except:
     log.err()
@@ -7,7 +7,12 @@ from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
-from carbon.util import pickle, get_unpickler
+from carbon.util import pickle, get_unpickler, InternTable
+from carbon.binary import decodeFrame
+
+
+# The metric names received, configured by METRIC_NAME_INTERN_SIZE
+metricNames = InternTable()
 
 
 class MetricReceiver:
@@ -62,13 +67,80 @@ class MetricReceiver:
       return
     if int(datapoint[0]) == -1: # use current time if none given: https://github.com/graphite-project/carbon/issues/54
       datapoint = (time.time(), datapoint[1])
-    
+    if metricNames.maxSize:
+      metric = metricNames.intern(metric)
+
     events.metricReceived(metric, datapoint)
 
+  def metricsReceived(self, datapoints):
+    """Like metricReceived, for a list of (metric, datapoint) tuples passed
+    on as one batch"""
+    if BlackList or WhiteList:
+      allowed = []
+      for (metric, datapoint) in datapoints:
+        if BlackList and metric in BlackList:
+          instrumentation.increment('blacklistMatches')
+          continue
+        if WhiteList and metric not in WhiteList:
+          instrumentation.increment('whitelistRejects')
+          continue
+        allowed.append((metric, datapoint))
+      datapoints = allowed
+
+    # Filter out NaN values, and use the current time for timestamps of -1
+    now = time.time()
+    accepted = [(metric, datapoint) if not -2 < datapoint[0] <= -1 else (metric, (now, datapoint[1]))
+                for (metric, datapoint) in datapoints if datapoint[1] == datapoint[1]]
+    if metricNames.maxSize:
+      accepted = metricNames.internAll(accepted)
+    if accepted:
+      events.metricReceived.batch(accepted)
+
+
+def parseLines(lines):
+  """Parses plaintext "metric value timestamp" lines, returning a list of
+  (metric, (timestamp, value)) tuples and the number of invalid lines"""
+  try:
+    # The whole batch at once, unless a line is invalid
+    return ([(metric, (float(timestamp), float(value)))
+             for (metric, value, timestamp) in [line.split() for line in lines]], 0)
+  except ValueError:
+    pass
+
+  datapoints = []
+  invalid = 0
+  for line in lines:
+    fields = line.split()
+    if len(fields) != 3:
+      invalid += 1
+      continue
+    try:
+      datapoints.append((fields[0], (float(fields[2]), float(fields[1]))))
+    except ValueError:
+      invalid += 1
+  return (datapoints, invalid)
+
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
+  """Parses every complete line of the data received at once, and passes
+  them on as one batch. Only the incomplete line left over is held to
+  MAX_LENGTH, as longer lines are invalid anyway."""
   delimiter = '\n'
 
+  def dataReceived(self, data):
+    if self.transport.disconnecting:
+      return
+    lines = (self._buffer + data).split(self.delimiter)
+    self._buffer = lines.pop()
+    if lines:
+      (datapoints, invalid) = parseLines(lines)
+      if invalid:
+        log.listener('%d invalid lines received from client %s, ignoring' % (invalid, self.peerName))
+      if datapoints:
+        self.metricsReceived(datapoints)
+    if len(self._buffer) > self.MAX_LENGTH:
+      return self.lineLengthExceeded(self._buffer)
+
   def lineReceived(self, line):
     try:
       metric, value, timestamp = line.strip().split()
@@ -82,14 +154,11 @@ class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
   def datagramReceived(self, data, (host, port)):
-    for line in data.splitlines():
-      try:
-        metric, value, timestamp = line.strip().split()
-        datapoint = ( float(timestamp), float(value) )
-
-        self.metricReceived(metric, datapoint)
-      except:
-        log.listener('invalid line received from %s, ignoring' % host)
+    (datapoints, invalid) = parseLines(data.splitlines())
+    if invalid:
+      log.listener('%d invalid lines received from %s, ignoring' % (invalid, host))
+    if datapoints:
+      self.metricsReceived(datapoints)
 
 
 class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
@@ -106,13 +175,29 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
       log.listener('invalid pickle received from %s, ignoring' % self.peerName)
       return
 
+    batch = []
     for (metric, datapoint) in datapoints:
       try:
         datapoint = ( float(datapoint[0]), float(datapoint[1]) ) #force proper types
       except:
         continue
 
-      self.metricReceived(metric, datapoint)
+      batch.append((metric, datapoint))
+
+    self.metricsReceived(batch)
+
+
+class MetricBinaryReceiver(MetricReceiver, Int32StringReceiver):
+  MAX_LENGTH = 2 ** 20
+
+  def stringReceived(self, data):
+    try:
+      datapoints = decodeFrame(data)
+    except ValueError as e:
+      log.listener('invalid binary message received from %s, ignoring: %s' % (self.peerName, e))
+      return
+
+    self.metricsReceived(datapoints)
 
 
 class CacheManagementHandler(Int32StringReceiver):
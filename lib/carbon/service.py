@@ -12,7 +12,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
-from os.path import exists
+from os.path import exists, splitext
 
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPServer, TCPClient, UDPServer
@@ -40,11 +40,14 @@ class CarbonRootService(MultiService):
 def createBaseService(config):
     from carbon.conf import settings
     from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
-                                  MetricDatagramReceiver)
+                                  MetricBinaryReceiver, MetricDatagramReceiver,
+                                  metricNames)
 
     root_service = CarbonRootService()
     root_service.setName(settings.program)
 
+    metricNames.configure(settings.METRIC_NAME_INTERN_SIZE)
+
     use_amqp = settings.get("ENABLE_AMQP", False)
     if use_amqp:
         from carbon import amqp_listener
@@ -59,19 +62,32 @@ def createBaseService(config):
         amqp_exchange_name = settings.get("AMQP_EXCHANGE", "graphite")
 
 
-    for interface, port, protocol in ((settings.LINE_RECEIVER_INTERFACE,
-                                       settings.LINE_RECEIVER_PORT,
-                                       MetricLineReceiver),
-                                      (settings.PICKLE_RECEIVER_INTERFACE,
-                                       settings.PICKLE_RECEIVER_PORT,
-                                       MetricPickleReceiver)):
-        if port:
-            factory = ServerFactory()
-            factory.protocol = protocol
-            service = TCPServer(int(port), factory, interface=interface)
-            service.setServiceParent(root_service)
+    if settings.INGEST_PROCESSES:
+        from carbon.ingest import IngestService
+
+        socketPath = settings.INGEST_SOCKET
+        if not socketPath:
+            socketPath = splitext(settings["pidfile"])[0] + '.ingest.sock'
+        service = IngestService(int(settings.INGEST_PROCESSES), socketPath)
+        service.setServiceParent(root_service)
 
-    if settings.ENABLE_UDP_LISTENER:
+    else:
+        for interface, port, protocol in ((settings.LINE_RECEIVER_INTERFACE,
+                                           settings.LINE_RECEIVER_PORT,
+                                           MetricLineReceiver),
+                                          (settings.PICKLE_RECEIVER_INTERFACE,
+                                           settings.PICKLE_RECEIVER_PORT,
+                                           MetricPickleReceiver),
+                                          (settings.BINARY_RECEIVER_INTERFACE,
+                                           settings.BINARY_RECEIVER_PORT,
+                                           MetricBinaryReceiver)):
+            if port:
+                factory = ServerFactory()
+                factory.protocol = protocol
+                service = TCPServer(int(port), factory, interface=interface)
+                service.setServiceParent(root_service)
+
+    if settings.ENABLE_UDP_LISTENER and not settings.INGEST_PROCESSES:
         service = UDPServer(int(settings.UDP_RECEIVER_PORT),
                             MetricDatagramReceiver(),
                             interface=settings.UDP_RECEIVER_INTERFACE)
@@ -113,9 +129,24 @@ def createCacheService(config):
     from carbon.cache import MetricCache
     from carbon.conf import settings
     from carbon.protocols import CacheManagementHandler
+    from carbon.snapshot import loadCache
+    # have to import this *after* settings are defined
+    from carbon import writer
 
     # Configure application components
-    events.metricReceived.addHandler(MetricCache.store)
+    if settings.CACHE_COALESCE_DATAPOINTS:
+      resolution = writer.getStorageResolution
+    else:
+      resolution = None
+    # Every writer thread needs at least one cache shard of its own
+    MetricCache.configure(max(settings.CACHE_SHARDS, settings.WRITER_THREADS),
+                          compact=settings.CACHE_COMPACT_DATAPOINTS,
+                          resolution=resolution, wal=writer.wal)
+    # Before any listener opens
+    if writer.wal is not None:
+      writer.wal.replay(MetricCache.store)
+    loadCache(MetricCache, writer.CACHE_SNAPSHOT_PATH)
+    events.metricReceived.addHandler(MetricCache.store, MetricCache.storeBatch)
 
     root_service = createBaseService(config)
     factory = ServerFactory()
@@ -124,10 +155,7 @@ def createCacheService(config):
                         interface=settings.CACHE_QUERY_INTERFACE)
     service.setServiceParent(root_service)
 
-    # have to import this *after* settings are defined
-    from carbon.writer import WriterService
-
-    service = WriterService()
+    service = writer.WriterService()
     service.setServiceParent(root_service)
 
     if settings.USE_FLOW_CONTROL:
@@ -153,8 +181,8 @@ def createAggregatorService(config):
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(receiver.process)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    events.metricReceived.addHandler(receiver.process, receiver.processBatch)
+    events.metricGenerated.addHandler(client_manager.sendDatapoint, client_manager.sendDatapoints)
 
     RuleManager.read_from(settings["aggregation-rules"])
     if exists(settings["rewrite-rules"]):
@@ -190,8 +218,8 @@ def createRelayService(config):
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(client_manager.sendDatapoint)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    events.metricReceived.addHandler(client_manager.sendDatapoint, client_manager.sendDatapoints)
+    events.metricGenerated.addHandler(client_manager.sendDatapoint, client_manager.sendDatapoints)
     events.specialMetricReceived.addHandler(client_manager.sendHighPriorityDatapoint)
     events.specialMetricGenerated.addHandler(client_manager.sendHighPriorityDatapoint)
 
@@ -0,0 +1,123 @@
+"""Saves the MetricCache to a binary file and loads it back.
+
+A snapshot starts with a magic string and the byte order of the host that
+wrote it. Every metric follows as a header holding the length of its name and
+its number of datapoints, the name, then its timestamps and its values as
+arrays of doubles. A header with an empty name marks the end of the file, so
+a truncated snapshot is detected."""
+import os
+import sys
+import time
+import struct
+from array import array
+
+from carbon.cache import CompactDatapoints
+from carbon import log
+
+
+MAGIC = 'carbon-cache-snapshot-1'
+HEADER = struct.Struct('!LL')
+BYTE_ORDERS = { 'little' : 'l', 'big' : 'b' }
+
+
+def writeSnapshot(path, items):
+  """Writes the (metric, datapoints) items to path atomically, and returns
+  the number of datapoints written"""
+  count = 0
+  tmpPath = path + '.tmp'
+  fh = open(tmpPath, 'wb')
+  try:
+    fh.write(MAGIC + BYTE_ORDERS[sys.byteorder])
+    for (metric, datapoints) in items:
+      if isinstance(datapoints, CompactDatapoints):
+        timestamps = array('d', datapoints.timestamps)
+        values = datapoints.values
+      else:
+        datapoints = list(datapoints)
+        timestamps = array('d', [datapoint[0] for datapoint in datapoints])
+        values = array('d', [datapoint[1] for datapoint in datapoints])
+      if not values:
+        continue
+      if isinstance(metric, unicode):
+        metric = metric.encode('utf-8')
+      fh.write(HEADER.pack(len(metric), len(values)))
+      fh.write(metric)
+      timestamps.tofile(fh)
+      values.tofile(fh)
+      count += len(values)
+    fh.write(HEADER.pack(0, 0))
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    os.rename(tmpPath, path)
+  except:
+    fh.close()
+    if os.path.exists(tmpPath):
+      os.remove(tmpPath)
+    raise
+  return count
+
+
+def readSnapshot(path):
+  "Generates the (metric, datapoints) items of the snapshot at path"
+  fh = open(path, 'rb')
+  try:
+    magic = fh.read(len(MAGIC) + 1)
+    if magic[:-1] != MAGIC:
+      raise ValueError("%s is not a cache snapshot" % path)
+    swap = magic[-1] != BYTE_ORDERS[sys.byteorder]
+
+    while True:
+      header = fh.read(HEADER.size)
+      if len(header) < HEADER.size:
+        raise EOFError("%s is truncated" % path)
+      (nameLength, count) = HEADER.unpack(header)
+      if not nameLength:
+        return
+      metric = fh.read(nameLength)
+      timestamps = array('d')
+      values = array('d')
+      timestamps.fromfile(fh, count)
+      values.fromfile(fh, count)
+      if swap:
+        timestamps.byteswap()
+        values.byteswap()
+      yield (metric, zip(timestamps, values))
+  finally:
+    fh.close()
+
+
+def saveCache(cache, path):
+  """Empties cache into a snapshot at path. If the snapshot cannot be
+  written, the datapoints are put back into the cache before raising."""
+  start = time.time()
+  items = cache.popAll()
+  try:
+    count = writeSnapshot(path, items)
+  except:
+    for (metric, datapoints) in items:
+      cache.hold(metric, datapoints)
+      cache.release(metric)
+    raise
+  log.msg("Saved %d cached datapoints of %d metrics to %s in %.2f seconds" %
+          (count, len(items), path, time.time() - start))
+  return items
+
+
+def loadCache(cache, path):
+  """Restores the snapshot at path into cache, if there is one, and deletes
+  it. What can be read of a truncated snapshot is restored."""
+  if not os.path.exists(path):
+    return
+  start = time.time()
+  count, metrics = 0, 0
+  try:
+    for (metric, datapoints) in readSnapshot(path):
+      cache.restore(metric, datapoints)
+      count += len(datapoints)
+      metrics += 1
+  except (ValueError, EOFError), e:
+    log.msg("Failed to load all of the cache snapshot: %s" % e)
+  os.remove(path)
+  log.msg("Loaded %d cached datapoints of %d metrics from %s in %.2f seconds" %
+          (count, metrics, path, time.time() - start))
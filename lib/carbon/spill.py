@@ -0,0 +1,153 @@
+import os
+import time
+import errno
+import struct
+from os.path import join
+from threading import Lock
+
+from carbon.util import pickle
+from carbon import log
+
+
+class SpillQueue(object):
+  """A first in, first out queue of (metric, datapoints) records kept on disk
+  in append-only segment files, holding up to maxSize bytes.
+
+  Every record is framed by its length and the time it was spilled. Segments
+  are deleted once every record in them has been popped, and segments left
+  over by a previous process are popped first, so records survive restarts.
+  A record popped shortly before a crash may be popped again."""
+  HEADER = struct.Struct('!Ld')
+  EXTENSION = '.spill'
+
+  def __init__(self, directory, maxSize, segmentSize=16 * 1024 * 1024):
+    self.directory = directory
+    self.maxSize = maxSize
+    self.segmentSize = segmentSize
+    self.lock = Lock()
+    self.size = 0
+    self.records = 0
+    self.writer = None
+    self.reader = None
+    self.readOffset = 0
+
+    try:
+      os.makedirs(directory, 0755)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self.segments = sorted([int(name[:-len(self.EXTENSION)])
+                            for name in os.listdir(directory)
+                            if name.endswith(self.EXTENSION)])
+    for segment in self.segments:
+      (records, size) = self._count(self._path(segment))
+      self.records += records
+      self.size += size
+
+  def __len__(self):
+    return self.records
+
+  def _path(self, segment):
+    return join(self.directory, '%020d%s' % (segment, self.EXTENSION))
+
+  def _count(self, path):
+    "Returns the number and total size of the complete records in path"
+    records, offset = 0, 0
+    end = os.path.getsize(path)
+    fh = open(path, 'rb')
+    try:
+      while offset + self.HEADER.size <= end:
+        (length, spilledAt) = self.HEADER.unpack(fh.read(self.HEADER.size))
+        if offset + self.HEADER.size + length > end:
+          break
+        offset += self.HEADER.size + length
+        records += 1
+        fh.seek(offset)
+    finally:
+      fh.close()
+    return (records, offset)
+
+  def append(self, metric, datapoints):
+    """Adds a record to the queue and returns True, or returns False without
+    adding it if the queue is full"""
+    data = pickle.dumps((metric, list(datapoints)), 2)
+    record = self.HEADER.pack(len(data), time.time()) + data
+    try:
+      self.lock.acquire()
+      if self.size + len(record) > self.maxSize:
+        return False
+      # Segments of a previous process are never appended to, as they may
+      # end with a torn record
+      if self.writer is None or self.writer.tell() >= self.segmentSize:
+        if self.writer is not None:
+          self.writer.close()
+        if self.segments:
+          segment = self.segments[-1] + 1
+        else:
+          segment = 0
+        self.writer = open(self._path(segment), 'ab')
+        self.segments.append(segment)
+      self.writer.write(record)
+      self.writer.flush()
+      self.size += len(record)
+      self.records += 1
+      return True
+    finally:
+      self.lock.release()
+
+  def _readHeader(self):
+    """Returns the (length, spilledAt) header of the next record, moving on
+    to the next segment as the current one runs out, or None if there is no
+    complete record to pop"""
+    while self.segments:
+      if self.reader is None:
+        self.reader = open(self._path(self.segments[0]), 'rb')
+        self.readOffset = 0
+
+      # Seeking also clears the EOF indicator when the writer appended since
+      self.reader.seek(self.readOffset)
+      header = self.reader.read(self.HEADER.size)
+      if len(header) == self.HEADER.size:
+        (length, spilledAt) = self.HEADER.unpack(header)
+        if self.readOffset + self.HEADER.size + length <= os.fstat(self.reader.fileno()).st_size:
+          return (length, spilledAt)
+
+      if self.writer is not None and len(self.segments) == 1:
+        return None # caught up with the writer
+
+      # The segment is done with, save for a torn record a crash left behind
+      self.reader.close()
+      self.reader = None
+      os.remove(self._path(self.segments.pop(0)))
+    return None
+
+  def pop(self):
+    "Removes and returns the oldest (metric, datapoints) record, or None"
+    try:
+      self.lock.acquire()
+      while True:
+        header = self._readHeader()
+        if header is None:
+          return None
+        (length, spilledAt) = header
+        data = self.reader.read(length)
+        self.readOffset += self.HEADER.size + length
+        self.size -= self.HEADER.size + length
+        self.records -= 1
+        try:
+          return pickle.loads(data)
+        except:
+          log.msg("Skipping corrupt record in %s" % self._path(self.segments[0]))
+    finally:
+      self.lock.release()
+
+  def oldest(self):
+    "Returns the time the oldest record was spilled at, or None"
+    try:
+      self.lock.acquire()
+      header = self._readHeader()
+      if header is not None:
+        return header[1]
+    finally:
+      self.lock.release()
@@ -38,6 +38,10 @@ class Schema:
   def matches(self, metric):
     return bool( self.test(metric) )
 
+  def definition(self):
+    "Returns what decides which metrics the schema matches, and how"
+    return (self.__class__.__name__, self.name, self.archives)
+
 
 class DefaultSchema(Schema):
 
@@ -60,6 +64,9 @@ class PatternSchema(Schema):
   def test(self, metric):
     return self.regex.search(metric)
 
+  def definition(self):
+    return Schema.definition(self) + (self.pattern,)
+
 
 class ListSchema(Schema):
 
@@ -91,6 +98,9 @@ class ListSchema(Schema):
 
     return metric in self.members
 
+  def definition(self):
+    return Schema.definition(self) + (self.listName, self.mtime)
+
 
 class Archive:
 
@@ -104,6 +114,12 @@ class Archive:
   def getTuple(self):
     return (self.secondsPerPoint,self.points)
 
+  def __eq__(self, other):
+    return isinstance(other, Archive) and self.getTuple() == other.getTuple()
+
+  def __ne__(self, other):
+    return not self == other
+
   @staticmethod
   def fromString(retentionDef):
     (secondsPerPoint, points) = whisper.parseRetentionDef(retentionDef)
@@ -0,0 +1,93 @@
+import os
+import time
+from threading import Lock, Semaphore, Thread
+from Queue import Queue, Empty
+
+from carbon import log
+
+
+# os.fdatasync skips metadata that is not needed to read the data back, such
+# as modification times, but is not available everywhere
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class Syncer(object):
+  """Syncs written files to disk in batches, so that writers do not wait for
+  an fsync after every file.
+
+  Writers hand over a duplicate of the descriptor of every file they wrote.
+  Descriptors are collected until batchSize of them are pending or the oldest
+  has waited window seconds, then synced and closed by a pool of threads. At
+  most maxPending descriptors may be awaiting their sync, beyond which add()
+  blocks, so data is never left unsynced for much longer than the window."""
+  def __init__(self, batchSize, window, threads=4, maxPending=None):
+    self.batchSize = batchSize
+    self.window = window
+    self.lock = Lock()
+    self.pending = []
+    self.oldest = None
+    self.work = Queue()
+    if maxPending is None:
+      maxPending = batchSize * 4
+    self.slots = Semaphore(maxPending)
+    self.threads = [Thread(target=self.syncForever, name='carbon-syncer-%d' % i)
+                    for i in range(threads)]
+    for thread in self.threads:
+      thread.setDaemon(True)
+      thread.start()
+
+  def add(self, fd):
+    self.slots.acquire()
+    try:
+      self.lock.acquire()
+      if not self.pending:
+        self.oldest = time.time()
+      self.pending.append(fd)
+      if len(self.pending) >= self.batchSize or time.time() - self.oldest >= self.window:
+        self._submit()
+    finally:
+      self.lock.release()
+
+  def _submit(self):
+    for fd in self.pending:
+      self.work.put(fd)
+    self.pending = []
+    self.oldest = None
+
+  def submitIfDue(self):
+    try:
+      self.lock.acquire()
+      if self.oldest is not None and time.time() - self.oldest >= self.window:
+        self._submit()
+    finally:
+      self.lock.release()
+
+  def syncForever(self):
+    while True:
+      try:
+        fd = self.work.get(timeout=self.window / 2.0)
+      except Empty:
+        self.submitIfDue()
+        continue
+      if fd is None:
+        return
+      try:
+        try:
+          fdatasync(fd)
+        except OSError:
+          log.err()
+      finally:
+        os.close(fd)
+        self.slots.release()
+
+  def close(self):
+    "Syncs every pending file and stops the threads"
+    try:
+      self.lock.acquire()
+      self._submit()
+    finally:
+      self.lock.release()
+    for thread in self.threads:
+      self.work.put(None)
+    for thread in self.threads:
+      thread.join()
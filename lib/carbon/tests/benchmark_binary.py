@@ -0,0 +1,54 @@
+"""Measure encoding and decoding messages of datapoints in the binary format
+of BINARY_RECEIVER_PORT against pickle, decoded with the SafeUnpickler the
+pickle receiver uses by default and with the USE_INSECURE_UNPICKLER one,
+then receiving them with each receiver, into an event without handlers.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_binary.py
+"""
+import time
+
+from carbon import events
+from carbon.binary import encodeFrame, decodeFrame
+from carbon.util import pickle, get_unpickler
+from carbon.protocols import MetricPickleReceiver, MetricBinaryReceiver
+
+
+MESSAGES = 1000
+MESSAGE_SIZES = (10, 100, 500)
+
+
+def measure(name, function, messages, datapoints):
+  start = time.time()
+  for message in messages:
+    function(message)
+  elapsed = time.time() - start
+  print "  %-24s %6.2f us/datapoint  %9.0f datapoints/s" % (
+    name, elapsed / datapoints * 1e6, datapoints / elapsed)
+
+
+def main():
+  now = time.time()
+  safe = get_unpickler()
+  events.metricReceived.handlers = []
+  pickleReceiver = MetricPickleReceiver()
+  pickleReceiver.unpickler = safe
+  binaryReceiver = MetricBinaryReceiver()
+  insecure = get_unpickler(insecure=True)
+  for size in MESSAGE_SIZES:
+    batches = [[('carbon.bench.host%d.metric%d' % (i % 100, (i * size + j) % 10000), (now, float(j)))
+                for j in range(size)] for i in range(MESSAGES)]
+    pickles = [pickle.dumps(batch, protocol=-1) for batch in batches]
+    frames = [encodeFrame(batch) for batch in batches]
+    print "%d datapoints per message, pickles of %d bytes, binary of %d bytes:" % (
+      size, len(pickles[0]), len(frames[0]))
+    measure('pickle.dumps', lambda batch: pickle.dumps(batch, protocol=-1), batches, size * MESSAGES)
+    measure('encodeFrame', encodeFrame, batches, size * MESSAGES)
+    measure('SafeUnpickler.loads', safe.loads, pickles, size * MESSAGES)
+    measure('insecure unpickler loads', insecure.loads, pickles, size * MESSAGES)
+    measure('decodeFrame', decodeFrame, frames, size * MESSAGES)
+    measure('MetricPickleReceiver', pickleReceiver.stringReceived, pickles, size * MESSAGES)
+    measure('MetricBinaryReceiver', binaryReceiver.stringReceived, frames, size * MESSAGES)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,82 @@
+"""Measure how much the writer thread stalls stores into the MetricCache.
+
+One thread stores datapoints the way the reactor does, while another
+pops the fullest queues the way carbon.writer does. A single shard
+behaves exactly like the former single-lock cache.
+
+It also compares draining the cache in write order through the length
+index against the former snapshot and sort of every queue.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_cache.py
+"""
+import time
+from threading import Thread
+
+from carbon.cache import MetricCache
+
+
+METRICS = 100000
+POINTS = 1000000
+SHARD_COUNTS = (1, 4, 16, 64)
+
+
+def writer(cache, done):
+  while not done:
+    cache.popFullest()
+
+
+def benchmark(shards):
+  cache = MetricCache.__class__(shards)
+  metrics = ['carbon.bench.metric%d' % i for i in range(METRICS)]
+  for metric in metrics:
+    cache.store(metric, (0, 0.0))
+
+  done = []
+  thread = Thread(target=writer, args=(cache, done))
+  thread.start()
+
+  stalls = []
+  start = time.time()
+  for i in xrange(POINTS):
+    t = time.time()
+    cache.store(metrics[i % METRICS], (i, float(i)))
+    stalls.append(time.time() - t)
+  elapsed = time.time() - start
+
+  done.append(True)
+  thread.join()
+
+  stalls.sort()
+  print "%4d shards: %9.0f stores/s  p99 %8.2f us  p99.9 %8.2f us  max %8.2f ms" % (
+    shards, POINTS / elapsed, stalls[int(POINTS * 0.99)] * 1e6,
+    stalls[int(POINTS * 0.999)] * 1e6, stalls[-1] * 1e3)
+
+
+def fill(cache):
+  for i in xrange(METRICS):
+    for j in xrange(i % 10 + 1):
+      cache.store('carbon.bench.metric%d' % i, (j, float(j)))
+
+
+def benchmark_write_order():
+  cache = MetricCache.__class__()
+
+  fill(cache)
+  start = time.time()
+  metrics = cache.counts()
+  metrics.sort(key=lambda item: item[1], reverse=True)
+  for metric, queueSize in metrics:
+    cache.pop(metric)
+  print "snapshot and sort: drained %d queues in %.3f s" % (METRICS, time.time() - start)
+
+  fill(cache)
+  start = time.time()
+  while cache.popFullest() is not None:
+    pass
+  print "length index:      drained %d queues in %.3f s" % (METRICS, time.time() - start)
+
+
+if __name__ == '__main__':
+  for shards in SHARD_COUNTS:
+    benchmark(shards)
+  benchmark_write_order()
@@ -0,0 +1,41 @@
+"""Measure the memory cost of each datapoint held in the MetricCache.
+
+Every mode runs in a forked child so that memory freed by one run does not
+hide the cost of the next one.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_cache_memory.py
+"""
+import os
+import time
+
+from carbon.cache import MetricCache
+from carbon.instrumentation import getMemUsage
+
+
+METRICS = 10000
+POINTS_PER_METRIC = (1, 10, 100)
+
+
+def measure(compact, pointsPerMetric):
+  cache = MetricCache.__class__(compact=compact)
+  metrics = ['carbon.bench.metric%d' % i for i in range(METRICS)]
+  now = int(time.time())
+
+  before = getMemUsage()
+  for i in xrange(pointsPerMetric):
+    for metric in metrics:
+      cache.store(metric, (now + i, float(i) / 3))
+  after = getMemUsage()
+
+  print "compact=%-5s %4d points/metric: %6.1f bytes per cached point" % (
+    compact, pointsPerMetric, float(after - before) / cache.size)
+
+
+if __name__ == '__main__':
+  for pointsPerMetric in POINTS_PER_METRIC:
+    for compact in (False, True):
+      pid = os.fork()
+      if pid == 0:
+        measure(compact, pointsPerMetric)
+        os._exit(0)
+      os.waitpid(pid, 0)
@@ -0,0 +1,85 @@
+"""Check that a database behaves as carbon expects, then measure how fast it
+creates metrics and writes datapoints to them, one at a time as when the
+cache keeps up and in batches as when it lags behind.
+
+The database is given as for the DATABASE setting, followed by any other
+settings for it.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_database.py \\
+         [DATABASE] [SETTING=value ...]
+"""
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from carbon.conf import Settings
+from carbon.database import loadDatabase
+from carbon.tests.test_database import DatabaseConformance
+
+
+METRICS = 5000
+ROUNDS = 5
+BATCH_SIZE = 100
+RETENTIONS = [(10, 8640), (60, 10080), (600, 52560)]
+
+
+def parseSettings(args):
+  databaseSettings = {}
+  if args and '=' not in args[0]:
+    databaseSettings['DATABASE'] = args.pop(0)
+  for arg in args:
+    (key, value) = arg.split('=', 1)
+    databaseSettings[key] = eval(value)
+  return databaseSettings
+
+
+def conformance(databaseSettings):
+  class Conformance(DatabaseConformance, unittest.TestCase):
+    pass
+  Conformance.databaseSettings = databaseSettings
+  suite = unittest.defaultTestLoader.loadTestsFromTestCase(Conformance)
+  return unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
+
+
+def report(name, count, elapsed, unit):
+  print "%-24s %9.0f %s/s" % (name, count / elapsed, unit)
+
+
+def throughput(databaseSettings):
+  directory = tempfile.mkdtemp()
+  settings = Settings()
+  settings.update(databaseSettings)
+  settings['LOCAL_DATA_DIR'] = directory
+  db = loadDatabase(settings)
+  db.open()
+  try:
+    metrics = ['carbon.bench.%d.metric%d' % (i % 100, i) for i in range(METRICS)]
+    now = int(time.time())
+
+    start = time.time()
+    for metric in metrics:
+      db.create(metric, RETENTIONS)
+    report("creates", METRICS, time.time() - start, "metrics")
+
+    start = time.time()
+    for i in range(ROUNDS):
+      for metric in metrics:
+        db.update_many(metric, [(now + i * 10, float(i))])
+    report("single point updates", METRICS * ROUNDS, time.time() - start, "updates")
+
+    start = time.time()
+    for metric in metrics:
+      db.update_many(metric, [(now - i * 10, float(i)) for i in range(BATCH_SIZE)])
+    report("%d point updates" % BATCH_SIZE, METRICS * BATCH_SIZE, time.time() - start, "points")
+  finally:
+    db.close()
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  databaseSettings = parseSettings(sys.argv[1:])
+  if not conformance(databaseSettings):
+    sys.exit(1)
+  throughput(databaseSettings)
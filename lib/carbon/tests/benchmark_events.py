@@ -0,0 +1,88 @@
+"""Measure the cost per datapoint of passing received datapoints on one at a
+time through the metricReceived event, against passing whole batches of
+them, as a pickle receiver gets them, with metricReceived.batch().
+
+Each path is measured the way a daemon sets it up: into the MetricCache for
+carbon-cache, into the send queues of the destinations for carbon-relay, and
+through the aggregation rules for carbon-aggregator.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_events.py
+"""
+import time
+
+from carbon.conf import settings
+from carbon import events, instrumentation, state
+from carbon.cache import MetricCache
+from carbon.client import CarbonClientManager
+from carbon.routers import ConsistentHashingRouter
+from carbon.aggregator import receiver
+from carbon.protocols import MetricPickleReceiver
+
+
+METRICS = 10000
+BATCH_SIZE = 500
+POINTS = 500000
+DESTINATIONS = [('127.0.0.1', 2104, 'a'), ('127.0.0.1', 2204, 'b'), ('127.0.0.1', 2304, 'c')]
+
+
+def batches():
+  now = int(time.time())
+  batch = []
+  for i in xrange(POINTS):
+    batch.append(('carbon.bench.host%d.metric%d' % (i % 100, i % METRICS), (now, float(i))))
+    if len(batch) == BATCH_SIZE:
+      yield batch
+      batch = []
+
+
+def measure(name, handler, batchHandler, event, reset):
+  protocol = MetricPickleReceiver()
+  data = list(batches())
+  event.addHandler(handler, batchHandler)
+  try:
+    for batched in (False, True):
+      reset()
+      elapsed = 0.0
+      for batch in data:
+        start = time.time()
+        if batched:
+          protocol.metricsReceived(batch)
+        else:
+          for (metric, datapoint) in batch:
+            protocol.metricReceived(metric, datapoint)
+        elapsed += time.time() - start
+        reset()
+      print "%-12s %-9s %6.2f us/datapoint  %9.0f datapoints/s" % (
+        name, batched and 'batches' or 'points', elapsed / POINTS * 1e6, POINTS / elapsed)
+  finally:
+    event.removeHandler(handler)
+
+
+def resetCache():
+  MetricCache.popAll()
+
+
+def main():
+  state.instrumentation = instrumentation
+  settings['MAX_CACHE_SIZE'] = float('inf')
+  MetricCache.configure(4)
+  measure('cache', MetricCache.store, MetricCache.storeBatch,
+          events.metricReceived, resetCache)
+
+  manager = CarbonClientManager(ConsistentHashingRouter())
+  for destination in DESTINATIONS:
+    manager.startClient(destination)
+  def resetQueues():
+    for factory in manager.client_factories.values():
+      factory.queue.clear()
+  measure('relay', manager.sendDatapoint, manager.sendDatapoints,
+          events.metricReceived, resetQueues)
+
+  # Metrics matching no rule are passed on to the destinations
+  events.metricGenerated.addHandler(manager.sendDatapoint, manager.sendDatapoints)
+  measure('aggregator', receiver.process, receiver.processBatch,
+          events.metricReceived, resetQueues)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+"""Measure how fast plaintext lines are received, parsing the whole chunk of
+data received at once with parseLines() against the former line by line
+lineReceived() of every line, for well-formed input and for input with some
+or only malformed lines.
+
+Datapoints are received into an event without handlers, so only the
+protocol is measured.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_lines.py
+"""
+import time
+
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.test.proto_helpers import StringTransport
+
+from carbon import events, log
+from carbon.protocols import MetricLineReceiver, parseLines
+
+
+LINES = 300000
+CHUNK_SIZE = 65536
+MALFORMED = (0, 0.01, 1)
+
+
+def makeChunks(malformed):
+  now = int(time.time())
+  lines = []
+  for i in xrange(LINES):
+    if malformed and i % int(1 / malformed) == 0:
+      lines.append('carbon.bench.host%d.metric%d %d\n' % (i % 100, i % 10000, i))
+    else:
+      lines.append('carbon.bench.host%d.metric%d %d.5 %d\n' % (i % 100, i % 10000, i, now))
+  data = ''.join(lines)
+  return [data[i:i + CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)]
+
+
+def measure(name, receive, chunks):
+  protocol = MetricLineReceiver()
+  protocol.peerName = 'bench'
+  protocol.transport = StringTransport()
+  start = time.time()
+  for chunk in chunks:
+    receive(protocol, chunk)
+  elapsed = time.time() - start
+  print "  %-16s %6.2f us/line  %9.0f lines/s" % (name, elapsed / LINES * 1e6, LINES / elapsed)
+
+
+def parseOnly(protocol, chunk):
+  lines = (protocol._buffer + chunk).split('\n')
+  protocol._buffer = lines.pop()
+  parseLines(lines)
+
+
+def main():
+  # Keep the logging of malformed lines out of the measure
+  log.listener = lambda message: None
+  events.metricReceived.handlers = []
+  for malformed in MALFORMED:
+    print "%d%% malformed lines:" % (malformed * 100)
+    chunks = makeChunks(malformed)
+    measure('lineReceived', LineOnlyReceiver.dataReceived, chunks)
+    measure('dataReceived', MetricLineReceiver.dataReceived, chunks)
+    measure('parseLines only', parseOnly, chunks)
+
+
+if __name__ == '__main__':
+  main()
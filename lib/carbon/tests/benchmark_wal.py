@@ -0,0 +1,48 @@
+"""Measure what the write-ahead log costs the MetricCache.
+
+Stores go through the cache with and without a log, and the buffered
+datapoints are then flushed to a segment, with and without an fsync.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_wal.py
+"""
+import time
+import shutil
+import tempfile
+
+from carbon.cache import MetricCache
+from carbon.wal import WriteAheadLog
+
+
+METRICS = 100000
+POINTS = 1000000
+
+
+def benchmark(wal):
+  cache = MetricCache.__class__(4, wal=wal)
+  metrics = ['carbon.bench.metric%d' % i for i in range(METRICS)]
+
+  start = time.time()
+  for i in xrange(POINTS):
+    cache.store(metrics[i % METRICS], (i, float(i)))
+  elapsed = time.time() - start
+
+  if wal is None:
+    print "no log:           %9.0f stores/s" % (POINTS / elapsed)
+    return
+
+  flushStart = time.time()
+  wal.flush()
+  flushElapsed = time.time() - flushStart
+  print "log, fsync=%-5s  %9.0f stores/s, flushed %9.0f datapoints/s (%.1f MB)" % (
+    wal.fsyncInterval >= 0, POINTS / elapsed, POINTS / flushElapsed,
+    wal.size / 1024.0 / 1024.0)
+
+
+if __name__ == '__main__':
+  benchmark(None)
+  for fsyncInterval in (-1, 0):
+    directory = tempfile.mkdtemp()
+    try:
+      benchmark(WriteAheadLog(directory, fsyncInterval=fsyncInterval))
+    finally:
+      shutil.rmtree(directory)
@@ -0,0 +1,81 @@
+"""Compare updating whisper files with multiple archives through stock
+whisper, through a FileCache and through a MappedFileCache.
+
+Every round writes one new datapoint to each file, so each update also
+propagates into the lower precision archives. Backfills then write batches
+of consecutive datapoints to each file, as when the cache holds many for
+each metric, with and without NumPy.
+
+Usage: PYTHONPATH=lib python lib/carbon/tests/benchmark_whispermap.py
+"""
+import os
+import time
+import shutil
+import tempfile
+
+import whisper
+
+from carbon.filecache import FileCache
+from carbon import whispermap
+from carbon.whispermap import MappedFileCache
+
+
+FILES = 2000
+ROUNDS = 10
+BACKFILL_FILES = 100
+BACKFILL_SIZES = (8, 32, 128, 512)
+SCHEMAS = {
+  '10s:1d,1m:7d,10m:1y' : [(10, 8640), (60, 10080), (600, 52560)],
+  '10s:6h,1m:1d,5m:7d,1h:1y,1d:5y' : [(10, 2160), (60, 1440), (300, 2016), (3600, 8760), (86400, 1825)],
+}
+
+
+def benchmark(name, update, paths):
+  start = time.time()
+  now = int(start)
+  for i in xrange(ROUNDS):
+    for path in paths:
+      update(path, [(now + i * 10, float(i))])
+  elapsed = time.time() - start
+  print "  %-12s %9.0f updates/s" % (name, ROUNDS * len(paths) / elapsed)
+
+
+def backfill(name, update, paths, size):
+  now = int(time.time())
+  points = [(now - i * 10, float(i)) for i in range(size)]
+  start = time.time()
+  for path in paths:
+    update(path, points)
+  elapsed = time.time() - start
+  print "  %-12s %4d points %9.0f points/s" % (name, size, size * len(paths) / elapsed)
+
+
+if __name__ == '__main__':
+  for (schema, archives) in sorted(SCHEMAS.items()):
+    print schema
+    directory = tempfile.mkdtemp()
+    try:
+      paths = [os.path.join(directory, '%d.wsp' % i) for i in range(FILES)]
+      for path in paths:
+        whisper.create(path, archives)
+
+      benchmark('whisper', whisper.update_many, paths)
+      whisper.CACHE_HEADERS = True
+      for (name, cache) in [('FileCache', FileCache(FILES)), ('mmap', MappedFileCache(FILES))]:
+        benchmark(name, cache.update, paths)
+        cache.close()
+      whisper.CACHE_HEADERS = False
+
+      # Every archive update is vectorized, to measure where it pays off
+      whispermap.VectorizedWhisperFile.minPoints = 1
+      caches = [('mmap', MappedFileCache(FILES))]
+      if whispermap.numpy is not None:
+        caches.append(('mmap+numpy', MappedFileCache(FILES, vectorize=True)))
+      for size in BACKFILL_SIZES:
+        backfill('whisper', whisper.update_many, paths[:BACKFILL_FILES], size)
+        for (name, cache) in caches:
+          backfill(name, cache.update, paths[:BACKFILL_FILES], size)
+      for (name, cache) in caches:
+        cache.close()
+    finally:
+      shutil.rmtree(directory)
@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from carbon.binary import encodeFrame, decodeFrame, HEADER
+
+
+class BinaryFrameTest(TestCase):
+
+    def test_round_trip(self):
+        datapoints = [("foo", (1.0, 2.5)), ("bar", (2.0, -1.0)), ("foo", (3.0, 1e300))]
+        self.assertEqual(datapoints, decodeFrame(encodeFrame(datapoints)))
+
+    def test_empty(self):
+        self.assertEqual([], decodeFrame(encodeFrame([])))
+
+    def test_names_are_shared(self):
+        one = len(encodeFrame([("carbon.test.metric", (1.0, 1.0))]))
+        two = len(encodeFrame([("carbon.test.metric", (1.0, 1.0))] * 2))
+        self.assertEqual(one + 20, two)
+
+    def test_unicode_names(self):
+        datapoints = [(u"caf\xe9", (1.0, 1.0))]
+        self.assertEqual([(u"caf\xe9".encode('utf-8'), (1.0, 1.0))],
+                         decodeFrame(encodeFrame(datapoints)))
+
+    def test_newlines_are_left_out(self):
+        datapoints = [("foo\nbar", (1.0, 1.0)), ("foo", (2.0, 2.0))]
+        self.assertEqual([("foo", (2.0, 2.0))], decodeFrame(encodeFrame(datapoints)))
+
+    def test_invalid_frames(self):
+        frame = encodeFrame([("foo", (1.0, 2.5)), ("bar", (2.0, -1.0))])
+        self.assertRaises(ValueError, decodeFrame, frame[:-1])
+        self.assertRaises(ValueError, decodeFrame, frame[:HEADER.size - 1])
+        self.assertRaises(ValueError, decodeFrame, '\x02' + frame[1:])
+        # A name index past the name table
+        self.assertRaises(ValueError, decodeFrame,
+                          frame[:HEADER.size + 7] + '\x05' + frame[HEADER.size + 8:])
@@ -0,0 +1,211 @@
+from unittest import TestCase
+from carbon.cache import MetricCache
+from carbon import log
+
+
+class MetricCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = MetricCache.__class__(shards=4)
+
+    def test_store_and_pop(self):
+        """Datapoints are popped in the order they were stored."""
+        self.cache.store("foo", (1, 1.0))
+        self.cache.store("foo", (2, 2.0))
+        self.assertEqual(2, self.cache.size)
+        self.assertEqual([(1, 1.0), (2, 2.0)], self.cache.pop("foo"))
+        self.assertEqual(0, self.cache.size)
+        self.assertFalse(self.cache)
+
+    def test_store_batch(self):
+        """A batch is stored like its datapoints one at a time."""
+        batch = [("metric.%d" % (i % 7), (i, float(i))) for i in range(50)]
+        self.cache.storeBatch(batch)
+        for (metric, datapoint) in batch:
+            self.cache.store(metric + ".single", datapoint)
+        self.assertEqual(100, self.cache.size)
+        for i in range(7):
+            self.assertEqual(self.cache.pop("metric.%d.single" % i),
+                             self.cache.pop("metric.%d" % i))
+        self.assertFalse(self.cache)
+
+    def test_store_batch_skips_failing_datapoint(self):
+        """A datapoint that cannot be stored costs only itself."""
+        steps = {"a": 10, "b": 10}
+        self.cache.configure(1, resolution=lambda metric: steps[metric])
+        errors = []
+        err, log.err = log.err, lambda *args: errors.append(args)
+        try:
+            self.cache.storeBatch([("a", (1, 1.0)), ("noschema", (1, 1.0)),
+                                   ("b", (1, 1.0))])
+        finally:
+            log.err = err
+        self.assertEqual(1, len(errors))
+        self.assertEqual([(0, 1.0)], self.cache.get("a"))
+        self.assertEqual([(0, 1.0)], self.cache.get("b"))
+        self.assertFalse("noschema" in self.cache)
+        self.assertEqual(2, self.cache.size)
+
+    def test_pop_missing_metric(self):
+        """Popping an unknown metric raises a KeyError."""
+        self.assertRaises(KeyError, self.cache.pop, "foo")
+
+    def test_counts_span_all_shards(self):
+        """C{counts} reports every queue, whichever shard it lives in."""
+        for i in range(20):
+            for j in range(i + 1):
+                self.cache.store("metric.%d" % i, (j, float(j)))
+        counts = dict(self.cache.counts())
+        self.assertEqual(20, len(counts))
+        self.assertEqual(20, len(self.cache))
+        self.assertEqual(sum(range(1, 21)), self.cache.size)
+        self.assertEqual(7, counts["metric.6"])
+
+    def test_pop_fullest(self):
+        """Queues are popped longest first, across all shards."""
+        for i in range(20):
+            for j in range(i + 1):
+                self.cache.store("metric.%d" % i, (j, float(j)))
+        popped = []
+        while self.cache:
+            metric, datapoints = self.cache.popFullest()
+            popped.append(len(datapoints))
+        self.assertEqual(range(20, 0, -1), popped)
+        self.assertEqual(None, self.cache.popFullest())
+        self.assertEqual(0, self.cache.size)
+
+    def test_pop_fullest_after_pop(self):
+        """Popping a queue by name keeps the length index consistent."""
+        for j in range(5):
+            self.cache.store("big", (j, float(j)))
+        self.cache.store("small", (1, 1.0))
+        self.cache.pop("big")
+        self.assertEqual(("small", [(1, 1.0)]), self.cache.popFullest())
+        self.assertEqual(None, self.cache.popFullest())
+
+    def test_partition(self):
+        """Partitions are disjoint and each only pops its own metrics."""
+        for i in range(20):
+            self.cache.store("metric.%d" % i, (i, float(i)))
+        partitions = self.cache.partition(3)
+        self.assertEqual(3, len(partitions))
+        self.assertEqual(sorted(self.cache.shards, key=id),
+                         sorted(sum(partitions, []), key=id))
+        popped = set()
+        for shards in partitions:
+            while True:
+                result = self.cache.popFullest(shards)
+                if result is None:
+                    break
+                popped.add(result[0])
+        self.assertEqual(20, len(popped))
+        self.assertFalse(self.cache)
+
+    def test_get(self):
+        """C{get} returns the queue without removing it."""
+        self.cache.store("foo", (1, 1.0))
+        self.assertEqual([(1, 1.0)], self.cache.get("foo"))
+        self.assertEqual([], self.cache.get("bar", []))
+        self.assertTrue("foo" in self.cache)
+
+    def test_compact_datapoints(self):
+        """Compact queues come back out as lists of datapoint tuples."""
+        self.cache.configure(4, compact=True)
+        self.cache.store("foo", (1.5, 1.0))
+        self.cache.store("foo", (2, 2))
+        self.assertEqual([(1, 1.0), (2, 2.0)], self.cache.get("foo"))
+        self.assertEqual(("foo", [(1, 1.0), (2, 2.0)]),
+                         self.cache.popFullest())
+        self.cache.store("bar", (3, 3.0))
+        self.assertEqual([(3, 3.0)], self.cache.pop("bar"))
+
+    def test_compact_rejects_out_of_range_datapoints(self):
+        """A rejected datapoint leaves no trace in the cache, and costs only
+        itself in a batch."""
+        self.cache.configure(4, compact=True)
+        for datapoint in [(-1, 1.0), (2 ** 40, 1.0), (float('inf'), 1.0), (1, 10 ** 400)]:
+            self.cache.store("foo", datapoint)
+        self.assertFalse(self.cache)
+        self.assertEqual(0, self.cache.size)
+        self.assertEqual(None, self.cache.popFullest())
+
+        self.cache.storeBatch([("foo", (1, 1.0)), ("foo", (-1, 2.0)), ("foo", (3, 3.0))])
+        self.assertEqual([(1, 1.0), (3, 3.0)], self.cache.get("foo"))
+        self.assertEqual(2, self.cache.size)
+
+    def test_coalesced_datapoints(self):
+        """The last value stored for a timestamp slot wins."""
+        steps = {"foo": 10, "bar": 60}
+        self.cache.configure(4, resolution=steps.get)
+        self.cache.store("foo", (101, 1.0))
+        self.cache.store("foo", (109, 2.0))
+        self.cache.store("foo", (90, 3.0))
+        self.cache.store("bar", (130, 4.0))
+        self.cache.store("bar", (125, 5.0))
+        self.assertEqual(3, self.cache.size)
+        self.assertEqual([(90, 3.0), (100, 2.0)], self.cache.get("foo"))
+        self.assertEqual(("foo", [(90, 3.0), (100, 2.0)]),
+                         self.cache.popFullest())
+        self.assertEqual([(120, 5.0)], self.cache.pop("bar"))
+        self.assertEqual(0, self.cache.size)
+
+    def test_coalesced_datapoints_without_resolution(self):
+        """Metrics with no known resolution are coalesced per second."""
+        self.cache.configure(4, resolution={}.get)
+        self.cache.store("foo", (1.5, 1.0))
+        self.cache.store("foo", (1, 2.0))
+        self.cache.store("foo", (2, 3.0))
+        self.assertEqual([(1, 2.0), (2, 3.0)], self.cache.pop("foo"))
+
+    def test_hold_and_release(self):
+        """Held queues keep growing but are only popped once released."""
+        self.cache.store("foo", (1, 1.0))
+        self.cache.store("foo", (2, 2.0))
+        self.cache.store("bar", (1, 1.0))
+        metric, datapoints = self.cache.popFullest()
+        self.cache.store("foo", (3, 3.0))
+        self.cache.hold(metric, datapoints)
+        self.cache.store("foo", (4, 4.0))
+        self.assertEqual(5, self.cache.size)
+        self.assertEqual([(1, 1.0), (2, 2.0), (3, 3.0), (4, 4.0)],
+                         self.cache.get("foo"))
+        self.assertEqual("bar", self.cache.popFullest()[0])
+        self.assertEqual(None, self.cache.popFullest())
+        self.cache.release("foo")
+        self.assertEqual(("foo", [(1, 1.0), (2, 2.0), (3, 3.0), (4, 4.0)]),
+                         self.cache.popFullest())
+        self.assertEqual(0, self.cache.size)
+
+    def test_pop_held_metric(self):
+        self.cache.store("foo", (1, 1.0))
+        self.cache.hold(*self.cache.popFullest())
+        self.assertEqual([(1, 1.0)], self.cache.pop("foo"))
+        self.cache.release("foo")
+        self.assertFalse(self.cache)
+        self.assertEqual(None, self.cache.popFullest())
+
+    def test_restore_and_pop_all(self):
+        """Restored datapoints come before those already cached."""
+        self.cache.store("foo", (3, 3.0))
+        self.cache.restore("foo", [(1, 1.0), (2, 2.0)])
+        self.cache.restore("bar", [(1, 1.0)])
+        self.assertEqual(4, self.cache.size)
+        self.assertEqual([(1, 1.0), (2, 2.0), (3, 3.0)], self.cache.get("foo"))
+        items = dict((metric, list(queue))
+                     for (metric, queue) in self.cache.popAll())
+        self.assertEqual({"foo": [(1, 1.0), (2, 2.0), (3, 3.0)],
+                          "bar": [(1, 1.0)]}, items)
+        self.assertEqual(0, self.cache.size)
+        self.assertEqual(None, self.cache.popFullest())
+
+    def test_configure_rejects_non_empty_cache(self):
+        """Resharding would lose track of queued datapoints."""
+        self.cache.store("foo", (1, 1.0))
+        self.assertRaises(RuntimeError, self.cache.configure, 8)
+
+    def test_configure_requires_a_shard(self):
+        self.assertRaises(ValueError, self.cache.configure, 0)
+
+    def test_setitem_is_disallowed(self):
+        shard = self.cache.getShard("foo")
+        self.assertRaises(TypeError, shard.__setitem__, "foo", [])
@@ -0,0 +1,138 @@
+import os
+import random
+from unittest import TestCase
+
+from carbon.conf import Settings
+from carbon.database import loadDatabase
+from carbon.chunks import encodePoints, decodePoints, bitLength, ChunkDatabase
+from carbon.tests.test_database import DatabaseConformance
+
+
+class CodecTest(TestCase):
+
+    def assertRoundTrip(self, points):
+        self.assertEqual(points, decodePoints(encodePoints(points), len(points)))
+
+    def test_single_point(self):
+        self.assertRoundTrip([(1400000000, 1.5)])
+
+    def test_regular_series(self):
+        points = [(1400000000 + i * 60, 42.0) for i in range(1000)]
+        self.assertRoundTrip(points)
+        # Past the first two points, a bit per timestamp and one per value
+        self.assertTrue(len(encodePoints(points)) <= 12 + 2 + 1000 / 4)
+
+    def test_irregular_series(self):
+        rand = random.Random(42)
+        timestamp = 1400000000
+        points = []
+        for i in range(2000):
+            timestamp += rand.choice([1, 10, 60, 61, 300, 5000, 100000, 10 ** 8])
+            points.append((timestamp, rand.choice([0.0, -1.0, 1e300, rand.random(),
+                                                   rand.randint(0, 100) * 1.0])))
+        self.assertRoundTrip(points)
+
+    def test_bit_length(self):
+        for x in (0, 1, 2, 255, 256, (1 << 64) - 1, 1 << 63):
+            self.assertEqual(len(bin(x).lstrip('0b')), bitLength(x))
+
+
+class ChunkDatabaseTest(DatabaseConformance, TestCase):
+    databaseSettings = {'DATABASE' : 'chunks', 'CHUNK_DURATION' : 600}
+    retentions = [(60, 60), (300, 24)]
+
+    def reopen(self):
+        self.db.close()
+        self.db = loadDatabase(self.db.settings)
+        self.db.open()
+
+    def test_is_chunks(self):
+        self.assertTrue(isinstance(self.db, ChunkDatabase))
+
+    def test_writer_processes_are_refused(self):
+        settings = Settings()
+        settings.update(self.databaseSettings)
+        settings['USE_WRITER_PROCESSES'] = True
+        self.assertRaises(ValueError, loadDatabase, settings)
+
+    def test_metric_name_too_long(self):
+        self.assertRaises(ValueError, self.db.create, "a" * 65536, self.retentions)
+        self.assertFalse(self.db.exists("a" * 65536))
+        self.db.create("a" * 65535, self.retentions)
+
+    def test_reopen(self):
+        self.db.create("carbon.test.metric", self.retentions, 0.5, 'sum')
+        self.db.update_many("carbon.test.metric", [(self.now - 120, 2.0)])
+        self.db.set_aggregation("carbon.test.metric", 'max')
+        self.reopen()
+        self.assertTrue(self.db.exists("carbon.test.metric"))
+        self.assertEqual('max', self.db.info("carbon.test.metric")['aggregationMethod'])
+        self.assertEqual(2.0, self.fetchValues("carbon.test.metric")[self.now - 120])
+
+    def test_torn_frame_is_truncated(self):
+        self.db.create("carbon.test.metric", self.retentions)
+        self.db.update_many("carbon.test.metric", [(self.now - 120, 2.0)])
+        self.db.update_many("carbon.test.metric", [(self.now - 60, 3.0)])
+        self.db.close()
+        (partition,) = self.db.partitions[(60, 60)].values()
+        with open(partition.path, 'r+b') as fh:
+            fh.truncate(partition.size - 1)
+        self.reopen()
+        values = self.fetchValues("carbon.test.metric")
+        self.assertEqual(2.0, values[self.now - 120])
+        self.assertEqual(None, values[self.now - 60])
+
+    def test_compact(self):
+        for i in range(3):
+            metric = "carbon.test.metric%d" % i
+            self.db.create(metric, self.retentions)
+            for age in (540, 480, 420, 360, 300):
+                self.db.update_many(metric, [(self.now - age, float(age + i))])
+        self.db.update_many("carbon.test.metric0", [(self.now - 480, 1.0)])
+
+        self.db.compact(now=self.now + 1200)
+        start = (self.now - 540) // 600 * 600
+        partition = self.db.partitions[(60, 60)][start]
+        self.assertEqual(partition.size, partition.indexedEnd)
+        self.assertEqual([1] * 3, [len(frames) for frames in partition.frames.values()])
+
+        self.db.update_many("carbon.test.metric1", [(self.now - 540, 2.0)])
+        self.reopen()
+        values = self.fetchValues("carbon.test.metric0")
+        self.assertEqual(1.0, values[self.now - 480])
+        self.assertEqual(420.0, values[self.now - 420])
+        self.assertEqual(2.0, self.fetchValues("carbon.test.metric1")[self.now - 540])
+
+    def test_coarser_archive_is_aggregated(self):
+        """Datapoints are aggregated into the coarser archive as they are
+        read until they are compacted, then read from it."""
+        self.db.create("carbon.test.metric", self.retentions, 0.5, 'sum')
+        self.db.update_many("carbon.test.metric", [(self.now - 3000 + i * 60, 1.0)
+                                                   for i in range(5)])
+        for compacted in (False, True):
+            (timeInfo, values) = self.db.fetch("carbon.test.metric", self.now - 6300, self.now)
+            self.assertEqual(300, timeInfo[2])
+            self.assertEqual(5.0, dict(zip(range(*timeInfo), values))[self.now - 3000])
+            self.db.compact(now=self.now + 3600 + 1200)
+            self.assertEqual({}, self.db.partitions[(60, 60)])
+
+    def test_old_datapoints_go_to_the_archive_covering_them(self):
+        self.db.create("carbon.test.metric", self.retentions)
+        self.db.update_many("carbon.test.metric", [(self.now - 6000, 1.0)])
+        self.assertEqual([(300, 24)], self.db.partitions.keys())
+        (timeInfo, values) = self.db.fetch("carbon.test.metric", self.now - 6300, self.now)
+        self.assertEqual(1.0, dict(zip(range(*timeInfo), values))[self.now - 6000])
+
+    def test_each_archive_expires_at_its_retention(self):
+        self.db.create("carbon.test.metric", self.retentions, 0, 'average')
+        self.db.update_many("carbon.test.metric", [(self.now - 120, 2.0)])
+        (partition,) = self.db.partitions[(60, 60)].values()
+        self.db.compact(now=self.now + 3600 + 1200)
+        self.assertEqual({}, self.db.partitions[(60, 60)])
+        self.assertFalse(os.path.exists(partition.path))
+        self.assertEqual(1, len(self.db.partitions[(300, 24)]))
+        (timeInfo, values) = self.db.fetch("carbon.test.metric", self.now - 6300, self.now)
+        self.assertEqual(2.0, dict(zip(range(*timeInfo), values))[self.now - 300])
+
+        self.db.compact(now=self.now + 7200 + 1200)
+        self.assertEqual({}, self.db.partitions[(300, 24)])
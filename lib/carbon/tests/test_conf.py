@@ -190,6 +190,22 @@ class ReadConfigTest(MockerTestCase):
         self.assertEqual(join("bar", "log", "carbon-foo"),
                          settings.LOG_DIR)
 
+    def test_spill_dir_for_instance_relative_to_storage_dir(self):
+        """
+        The 'SPILL_DIR' setting defaults to a program-specific directory
+        relative to the 'STORAGE_DIR' setting, with the instance name appended
+        in the case of an instance.
+        """
+        config = self.makeFile(content="[foo]")
+        settings = read_config(
+            "carbon-foo",
+            FakeOptions(config=config, instance="x",
+                        pidfile=None, logdir=None),
+            ROOT_DIR="foo")
+        self.assertEqual(join("foo", "storage", "spill", "carbon-foo",
+                              "carbon-foo-x"),
+                         settings.SPILL_DIR)
+
     def test_log_dir_for_instance_relative_to_storage_dir(self):
         """
         The 'LOG_DIR' setting defaults to a program-specific directory relative
@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import whisper
+
+from carbon import syncer
+from carbon.conf import Settings
+from carbon.database import loadDatabase, WhisperDatabase
+
+
+class DatabaseConformance(object):
+    """What any database must do, mixed into a TestCase per database, which
+    benchmark_database.py also runs against the database it measures."""
+    databaseSettings = {}
+    retentions = [(60, 60), (300, 24)]
+
+    def setUp(self):
+        self.whisperFlags = (whisper.AUTOFLUSH, whisper.CACHE_HEADERS, whisper.LOCK)
+        self.dir = tempfile.mkdtemp()
+        settings = Settings()
+        settings.update(self.databaseSettings)
+        settings['LOCAL_DATA_DIR'] = self.dir
+        self.db = loadDatabase(settings)
+        self.db.open()
+        self.now = int(time.time()) // 300 * 300
+
+    def tearDown(self):
+        self.db.close()
+        (whisper.AUTOFLUSH, whisper.CACHE_HEADERS, whisper.LOCK) = self.whisperFlags
+        shutil.rmtree(self.dir)
+
+    def fetchValues(self, metric):
+        (timeInfo, values) = self.db.fetch(metric, self.now - 600, self.now)
+        return dict(zip(range(*timeInfo), values))
+
+    def test_create(self):
+        self.assertFalse(self.db.exists("carbon.test.metric"))
+        self.db.create("carbon.test.metric", self.retentions, 0.5, 'max')
+        self.assertTrue(self.db.exists("carbon.test.metric"))
+        self.assertFalse(self.db.exists("carbon.test"))
+
+        info = self.db.info("carbon.test.metric")
+        self.assertEqual('max', info['aggregationMethod'])
+        self.assertEqual(0.5, info['xFilesFactor'])
+        self.assertEqual(self.retentions, [(archive['secondsPerPoint'], archive['points'])
+                                           for archive in info['archives']])
+
+    def test_create_with_defaults(self):
+        self.db.create("carbon.test.metric", self.retentions)
+        self.assertTrue(self.db.info("carbon.test.metric")['aggregationMethod'])
+
+    def test_update_many(self):
+        self.db.create("carbon.test.metric", self.retentions)
+        self.db.update_many("carbon.test.metric", [(self.now - 120, 2.0), (self.now - 240, 1.0)])
+        self.db.update_many("carbon.test.metric", [(self.now - 120, 3.0)])
+
+        values = self.fetchValues("carbon.test.metric")
+        self.assertEqual(1.0, values[self.now - 240])
+        self.assertEqual(3.0, values[self.now - 120])
+        self.assertEqual(None, values[self.now - 180])
+
+    def test_set_aggregation(self):
+        self.db.create("carbon.test.metric", self.retentions, aggregationMethod='sum')
+        self.db.update_many("carbon.test.metric", [(self.now - 60, 1.0)])
+        self.assertEqual('sum', self.db.set_aggregation("carbon.test.metric", 'max'))
+        self.db.invalidate("carbon.test.metric")
+        self.assertEqual('max', self.db.info("carbon.test.metric")['aggregationMethod'])
+        self.db.update_many("carbon.test.metric", [(self.now - 60, 2.0)])
+        self.assertEqual(2.0, self.fetchValues("carbon.test.metric")[self.now - 60])
+
+    def test_estimate_write_size(self):
+        self.assertTrue(self.db.estimateWriteSize(1) > 0)
+        self.assertTrue(self.db.estimateWriteSize(1, self.retentions) >
+                        self.db.estimateWriteSize(1))
+
+
+class WhisperDatabaseTest(DatabaseConformance, TestCase):
+
+    def test_is_the_default(self):
+        self.assertTrue(isinstance(self.db, WhisperDatabase))
+
+    def test_unknown_database(self):
+        settings = Settings()
+        settings['DATABASE'] = 'nosuch'
+        self.assertRaises(ValueError, loadDatabase, settings)
+
+
+class WhisperOpenFilesDatabaseTest(DatabaseConformance, TestCase):
+    databaseSettings = {'WHISPER_OPEN_FILES' : 10, 'WHISPER_MMAP' : True}
+
+
+class WhisperBatchedSyncDatabaseTest(DatabaseConformance, TestCase):
+    databaseSettings = {'WHISPER_AUTOFLUSH' : True, 'WHISPER_SYNC_BATCH_SIZE' : 2}
+
+    def test_every_update_is_synced(self):
+        """Files are synced in batches, and all of them by the time the
+        database is closed."""
+        synced = []
+        def fdatasync(fd):
+            synced.append(os.fstat(fd).st_ino)
+        originalFdatasync, syncer.fdatasync = syncer.fdatasync, fdatasync
+        try:
+            metrics = ["carbon.test.metric%d" % i for i in range(3)]
+            for metric in metrics:
+                self.db.create(metric, self.retentions)
+                self.db.update_many(metric, [(self.now - 60, 1.0)])
+            self.assertFalse(whisper.AUTOFLUSH)
+            self.db.close()
+        finally:
+            syncer.fdatasync = originalFdatasync
+        self.assertEqual(sorted([os.stat(self.db.getFilesystemPath(metric)).st_ino
+                                 for metric in metrics]), sorted(synced))
+        for metric in metrics:
+            self.assertEqual(1.0, self.fetchValues(metric)[self.now - 60])
+
+
+class DatabaseByPathTest(DatabaseConformance, TestCase):
+    databaseSettings = {'DATABASE' : 'carbon.database.WhisperDatabase'}
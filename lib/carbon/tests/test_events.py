@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from carbon.events import BatchEvent
+
+
+class BatchEventTest(TestCase):
+
+    def setUp(self):
+        self.event = BatchEvent('test')
+        self.points = []
+        self.batches = []
+        self.batch = [("foo", (1, 1.0)), ("bar", (2, 2.0))]
+
+    def pointHandler(self, metric, datapoint):
+        self.points.append((metric, datapoint))
+
+    def batchHandler(self, datapoints):
+        self.batches.append(datapoints)
+
+    def test_batch_handler(self):
+        self.event.addHandler(self.pointHandler, self.batchHandler)
+        self.event.batch(self.batch)
+        self.event("baz", (3, 3.0))
+        self.assertEqual([self.batch], self.batches)
+        self.assertEqual([("baz", (3, 3.0))], self.points)
+
+    def test_point_handler_fallback(self):
+        self.event.addHandler(self.pointHandler)
+        self.event.batch(self.batch)
+        self.assertEqual(self.batch, self.points)
+
+    def test_remove_handler(self):
+        self.event.addHandler(self.pointHandler, self.batchHandler)
+        self.event.removeHandler(self.pointHandler)
+        self.event.batch(self.batch)
+        self.assertEqual([], self.batches)
+        self.assertEqual({}, self.event.batchHandlers)
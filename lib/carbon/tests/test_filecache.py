@@ -0,0 +1,79 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import whisper
+
+from carbon import filecache
+from carbon.filecache import FileCache, headerCache
+
+
+class FileCacheTest(TestCase):
+
+    def setUp(self):
+        self.cacheHeaders = whisper.CACHE_HEADERS
+        whisper.CACHE_HEADERS = True
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, "%d.wsp" % i) for i in range(3)]
+        for path in self.paths:
+            whisper.create(path, [(1, 60)])
+        self.now = int(time.time())
+        self.files = FileCache(2)
+
+    def tearDown(self):
+        self.files.close()
+        whisper.CACHE_HEADERS = self.cacheHeaders
+        shutil.rmtree(self.dir)
+
+    def fetch(self, path):
+        return whisper.fetch(path, self.now - 10, self.now)[1][-1]
+
+    def test_handles_are_reused(self):
+        fh = self.files.update(self.paths[0], [(self.now, 1.0)])
+        self.assertTrue(fh is self.files.update(self.paths[0], [(self.now, 2.0)]))
+        self.assertEqual(2.0, self.fetch(self.paths[0]))
+
+    def test_least_recently_used_is_closed(self):
+        fh = self.files.update(self.paths[0], [(self.now, 1.0)])
+        self.files.update(self.paths[1], [(self.now, 1.0)])
+        self.files.update(self.paths[2], [(self.now, 1.0)])
+        self.assertTrue(fh.closed)
+        self.assertEqual(2, len(self.files))
+        self.assertFalse(self.paths[0] in headerCache)
+
+    def test_replaced_file_is_reopened(self):
+        self.files.update(self.paths[0], [(self.now, 1.0)])
+        os.remove(self.paths[0])
+        whisper.create(self.paths[0], [(1, 60)])
+        self.files.update(self.paths[0], [(self.now, 2.0)])
+        self.assertEqual(2.0, self.fetch(self.paths[0]))
+
+    def test_invalidate_forgets_header(self):
+        self.files.update(self.paths[0], [(self.now, 1.0)])
+        self.files.invalidate(self.paths[0])
+        self.assertEqual(0, len(self.files))
+        self.assertFalse(self.paths[0] in headerCache)
+
+    def test_without_header_cache(self):
+        """Files are still kept open when whisper's header cache cannot be
+        found."""
+        filecache.headerCache = None
+        try:
+            fh = self.files.update(self.paths[0], [(self.now, 1.0)])
+            self.files.update(self.paths[1], [(self.now, 1.0)])
+            self.files.update(self.paths[2], [(self.now, 1.0)])
+            self.assertTrue(fh.closed)
+            self.files.invalidate(self.paths[1])
+            self.assertEqual(1, len(self.files))
+        finally:
+            filecache.headerCache = headerCache
+
+    def test_headers_of_other_files_are_not_kept(self):
+        """Headers read outside of the FileCache, by whisper.info() and
+        fetch(), are not cached."""
+        self.files.update(self.paths[0], [(self.now, 1.0)])
+        whisper.info(self.paths[1])
+        self.fetch(self.paths[2])
+        self.assertEqual([self.paths[0]], headerCache.keys())
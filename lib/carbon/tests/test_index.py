@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+from carbon.index import FileIndex
+
+
+class FileIndexTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = FileIndex(self.root, threads=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, *parts):
+        path = join(self.root, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        return path
+
+    def test_rebuild_finds_database_files(self):
+        """Files are found at any depth, but only with the extension."""
+        paths = set([self.touch('top.wsp'),
+                     self.touch('foo', 'bar.wsp'),
+                     self.touch('foo', 'baz', 'qux.wsp'),
+                     self.touch('other', 'metric.wsp')])
+        self.touch('foo', 'notes.txt')
+        self.index.rebuild()
+        self.assertEqual(paths, self.index.paths)
+
+    def test_falls_back_to_stat_until_ready(self):
+        path = self.touch('foo', 'bar.wsp')
+        self.assertTrue(self.index.exists(path))
+        self.assertFalse(self.index.exists(join(self.root, 'missing.wsp')))
+
+    def test_ready_index_does_not_stat(self):
+        """Once built, files created behind the index's back are unknown."""
+        self.index.rebuild()
+        path = self.touch('foo', 'bar.wsp')
+        self.assertFalse(self.index.exists(path))
+        self.index.add(path)
+        self.assertTrue(self.index.exists(path))
+
+    def test_forget_removed_file(self):
+        path = self.touch('foo', 'bar.wsp')
+        self.index.rebuild()
+        self.index.forget(path)
+        self.assertTrue(self.index.exists(path))
+        os.remove(path)
+        self.index.forget(path)
+        self.assertFalse(self.index.exists(path))
+
+    def test_forget_during_rebuild(self):
+        """A file forgotten while a rebuild is running is not added back
+        by it."""
+        path = join(self.root, 'foo', 'bar.wsp')
+        self.index.added = set()
+        self.index.add(path)
+        self.index.forget(path)
+        self.assertEqual(set(), self.index.added)
+        self.assertFalse(path in self.index.paths)
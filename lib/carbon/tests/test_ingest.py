@@ -0,0 +1,90 @@
+import struct
+from unittest import TestCase
+
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from carbon import events, instrumentation
+from carbon.binary import encodeFrame, decodeFrame
+from carbon.ingest import IngestCoreReceiver, IngestForwarder, PAUSE, RESUME, STATS
+
+
+def frames(data):
+    "Splits the 32-bit length prefixed messages out of data"
+    messages = []
+    while data:
+        (length,) = struct.unpack('!I', data[:4])
+        messages.append(data[4:4 + length])
+        data = data[4 + length:]
+    return messages
+
+
+class IngestCoreReceiverTest(TestCase):
+
+    def setUp(self):
+        self.received = []
+        events.metricReceived.addHandler(self.metricReceived, self.received.extend)
+        self.receiver = IngestCoreReceiver()
+        self.receiver.makeConnection(StringTransport())
+
+    def tearDown(self):
+        self.receiver.connectionLost(Failure(ConnectionDone()))
+        events.metricReceived.removeHandler(self.metricReceived)
+
+    def metricReceived(self, metric, datapoint):
+        self.fail("Forwarded datapoints are passed on as batches")
+
+    def test_forwarded_datapoints_are_passed_on(self):
+        datapoints = [("foo", (1.0, 2.0)), ("bar", (-1.0, 3.0))]
+        self.receiver.stringReceived(encodeFrame(datapoints))
+        self.assertEqual(datapoints, self.received)
+
+    def test_forwarded_stats_are_counted(self):
+        instrumentation.stats.pop('blacklistMatches', None)
+        self.receiver.stringReceived(STATS + ' blacklistMatches=3 unknown=1')
+        self.receiver.stringReceived(STATS + ' blacklistMatches=2')
+        self.assertEqual(5, instrumentation.stats.pop('blacklistMatches'))
+        self.assertFalse('unknown' in instrumentation.stats)
+        self.assertEqual([], self.received)
+
+    def test_pauses_are_passed_on(self):
+        events.pauseReceivingMetrics()
+        events.resumeReceivingMetrics()
+        self.assertEqual([PAUSE, RESUME], frames(self.receiver.transport.value()))
+
+
+class IngestForwarderTest(TestCase):
+
+    def setUp(self):
+        self.paused = []
+        self.forwarder = IngestForwarder()
+        self.forwarder.pending = []
+        self.forwarder.transport = StringTransport()
+
+    def test_batches_are_forwarded_together(self):
+        self.forwarder.pending.extend([("foo", (1.0, 2.0))])
+        self.forwarder.pending.extend([("bar", (2.0, 3.0))])
+        self.forwarder.flush()
+        (message,) = frames(self.forwarder.transport.value())
+        self.assertEqual([("foo", (1.0, 2.0)), ("bar", (2.0, 3.0))], decodeFrame(message))
+
+    def test_pause_and_resume(self):
+        handlers = (lambda: self.paused.append(True), lambda: self.paused.append(False))
+        events.pauseReceivingMetrics.addHandler(handlers[0])
+        events.resumeReceivingMetrics.addHandler(handlers[1])
+        try:
+            self.forwarder.stringReceived(PAUSE)
+            self.forwarder.stringReceived(RESUME)
+        finally:
+            events.pauseReceivingMetrics.removeHandler(handlers[0])
+            events.resumeReceivingMetrics.removeHandler(handlers[1])
+        self.assertEqual([True, False], self.paused)
+
+    def test_stats_are_forwarded(self):
+        instrumentation.increment('whitelistRejects', 4)
+        self.forwarder.sendStats()
+        self.forwarder.sendStats()
+        (message,) = frames(self.forwarder.transport.value())
+        self.assertEqual(STATS + ' whitelistRejects=4', message)
+        self.assertFalse('whitelistRejects' in instrumentation.stats)
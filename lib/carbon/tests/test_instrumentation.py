@@ -0,0 +1,21 @@
+from threading import Thread
+from unittest import TestCase
+
+from carbon import instrumentation
+
+
+class InstrumentationTest(TestCase):
+
+    def tearDown(self):
+        instrumentation.stats.pop('test.count', None)
+
+    def test_concurrent_increments_are_counted(self):
+        def increment():
+            for i in xrange(10000):
+                instrumentation.increment('test.count')
+        threads = [Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40000, instrumentation.stats['test.count'])
@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from twisted.test.proto_helpers import StringTransport
+
+from carbon.protocols import parseLines, MetricLineReceiver
+
+
+class ParseLinesTest(TestCase):
+
+    def test_well_formed(self):
+        self.assertEqual(([("foo", (1.0, 2.5)), ("bar", (3.0, -1.0))], 0),
+                         parseLines(["foo 2.5 1", "bar  -1\t3\r"]))
+
+    def test_invalid_lines_are_counted(self):
+        lines = ["foo 2.5 1", "", "foo bar 1", "foo 1", "foo 1 2 3", "bar 1 2"]
+        self.assertEqual(([("foo", (1.0, 2.5)), ("bar", (2.0, 1.0))], 4),
+                         parseLines(lines))
+
+
+class MetricLineReceiverTest(TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.protocol = MetricLineReceiver()
+        self.protocol.metricsReceived = self.received.extend
+        self.protocol.peerName = 'test'
+        self.protocol.transport = StringTransport()
+
+    def test_lines_split_across_chunks(self):
+        self.protocol.dataReceived("foo 1 10\nba")
+        self.assertEqual([("foo", (10.0, 1.0))], self.received)
+        self.protocol.dataReceived("r 2 20\nbaz 3 30\n")
+        self.assertEqual([("foo", (10.0, 1.0)), ("bar", (20.0, 2.0)), ("baz", (30.0, 3.0))],
+                         self.received)
+
+    def test_line_length_exceeded(self):
+        self.assertTrue(self.protocol.dataReceived("x" * (MetricLineReceiver.MAX_LENGTH + 1)))
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+from carbon.cache import MetricCache
+from carbon.snapshot import saveCache, loadCache, readSnapshot
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, "cache.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        """A snapshot empties the cache, and is deleted once loaded."""
+        for compact in (False, True):
+            cache = MetricCache.__class__(shards=2, compact=compact)
+            cache.store("foo", (1, 1.0))
+            cache.store("foo", (2, 2.5))
+            cache.store("bar", (3, 3.0))
+            saveCache(cache, self.path)
+            self.assertFalse(cache)
+
+            cache = MetricCache.__class__(shards=4)
+            loadCache(cache, self.path)
+            self.assertEqual([(1, 1.0), (2, 2.5)], cache.get("foo"))
+            self.assertEqual([(3, 3.0)], cache.get("bar"))
+            self.assertEqual(3, cache.size)
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_truncated_snapshot(self):
+        """A truncated snapshot is detected and loaded as far as it goes."""
+        cache = MetricCache.__class__()
+        cache.store("foo", (1, 1.0))
+        saveCache(cache, self.path)
+        data = open(self.path, 'rb').read()
+        open(self.path, 'wb').write(data[:-8])
+        self.assertRaises(EOFError, list, readSnapshot(self.path))
+        loadCache(cache, self.path)
+        self.assertEqual([(1, 1.0)], cache.get("foo"))
+
+    def test_failed_save_keeps_the_cache(self):
+        """Datapoints are put back into the cache if the snapshot cannot be
+        written."""
+        for compact in (False, True):
+            cache = MetricCache.__class__(shards=2, compact=compact)
+            cache.store("foo", (1, 1.0))
+            cache.store("bar", (2, 2.0))
+            path = join(self.directory, "missing", "cache.snapshot")
+            self.assertRaises(IOError, saveCache, cache, path)
+            self.assertEqual([(1, 1.0)], cache.get("foo"))
+            self.assertEqual([(2, 2.0)], cache.get("bar"))
+            self.assertEqual(2, cache.size)
+            # Put back available to the writer, not held
+            popped = [cache.popFullest()[0], cache.popFullest()[0]]
+            self.assertEqual(["bar", "foo"], sorted(popped))
+
+    def test_unicode_metric_name(self):
+        cache = MetricCache.__class__()
+        cache.store(u"caf\xe9", (1, 1.0))
+        saveCache(cache, self.path)
+        loadCache(cache, self.path)
+        self.assertEqual([(1, 1.0)], cache.get("caf\xc3\xa9"))
+
+    def test_missing_snapshot(self):
+        cache = MetricCache.__class__()
+        loadCache(cache, self.path)
+        self.assertFalse(cache)
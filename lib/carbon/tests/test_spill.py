@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from carbon.spill import SpillQueue
+
+
+class SpillQueueTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_first_in_first_out(self):
+        """Records are popped in order across segments, which are deleted
+        once popped."""
+        queue = SpillQueue(self.directory, 1024 * 1024, segmentSize=100)
+        for i in range(10):
+            self.assertTrue(queue.append("metric.%d" % i, [(i, float(i))]))
+        self.assertEqual(10, len(queue))
+        self.assertTrue(len(self.segments()) > 1)
+        for i in range(10):
+            self.assertEqual(("metric.%d" % i, [(i, float(i))]), queue.pop())
+        self.assertEqual(None, queue.pop())
+        self.assertEqual(0, len(queue))
+        self.assertEqual(0, queue.size)
+        self.assertEqual(1, len(self.segments()))
+
+    def test_pop_after_catching_up(self):
+        """Records appended after the queue was drained can be popped."""
+        queue = SpillQueue(self.directory, 1024 * 1024)
+        queue.append("foo", [(1, 1.0)])
+        self.assertEqual("foo", queue.pop()[0])
+        self.assertEqual(None, queue.pop())
+        queue.append("bar", [(2, 2.0)])
+        self.assertEqual("bar", queue.pop()[0])
+
+    def test_bounded_size(self):
+        queue = SpillQueue(self.directory, 200)
+        appended = 0
+        while queue.append("foo", [(1, 1.0)]):
+            appended += 1
+        self.assertTrue(appended > 0)
+        self.assertEqual(appended, len(queue))
+        self.assertTrue(queue.size <= 200)
+
+    def test_records_survive_restart(self):
+        """Records left by a previous queue are popped first, and a torn
+        record at the end of a segment is skipped."""
+        queue = SpillQueue(self.directory, 1024 * 1024)
+        queue.append("foo", [(1, 1.0)])
+        queue.append("bar", [(2, 2.0)])
+        queue.writer.write("\x00\x00\x01")
+        queue.writer.close()
+
+        queue = SpillQueue(self.directory, 1024 * 1024)
+        self.assertEqual(2, len(queue))
+        self.assertNotEqual(None, queue.oldest())
+        queue.append("baz", [(3, 3.0)])
+        self.assertEqual(["foo", "bar", "baz"],
+                         [queue.pop()[0] for i in range(3)])
+        self.assertEqual(None, queue.pop())
+        self.assertEqual(None, queue.oldest())
+        self.assertEqual(1, len(self.segments()))
@@ -0,0 +1,51 @@
+import os
+import time
+import tempfile
+from unittest import TestCase
+
+from carbon import syncer
+from carbon.syncer import Syncer
+
+
+class SyncerTest(TestCase):
+
+    def setUp(self):
+        self.synced = []
+        self.fdatasync = syncer.fdatasync
+        syncer.fdatasync = self.synced.append
+        self.fh = tempfile.TemporaryFile()
+
+    def tearDown(self):
+        syncer.fdatasync = self.fdatasync
+        self.fh.close()
+
+    def dup(self):
+        return os.dup(self.fh.fileno())
+
+    def test_full_batch_is_synced(self):
+        s = Syncer(batchSize=2, window=60, threads=2)
+        fds = [self.dup(), self.dup()]
+        for fd in fds:
+            s.add(fd)
+        s.close()
+        self.assertEqual(sorted(fds), sorted(self.synced))
+
+    def test_window_bounds_sync_delay(self):
+        """A partial batch is synced once its oldest file waited the
+        window."""
+        s = Syncer(batchSize=100, window=0.1, threads=1)
+        fd = self.dup()
+        s.add(fd)
+        deadline = time.time() + 5
+        while not self.synced and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([fd], self.synced)
+        s.close()
+
+    def test_close_syncs_pending_files(self):
+        s = Syncer(batchSize=100, window=60, threads=1)
+        fd = self.dup()
+        s.add(fd)
+        s.close()
+        self.assertEqual([fd], self.synced)
+        self.assertRaises(OSError, os.fstat, fd)
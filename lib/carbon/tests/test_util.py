@@ -0,0 +1,138 @@
+from unittest import TestCase
+from carbon.util import TokenBucket, LRUCache, InternTable
+
+
+class TokenBucketTest(TestCase):
+
+    def test_drain_within_capacity(self):
+        """Tokens can be drained until the bucket is empty."""
+        bucket = TokenBucket(10, 1)
+        self.assertTrue(bucket.drain(6))
+        self.assertTrue(bucket.drain(4))
+        self.assertFalse(bucket.drain(1))
+
+    def test_refill(self):
+        """The bucket refills at its fill rate, up to its capacity."""
+        bucket = TokenBucket(10, 2)
+        bucket.drain(10)
+        bucket.timestamp -= 2
+        self.assertTrue(bucket.drain(4))
+        self.assertFalse(bucket.drain(1))
+        bucket.timestamp -= 60
+        self.assertEqual(10, int(bucket.tokens))
+
+    def test_throttle_pays_off_debt(self):
+        """Throttling sleeps for as long as it takes to refill the debt."""
+        bucket = TokenBucket(1, 1000)
+        self.assertEqual(0, bucket.throttle(1))
+        delay = bucket.throttle(5)
+        self.assertTrue(0.004 < delay <= 0.005, delay)
+
+    def test_throttle_without_fill_rate(self):
+        """A fill rate of 0 sets no limit on throttling."""
+        bucket = TokenBucket(0, 0)
+        self.assertEqual(0, bucket.throttle(10 ** 9))
+        self.assertEqual(0, bucket.throttle(1))
+
+    def test_unlimited(self):
+        """An infinite bucket never runs out."""
+        bucket = TokenBucket(float('inf'), float('inf'))
+        self.assertTrue(bucket.drain(10 ** 9))
+        self.assertEqual(0, bucket.throttle(10 ** 9))
+        self.assertEqual(float('inf'), bucket.tokens)
+
+    def test_set_rate_does_not_refill(self):
+        bucket = TokenBucket(10, 0.001)
+        bucket.drain(8)
+        bucket.setRate(100, 0.001)
+        self.assertFalse(bucket.drain(5))
+        bucket.setRate(1, 0.001)
+        self.assertTrue(bucket.tokens <= 1)
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        """Reading an item protects it from the next eviction."""
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertFalse("b" in cache)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_put_replaces_value(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("a", 2)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(2, cache.get("a"))
+
+    def test_zero_size_holds_nothing(self):
+        cache = LRUCache(0)
+        cache.put("a", 1)
+        self.assertEqual(0, len(cache))
+        self.assertEqual("missing", cache.get("a", "missing"))
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        cache.put("b", 2)
+        self.assertEqual(2, cache.get("b"))
+
+    def test_evicted_items_are_passed_on(self):
+        evicted = []
+        cache = LRUCache(1, lambda key, value: evicted.append((key, value)))
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual([("a", 1)], evicted)
+        self.assertEqual(2, cache.pop("b"))
+        self.assertEqual(None, cache.pop("b"))
+        self.assertEqual([("a", 1)], evicted)
+        self.assertEqual([], cache.items())
+
+
+class InternTableTest(TestCase):
+
+    def setUp(self):
+        self.table = InternTable(2)
+
+    def test_equal_strings_share_an_instance(self):
+        first = ''.join(['foo', '.bar'])
+        second = ''.join(['foo', '.bar'])
+        self.assertFalse(first is second)
+        self.assertTrue(self.table.intern(first) is first)
+        self.assertTrue(self.table.intern(second) is first)
+        self.assertEqual((1, 1, len(second) + InternTable.STRING_OVERHEAD),
+                         self.table.takeStats())
+        self.assertEqual((0, 0, 0), self.table.takeStats())
+
+    def test_intern_all(self):
+        items = [("foo", 1), ("bar", 2), ("foo", 3)]
+        self.assertEqual(items, self.table.internAll(items))
+        self.assertEqual(2, len(self.table))
+
+    def test_evicts_when_full(self):
+        for string in ("foo", "bar", "baz"):
+            self.table.intern(string)
+        self.assertEqual(2, len(self.table))
+
+    def test_hot_set_within_a_batch_of_max_size(self):
+        """A table nearly full of the strings in use keeps them."""
+        self.table.internAll([("foo", 1), ("bar", 2)])
+        self.table.takeStats()
+        for i in range(3):
+            self.table.internAll([("".join(["fo", "o"]), 1), ("".join(["ba", "r"]), 2)])
+        self.assertEqual((6, 0, 6 * (3 + InternTable.STRING_OVERHEAD)), self.table.takeStats())
+
+    def test_instance_found_saves_nothing(self):
+        string = "".join(["foo", ".bar"])
+        self.table.intern(string)
+        self.table.intern(string)
+        self.assertEqual((1, 1, 0), self.table.takeStats())
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from carbon.cache import MetricCache
+from carbon.wal import WriteAheadLog
+
+
+class WriteAheadLogTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def restart(self, segmentSize=1024 * 1024):
+        wal = WriteAheadLog(self.directory, segmentSize, fsyncInterval=-1)
+        cache = MetricCache.__class__(shards=2, wal=wal)
+        wal.replay(cache.store)
+        return (wal, cache)
+
+    def write(self, wal, cache):
+        metric, datapoints = cache.popFullest()
+        wal.written(metric)
+        return metric
+
+    def test_replay_unwritten_datapoints(self):
+        """Only the datapoints not written before a crash are replayed."""
+        wal, cache = self.restart()
+        cache.store("foo", (1, 1.0))
+        cache.store("foo", (2, 2.0))
+        cache.store("bar", (1, 1.0))
+        self.assertEqual("foo", self.write(wal, cache))
+        wal.flush()
+
+        wal, cache = self.restart()
+        self.assertEqual([(1, 1.0)], cache.get("bar"))
+        # foo shared bar's segment, which is replayed as a whole
+        self.assertEqual([(1, 1.0), (2, 2.0)], cache.get("foo"))
+
+    def test_written_segments_are_deleted(self):
+        wal, cache = self.restart(segmentSize=1)
+        for i in range(3):
+            cache.store("foo", (i, float(i)))
+            wal.flush()
+        self.assertEqual(3, len(os.listdir(self.directory)))
+        self.write(wal, cache)
+        wal.flush()
+        self.assertEqual([], os.listdir(self.directory))
+
+        wal, cache = self.restart()
+        self.assertFalse(cache)
+
+    def test_datapoints_stored_while_popped(self):
+        """A queue stored to while its predecessor is being written keeps
+        its segment."""
+        wal, cache = self.restart(segmentSize=1)
+        cache.store("foo", (1, 1.0))
+        wal.flush()
+        metric, datapoints = cache.popFullest()
+        cache.store("foo", (2, 2.0))
+        wal.flush()
+        wal.written(metric)
+        wal.flush()
+
+        wal, cache = self.restart()
+        self.assertEqual([(2, 2.0)], cache.get("foo"))
+
+    def test_held_queue_is_replayed(self):
+        wal, cache = self.restart(segmentSize=1)
+        cache.store("foo", (1, 1.0))
+        wal.flush()
+        cache.hold(*cache.popFullest())
+        wal.flush()
+
+        wal, cache = self.restart()
+        self.assertEqual([(1, 1.0)], cache.get("foo"))
+
+    def test_popped_twice_before_written(self):
+        """A queue popped again before the previous one was written does
+        not keep its segments forever."""
+        wal, cache = self.restart(segmentSize=1)
+        cache.store("foo", (1, 1.0))
+        wal.flush()
+        cache.popFullest()
+        cache.store("foo", (2, 2.0))
+        wal.flush()
+        self.write(wal, cache)
+        self.assertEqual({}, wal.references)
+        self.assertEqual([{}, {}], [shard.references for shard in wal.shards])
+        wal.flush()
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_stores_do_not_take_the_log_lock(self):
+        """Shards log datapoints without contending for a lock of the
+        log."""
+        wal, cache = self.restart()
+        class NoLock(object):
+            def acquire(self):
+                raise AssertionError("The lock of the log was taken")
+        wal.lock = NoLock()
+        for i in range(10):
+            cache.store("foo.%d" % i, (i, float(i)))
+        self.assertEqual(10, sum([len(shard.buffer) for shard in wal.shards]))
+
+    def test_torn_frame_is_ignored(self):
+        wal, cache = self.restart()
+        cache.store("foo", (1, 1.0))
+        wal.flush()
+        wal.fh.write("\x00\x00\x00\x10garbage")
+        wal.close()
+
+        wal, cache = self.restart()
+        self.assertEqual([(1, 1.0)], cache.get("foo"))
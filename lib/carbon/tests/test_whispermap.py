@@ -0,0 +1,98 @@
+import os
+import random
+import shutil
+import tempfile
+import struct
+
+from twisted.trial.unittest import TestCase
+
+import whisper
+
+from carbon import whispermap
+from carbon.whispermap import MappedWhisperFile, VectorizedWhisperFile
+
+
+class MappedWhisperFileTest(TestCase):
+    fileClass = MappedWhisperFile
+    archives = [(10, 60), (60, 60), (300, 48), (3600, 24)]
+    now = 1400000000
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.random = random.Random(42)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create(self, name, **kwargs):
+        path = os.path.join(self.dir, '%d-%s' % (len(os.listdir(self.dir)), name))
+        whisper.create(path, self.archives, **kwargs)
+        return path
+
+    def points(self, count, maxAge):
+        points = [(self.now - self.random.randint(0, maxAge), self.random.random() * 100)
+                  for i in range(count)]
+        points.sort(key=lambda point: point[0], reverse=True)
+        return points
+
+    def assertSameUpdates(self, batches, **kwargs):
+        """Applies the batches to a file with whisper and to another through
+        fileClass, which must end up the same."""
+        expected = self.create('expected.wsp', **kwargs)
+        actual = self.create('actual.wsp', **kwargs)
+        mapped = self.fileClass(actual)
+        try:
+            for points in batches:
+                whisper.update_many(expected, points, now=self.now)
+                mapped.update_many(points, now=self.now)
+        finally:
+            mapped.close()
+        self.assertSameFiles(open(expected, 'rb').read(), open(actual, 'rb').read())
+
+    def assertSameFiles(self, expected, actual):
+        self.assertEqual(expected, actual)
+
+    def test_single_points(self):
+        self.assertSameUpdates([self.points(1, 3000) for i in range(200)])
+
+    def test_batches_wrap_and_propagate(self):
+        self.assertSameUpdates([self.points(50, 90000) for i in range(30)])
+
+    def test_aggregation_and_xff(self):
+        for method in whisper.aggregationMethods:
+            self.assertSameUpdates([self.points(20, 20000) for i in range(20)],
+                                   aggregationMethod=method, xFilesFactor=0.1)
+
+    def test_truncated_file_is_corrupt(self):
+        path = self.create('truncated.wsp')
+        with open(path, 'r+b') as fh:
+            fh.truncate(100)
+        self.assertRaises(whisper.CorruptWhisperFile, MappedWhisperFile, path)
+
+
+class VectorizedWhisperFileTest(MappedWhisperFileTest):
+    fileClass = VectorizedWhisperFile
+    if whispermap.numpy is None:
+        skip = "numpy is not installed"
+
+    def setUp(self):
+        MappedWhisperFileTest.setUp(self)
+        self.minPoints = VectorizedWhisperFile.minPoints
+        VectorizedWhisperFile.minPoints = 2
+
+    def tearDown(self):
+        VectorizedWhisperFile.minPoints = self.minPoints
+        MappedWhisperFileTest.tearDown(self)
+
+    def assertSameFiles(self, expected, actual):
+        """The same points must be written, with values equal but for the
+        rounding of sums."""
+        self.assertEqual(len(expected), len(actual))
+        pointSize = whisper.pointSize
+        start = whisper.metadataSize + whisper.archiveInfoSize * len(self.archives)
+        self.assertEqual(expected[:start], actual[:start])
+        for offset in range(start, len(expected), pointSize):
+            (expectedInterval, expectedValue) = struct.unpack_from(whisper.pointFormat, expected, offset)
+            (actualInterval, actualValue) = struct.unpack_from(whisper.pointFormat, actual, offset)
+            self.assertEqual(expectedInterval, actualInterval)
+            self.assertAlmostEqual(expectedValue, actualValue)
@@ -0,0 +1,314 @@
+import os
+import shutil
+import signal
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+import whisper
+
+from carbon import conf, log, instrumentation
+from carbon.cache import MetricCache
+from carbon.index import FileIndex
+from carbon.spill import SpillQueue
+from carbon.util import TokenBucket
+
+# carbon.writer loads the storage schemas and opens its database on import
+directory = tempfile.mkdtemp()
+open(join(directory, 'storage-schemas.conf'), 'w').write(
+    "[default]\npattern = .*\nretentions = 60s:1d\n")
+for name in ('CONF_DIR', 'LOCAL_DATA_DIR', 'SNAPSHOT_DIR', 'SPILL_DIR', 'WAL_DIR'):
+    conf.settings.setdefault(name, directory)
+
+from carbon import writer
+
+
+class WriterProcessTest(TestCase):
+
+    def setUp(self):
+        self.process = self.conn = writer.startWriterProcess(0)
+
+    def tearDown(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        MetricCache.popAll()
+
+    def test_writes_in_a_fresh_interpreter(self):
+        """Batches are written by the process, which logs to the daemon."""
+        path = writer.database.getFilesystemPath("written")
+        writes = [("written", [(60, 1.0)], path, ([(60, 60)], 0.5, "average"))]
+        try:
+            ((metric, dbFilePath, created, pointCount, updateTime, error),) = \
+                writer.commit(writes, self.conn)
+            self.assertEqual(None, error)
+            self.assertEqual(("written", True, 1), (metric, created, pointCount))
+            self.assertTrue(os.path.exists(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertTrue(self.process.is_alive())
+
+    def test_dead_process_puts_batch_back(self):
+        """The datapoints of a batch the writer process dies on are put back
+        into the cache instead of being lost."""
+        for metric in ("foo", "bar"):
+            MetricCache.store(metric, (60, 1.0))
+        writes = [(metric, datapoints, join(directory, metric + ".wsp"), True)
+                  for (metric, datapoints) in MetricCache.popAll()]
+        os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+        self.assertRaises((EOFError, IOError), list,
+                          writer.commitBatches(writes, self.conn))
+        self.assertEqual([(60, 1.0)], MetricCache.get("foo"))
+        self.assertEqual([(60, 1.0)], MetricCache.get("bar"))
+        # Put back available to the writers, not held
+        self.assertTrue(MetricCache.popFullest())
+        self.assertTrue(MetricCache.popFullest())
+
+    def test_create_args_failure_is_reported(self):
+        """A metric that cannot be created fails alone, like a failed
+        write."""
+        writes = [("foo", [(60, 1.0)], join(directory, "foo.wsp"), False)]
+        getCreateArgs = writer.getCreateArgs
+        def fail(metric):
+            raise Exception("No storage schema matched the metric")
+        writer.getCreateArgs = fail
+        try:
+            (results,) = list(writer.commitBatches(writes, self.conn))
+        finally:
+            writer.getCreateArgs = getCreateArgs
+        ((metric, dbFilePath, created, pointCount, updateTime, error),) = results
+        self.assertEqual(("foo", False, 1, None), (metric, created, pointCount, updateTime))
+        self.assertTrue("No storage schema" in error)
+
+
+class WriteCachedDataPointsTest(TestCase):
+
+    def tearDown(self):
+        MetricCache.popAll()
+        for name in ('committedPoints', 'updateTimes', 'writer.0.updateTimes'):
+            instrumentation.stats.pop(name, None)
+
+    def test_single_writer_update_times(self):
+        """Update times are only broken down per writer when there are
+        several."""
+        path = writer.database.getFilesystemPath("timed")
+        whisper.create(path, [(60, 60)])
+        try:
+            MetricCache.store("timed", (60, 1.0))
+            writer.writeCachedDataPoints()
+        finally:
+            os.remove(path)
+        self.assertEqual(1, len(instrumentation.stats['updateTimes']))
+        self.assertFalse('writer.0.updateTimes' in instrumentation.stats)
+
+
+class OptimalWriteOrderTest(TestCase):
+
+    def setUp(self):
+        self.fileIndex = writer.fileIndex
+        writer.fileIndex = FileIndex(directory)
+        writer.fileIndex.rebuild()
+
+    def tearDown(self):
+        writer.fileIndex = self.fileIndex
+        MetricCache.popAll()
+
+    def test_file_created_outside_carbon(self):
+        """A file missing from the index is looked for before it is
+        created."""
+        path = writer.database.getFilesystemPath("outside")
+        whisper.create(path, [(60, 60)])
+        try:
+            MetricCache.store("outside", (60, 1.0))
+            ((metric, datapoints, dbFilePath, dbFileExists),) = list(writer.optimalWriteOrder())
+            self.assertTrue(dbFileExists)
+            self.assertTrue(writer.fileIndex.exists(path))
+        finally:
+            os.remove(path)
+
+
+    def test_one_stat_until_the_index_is_ready(self):
+        writer.fileIndex = FileIndex(directory)
+        stats = []
+        def exists(metric):
+            stats.append(metric)
+            return False
+        writer.database.exists = exists
+        try:
+            MetricCache.store("unindexed", (60, 1.0))
+            ((metric, datapoints, dbFilePath, dbFileExists),) = list(writer.optimalWriteOrder())
+        finally:
+            del writer.database.exists
+        self.assertFalse(dbFileExists)
+        self.assertEqual([], stats)
+
+
+class ReplaySpilledTest(TestCase):
+
+    def setUp(self):
+        self.spill, self.createBucket = writer.spill, writer.createBucket
+        self.spillDir = tempfile.mkdtemp()
+        writer.spill = SpillQueue(self.spillDir, 1024 * 1024)
+        writer.createBucket = TokenBucket(2, 0.001)
+
+    def tearDown(self):
+        writer.spill, writer.createBucket = self.spill, self.createBucket
+        writer.replayedCreates.clear()
+        MetricCache.popAll()
+        shutil.rmtree(self.spillDir)
+
+    def test_replayed_metrics_keep_their_creates(self):
+        """Replayed metrics take their creates from the budget, and new
+        metrics cannot use them up."""
+        for metric in ("foo", "bar", "baz"):
+            writer.spill.append(metric, [(60, 1.0)])
+        writer.storeSpilled(writer.readSpilled())
+        self.assertEqual(1, len(writer.spill))
+        self.assertEqual(2, len(MetricCache))
+        self.assertFalse(writer.drainCreate("new"))
+        self.assertTrue(writer.drainCreate("foo"))
+        self.assertTrue(writer.drainCreate("bar"))
+        self.assertFalse(writer.drainCreate("bar"))
+
+    def test_created_in_the_meantime(self):
+        """The create of a replayed metric whose file exists by the time it
+        is written is forgotten."""
+        path = writer.database.getFilesystemPath("replayed")
+        whisper.create(path, [(60, 60)])
+        try:
+            writer.spill.append("replayed", [(60, 1.0)])
+            writer.storeSpilled(writer.readSpilled())
+            self.assertEqual(set(["replayed"]), writer.replayedCreates)
+            fileIndex, writer.fileIndex = writer.fileIndex, None
+            try:
+                self.assertEqual(1, len(list(writer.optimalWriteOrder())))
+            finally:
+                writer.fileIndex = fileIndex
+            self.assertEqual(set(), writer.replayedCreates)
+        finally:
+            os.remove(path)
+
+
+class CreateHeldMetricTest(TestCase):
+
+    def setUp(self):
+        self.path = writer.database.getFilesystemPath("held")
+        MetricCache.store("held", (60, 1.0))
+        MetricCache.hold(*MetricCache.popFullest())
+        writer.pendingCreates.add("held")
+
+    def tearDown(self):
+        writer.pendingCreates.clear()
+        MetricCache.popAll()
+        for name in ('errors', 'spill.dropped'):
+            instrumentation.stats.pop(name, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_released_after_create(self):
+        self.assertEqual(None, MetricCache.popFullest())
+        writer.createHeldMetric("held")
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(set(), writer.pendingCreates)
+        self.assertEqual(("held", [(60, 1.0)]), MetricCache.popFullest())
+
+    def test_failed_create_drops_datapoints(self):
+        getCreateArgs, err = writer.getCreateArgs, log.err
+        def fail(metric):
+            raise Exception("No storage schema matched the metric")
+        writer.getCreateArgs = fail
+        log.err = lambda *args, **kwargs: None
+        try:
+            writer.createHeldMetric("held")
+        finally:
+            writer.getCreateArgs, log.err = getCreateArgs, err
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(set(), writer.pendingCreates)
+        self.assertFalse(MetricCache)
+        self.assertEqual(1, instrumentation.stats['errors'])
+        self.assertEqual(1, instrumentation.stats['spill.dropped'])
+
+    def test_pending_creates_dropped_on_shutdown(self):
+        writer.dropPendingCreates()
+        self.assertEqual(set(), writer.pendingCreates)
+        self.assertFalse(MetricCache)
+        self.assertEqual(1, instrumentation.stats['spill.dropped'])
+
+    def test_pending_creates_spilled_on_shutdown(self):
+        spill, spillDir = writer.spill, tempfile.mkdtemp()
+        writer.spill = SpillQueue(spillDir, 1024 * 1024)
+        try:
+            writer.dropPendingCreates()
+            self.assertEqual(("held", [(60, 1.0)]), writer.spill.pop())
+        finally:
+            writer.spill = spill
+            shutil.rmtree(spillDir)
+        self.assertFalse(MetricCache)
+        self.assertFalse('spill.dropped' in instrumentation.stats)
+
+
+class UpdateRateControllerTest(TestCase):
+
+    def setUp(self):
+        self.bucket = TokenBucket(1000, 1000)
+
+    def adjust(self, controller, updateTime, throttled=0.0):
+        controller.observe(updateTime)
+        if throttled:
+            controller.addThrottled(throttled)
+        controller.adjust()
+        return controller.rate
+
+    def test_initial_rate(self):
+        controller = writer.UpdateRateController(self.bucket, 100, 500, 0.01)
+        self.assertEqual(500, controller.rate)
+        self.assertEqual(500, self.bucket.fillRate)
+        controller = writer.UpdateRateController(self.bucket, 100, float('inf'), 0.01)
+        self.assertEqual(100, controller.rate)
+        self.assertEqual(100, self.bucket.fillRate)
+        controller = writer.UpdateRateController(self.bucket, 100, 0, 0.01)
+        self.assertEqual(100, controller.rate)
+        self.assertEqual(float('inf'), controller.maxRate)
+
+    def test_p99(self):
+        controller = writer.UpdateRateController(self.bucket, 100, 500, 0.01)
+        for i in range(199):
+            controller.observe(0.001)
+        controller.observe(1.0)
+        controller.adjust()
+        self.assertEqual(0.001, controller.lastP99)
+        self.assertEqual(500, controller.rate)
+
+        for i in range(198):
+            controller.observe(0.001)
+        controller.observe(1.0)
+        controller.observe(1.0)
+        controller.adjust()
+        self.assertEqual(1.0, controller.lastP99)
+        self.assertEqual(250, controller.rate)
+
+    def test_halved_down_to_min_rate(self):
+        controller = writer.UpdateRateController(self.bucket, 100, 500, 0.01)
+        self.assertEqual([250, 125, 100, 100],
+                         [self.adjust(controller, 0.1) for i in range(4)])
+        self.assertEqual(100, self.bucket.fillRate)
+
+    def test_raised_up_to_max_rate_while_throttled(self):
+        controller = writer.UpdateRateController(self.bucket, 100, 250, 0.01)
+        self.adjust(controller, 0.1)
+        self.assertEqual(125, controller.rate)
+        # Not throttled, there is no need to go faster
+        self.assertEqual(125, self.adjust(controller, 0.001))
+        self.assertEqual([225, 250, 250],
+                         [self.adjust(controller, 0.001, throttled=0.5) for i in range(3)])
+        self.assertEqual(250, self.bucket.fillRate)
+
+    def test_nothing_observed(self):
+        controller = writer.UpdateRateController(self.bucket, 100, 500, 0.01)
+        controller.addThrottled(1.0)
+        controller.adjust()
+        self.assertEqual(500, controller.rate)
+        self.assertEqual(0.0, controller.throttled)
+        self.assertEqual(None, controller.lastP99)
@@ -1,6 +1,7 @@
 import sys
 import os
 import pwd
+import time
 
 from os.path import abspath, basename, dirname, join
 try:
@@ -14,6 +15,8 @@ except:
   import pickle
   USING_CPICKLE = False
 
+from itertools import izip
+from threading import Lock
 from twisted.python.util import initgroups
 from twisted.scripts.twistd import runApp
 from twisted.scripts._twistd_unix import daemonize
@@ -166,3 +169,227 @@ def get_unpickler(insecure=False):
     return pickle
   else:
     return SafeUnpickler
+
+
+class TokenBucket(object):
+  """A token bucket rate limiter holding up to capacity tokens, which refills
+  at fillRate tokens per second. It may be shared between threads."""
+  def __init__(self, capacity, fillRate):
+    self.lock = Lock()
+    self.capacity = float(capacity)
+    self.fillRate = float(fillRate)
+    self._tokens = self.capacity
+    self.timestamp = time.time()
+
+  def setRate(self, capacity, fillRate):
+    "Changes the limits without refilling the bucket"
+    try:
+      self.lock.acquire()
+      self._refill()
+      self.capacity = float(capacity)
+      self.fillRate = float(fillRate)
+      self._tokens = min(self._tokens, self.capacity)
+    finally:
+      self.lock.release()
+
+  @property
+  def tokens(self):
+    try:
+      self.lock.acquire()
+      self._refill()
+      return self._tokens
+    finally:
+      self.lock.release()
+
+  def _refill(self):
+    now = time.time()
+    if self.fillRate == float('inf'):
+      self._tokens = self.capacity
+    else:
+      self._tokens = min(self.capacity,
+                         self._tokens + (now - self.timestamp) * self.fillRate)
+    self.timestamp = now
+
+  def drain(self, cost):
+    """Takes cost tokens from the bucket if it holds that many and returns
+    True, otherwise leaves the bucket alone and returns False."""
+    try:
+      self.lock.acquire()
+      self._refill()
+      if cost > self._tokens:
+        return False
+      self._tokens -= cost
+      return True
+    finally:
+      self.lock.release()
+
+  def throttle(self, cost):
+    """Takes cost tokens from the bucket, sleeping until they have been
+    refilled if it runs into debt. Returns the number of seconds slept. A
+    fill rate of 0, like inf, sets no limit."""
+    try:
+      self.lock.acquire()
+      if not self.fillRate or self.fillRate == float('inf'):
+        return 0.0
+      self._refill()
+      self._tokens -= cost
+      if self._tokens >= 0:
+        return 0.0
+      delay = -self._tokens / self.fillRate
+    finally:
+      self.lock.release()
+
+    # Sleep outside of the lock, other threads just queue up more debt
+    time.sleep(delay)
+    return delay
+
+
+class LRUCache(object):
+  """A mapping holding up to maxSize items, which evicts the least recently
+  used one to make room for a new one, passing it to onEvict(key, value) if
+  given. It may be shared between threads."""
+  # Items are kept in a circular doubly linked list of [prev, next, key, value]
+  # links, ordered from least to most recently used after the root link.
+  PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+  def __init__(self, maxSize, onEvict=None):
+    self.lock = Lock()
+    self.maxSize = int(maxSize)
+    self.onEvict = onEvict
+    self.clear()
+
+  def clear(self):
+    try:
+      self.lock.acquire()
+      self.links = {}
+      self.root = []
+      self.root[:] = [self.root, self.root, None, None]
+    finally:
+      self.lock.release()
+
+  def __len__(self):
+    return len(self.links)
+
+  def __contains__(self, key):
+    return key in self.links
+
+  def _append(self, link):
+    last = self.root[self.PREV]
+    link[self.PREV] = last
+    link[self.NEXT] = self.root
+    last[self.NEXT] = self.root[self.PREV] = link
+
+  def _unlink(self, link):
+    link[self.PREV][self.NEXT] = link[self.NEXT]
+    link[self.NEXT][self.PREV] = link[self.PREV]
+
+  def get(self, key, default=None):
+    try:
+      self.lock.acquire()
+      link = self.links.get(key)
+      if link is None:
+        return default
+      self._unlink(link)
+      self._append(link)
+      return link[self.VALUE]
+    finally:
+      self.lock.release()
+
+  def pop(self, key, default=None):
+    try:
+      self.lock.acquire()
+      link = self.links.pop(key, None)
+      if link is None:
+        return default
+      self._unlink(link)
+      return link[self.VALUE]
+    finally:
+      self.lock.release()
+
+  def put(self, key, value):
+    evicted = None
+    try:
+      self.lock.acquire()
+      link = self.links.get(key)
+      if link is not None:
+        self._unlink(link)
+      elif len(self.links) >= self.maxSize:
+        if not self.maxSize:
+          return
+        evicted = self.root[self.NEXT]
+        self._unlink(evicted)
+        del self.links[evicted[self.KEY]]
+      link = [None, None, key, value]
+      self.links[key] = link
+      self._append(link)
+    finally:
+      self.lock.release()
+
+    if evicted is not None and self.onEvict is not None:
+      self.onEvict(evicted[self.KEY], evicted[self.VALUE])
+
+  def items(self):
+    "Returns the (key, value) items, least recently used first"
+    try:
+      self.lock.acquire()
+      items = []
+      link = self.root[self.NEXT]
+      while link is not self.root:
+        items.append((link[self.KEY], link[self.VALUE]))
+        link = link[self.NEXT]
+      return items
+    finally:
+      self.lock.release()
+
+
+class InternTable(object):
+  """Maps strings to a single instance of each, up to maxSize of them, so
+  that the equal strings received over and over share one object, and the
+  dicts they are looked up in compare them by identity. Past maxSize,
+  arbitrary strings are evicted, and those still in use are soon back.
+
+  It counts the strings found, those added, and how many bytes the
+  duplicates released in favor of the instances found took, until
+  takeStats() is called. A maxSize of 0 disables it."""
+  STRING_OVERHEAD = sys.getsizeof('')
+
+  def __init__(self, maxSize=0):
+    self.strings = {}
+    self.configure(maxSize)
+
+  def configure(self, maxSize):
+    self.maxSize = int(maxSize)
+    self.strings.clear()
+    self.hits = self.misses = self.bytesSaved = 0
+
+  def __len__(self):
+    return len(self.strings)
+
+  def intern(self, string):
+    return self.internAll([(string, None)])[0][0]
+
+  def internAll(self, items):
+    "Returns the list of (string, value) items with their strings interned"
+    strings = self.strings
+    size = len(strings)
+    setdefault = strings.setdefault
+    interned = [(setdefault(string, string), value) for (string, value) in items]
+
+    misses = len(strings) - size
+    hits = len(items) - misses
+    self.hits += hits
+    self.misses += misses
+    if hits:
+      # Only the strings that were not the instance already count
+      duplicates = [string for ((string, value), (held, heldValue)) in izip(items, interned)
+                    if held is not string]
+      self.bytesSaved += len(duplicates) * self.STRING_OVERHEAD + sum(map(len, duplicates))
+    for i in xrange(len(strings) - self.maxSize):
+      strings.popitem()
+    return interned
+
+  def takeStats(self):
+    "Returns and resets the (hits, misses, bytesSaved) counts"
+    stats = (self.hits, self.misses, self.bytesSaved)
+    self.hits = self.misses = self.bytesSaved = 0
+    return stats
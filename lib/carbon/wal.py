@@ -0,0 +1,281 @@
+import os
+import time
+import zlib
+import errno
+import struct
+from os.path import join
+from threading import Lock
+
+from carbon.util import pickle
+from carbon import log
+
+
+class WriteAheadLog(object):
+  """Logs the datapoints stored into the MetricCache to segment files in
+  directory, so that those not yet written to disk can be stored again after
+  a crash.
+
+  Each CacheShard logs to a WriteAheadLogShard of its own, which buffers its
+  datapoints and references the segment the oldest cached one of each of its
+  metrics was logged in, so that shards do not contend for a lock of the log
+  for every datapoint. flush() writes the buffers as a single checksummed
+  frame to the current segment, rolling over to a new one past segmentSize
+  bytes. A segment is deleted once neither a metric nor a popped queue that
+  is being written references it or an older segment. The MetricCache tells
+  the log when a metric's queue is popped or put back, and the writer when
+  popped datapoints no longer need replaying."""
+  HEADER = struct.Struct('!LL')
+  EXTENSION = '.wal'
+
+  def __init__(self, directory, segmentSize=64 * 1024 * 1024, fsyncInterval=0):
+    self.directory = directory
+    self.segmentSize = segmentSize
+    self.fsyncInterval = fsyncInterval
+    self.lock = Lock()
+    self.flushLock = Lock()
+    self.shards = []
+    self.inflight = {} # metric -> oldest segment holding its popped points
+    self.references = {} # segment -> number of popped queues referencing it
+    self.lastSync = 0
+    self.fh = None
+    self.replaying = None # the segment being replayed
+
+    try:
+      os.makedirs(directory, 0755)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self.segments = sorted([int(name[:-len(self.EXTENSION)])
+                            for name in os.listdir(directory)
+                            if name.endswith(self.EXTENSION)])
+    if self.segments:
+      self.segment = self.segments[-1] + 1
+    else:
+      self.segment = 0
+    self.segments.append(self.segment)
+
+  def _path(self, segment):
+    return join(self.directory, '%020d%s' % (segment, self.EXTENSION))
+
+  @property
+  def size(self):
+    size = 0
+    for segment in self.segments:
+      try:
+        size += os.path.getsize(self._path(segment))
+      except OSError:
+        pass
+    return size
+
+  def shard(self):
+    "Returns a new WriteAheadLogShard, for a CacheShard to log to"
+    shard = WriteAheadLogShard(self)
+    self.shards.append(shard)
+    return shard
+
+  def replay(self, store):
+    """Calls store(metric, datapoint) for every datapoint left in the
+    segments of a previous process, which are kept until they are written"""
+    for segment in self.segments[:-1]:
+      path = self._path(segment)
+      fh = open(path, 'rb')
+      try:
+        count = 0
+        while True:
+          header = fh.read(self.HEADER.size)
+          if len(header) < self.HEADER.size:
+            break
+          (length, checksum) = self.HEADER.unpack(header)
+          data = fh.read(length)
+          if len(data) < length or zlib.crc32(data) & 0xffffffff != checksum:
+            log.msg("Ignoring the torn end of %s" % path)
+            break
+          # store() calls back into append(), which references the segment
+          # being replayed instead of logging the datapoints again
+          self.replaying = segment
+          for (metric, timestamp, value) in pickle.loads(data):
+            store(metric, (timestamp, value))
+            count += 1
+      finally:
+        self.replaying = None
+        fh.close()
+      log.msg("Replayed %d datapoints from %s" % (count, path))
+    self._truncate()
+
+  def _popped(self, metric, segment):
+    """The queue of metric, whose oldest datapoint was logged in segment, is
+    being written. Called by its shard, holding the shard's lock."""
+    try:
+      self.lock.acquire()
+      # Popped again before the previous queue was written, one inflight
+      # reference holding on to the older segment covers both
+      older = self.inflight.get(metric)
+      if older is not None and older <= segment:
+        return
+      if older is not None:
+        self._dereference(older)
+      self.inflight[metric] = segment
+      self.references[segment] = self.references.get(segment, 0) + 1
+    finally:
+      self.lock.release()
+
+  def _dereference(self, segment):
+    self.references[segment] -= 1
+    if not self.references[segment]:
+      del self.references[segment]
+
+  def _takeInflight(self, metric):
+    "Returns the segment the popped queue of metric references, or None"
+    try:
+      self.lock.acquire()
+      segment = self.inflight.pop(metric, None)
+      if segment is not None:
+        self._dereference(segment)
+      return segment
+    finally:
+      self.lock.release()
+
+  def written(self, metric):
+    """The popped queue of metric no longer needs replaying, whether it was
+    written or given up on"""
+    self._takeInflight(metric)
+
+  def flush(self):
+    "Writes the buffered datapoints to the current segment"
+    try:
+      self.flushLock.acquire()
+      records = []
+      for shard in self.shards:
+        records.extend(shard.takeBuffer())
+
+      if records:
+        if self.fh is None:
+          self.fh = open(self._path(self.segment), 'ab')
+        data = pickle.dumps(records, 2)
+        self.fh.write(self.HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self.fh.write(data)
+        self.fh.flush()
+        if self.fsyncInterval >= 0 and time.time() - self.lastSync >= self.fsyncInterval:
+          os.fsync(self.fh.fileno())
+          self.lastSync = time.time()
+
+        if self.fh.tell() >= self.segmentSize:
+          self.fh.close()
+          self.fh = None
+          try:
+            self.lock.acquire()
+            self.segment += 1
+            self.segments.append(self.segment)
+          finally:
+            self.lock.release()
+    finally:
+      self.flushLock.release()
+    self._truncate()
+
+  def _truncate(self):
+    "Deletes the segments that are no longer referenced, oldest first"
+    # References move between the shards and the log under the lock of their
+    # shard, so every lock is held to see them all, those of the shards first
+    shards = self.shards[:]
+    for shard in shards:
+      shard.lock.acquire()
+    try:
+      self.lock.acquire()
+      try:
+        referenced = set(self.references)
+        for shard in shards:
+          referenced.update(shard.references)
+        deletable = []
+        while self.segments[0] != self.segment and self.segments[0] not in referenced:
+          deletable.append(self.segments.pop(0))
+      finally:
+        self.lock.release()
+    finally:
+      for shard in shards:
+        shard.lock.release()
+
+    for segment in deletable:
+      try:
+        os.remove(self._path(segment))
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+
+  def close(self):
+    self.flush()
+    if self.fh is not None:
+      self.fh.close()
+      self.fh = None
+
+
+class WriteAheadLogShard(object):
+  """The part of a WriteAheadLog a CacheShard logs to, holding the lock of
+  the CacheShard: its buffer of datapoints, and the segment the oldest
+  cached datapoint of each of its metrics was logged in."""
+  def __init__(self, wal):
+    self.wal = wal
+    self.lock = Lock()
+    self.buffer = []
+    self.firstSegment = {} # metric -> oldest segment holding its cached points
+    self.references = {} # segment -> number of metrics referencing it
+
+  def _reference(self, metric, segment):
+    self.firstSegment[metric] = segment
+    self.references[segment] = self.references.get(segment, 0) + 1
+
+  def _dereference(self, metric):
+    segment = self.firstSegment.pop(metric)
+    self.references[segment] -= 1
+    if not self.references[segment]:
+      del self.references[segment]
+    return segment
+
+  def append(self, metric, datapoint):
+    try:
+      self.lock.acquire()
+      replaying = self.wal.replaying
+      if replaying is not None:
+        if metric not in self.firstSegment:
+          self._reference(metric, replaying)
+        return
+      if metric not in self.firstSegment:
+        # The datapoint may land in a later segment, holding on to an extra
+        # segment is harmless.
+        self._reference(metric, self.wal.segment)
+      self.buffer.append((metric, datapoint[0], datapoint[1]))
+    finally:
+      self.lock.release()
+
+  def takeBuffer(self):
+    try:
+      self.lock.acquire()
+      records, self.buffer = self.buffer, []
+      return records
+    finally:
+      self.lock.release()
+
+  def popped(self, metric):
+    "The queue of metric was taken out of the cache"
+    try:
+      self.lock.acquire()
+      if metric in self.firstSegment:
+        self.wal._popped(metric, self.firstSegment[metric])
+        self._dereference(metric)
+    finally:
+      self.lock.release()
+
+  def unpopped(self, metric):
+    "The queue of metric was put back into the cache"
+    try:
+      self.lock.acquire()
+      segment = self.wal._takeInflight(metric)
+      if segment is None:
+        return
+      newer = self.firstSegment.get(metric)
+      if newer is None or segment < newer:
+        if newer is not None:
+          self._dereference(metric)
+        self._reference(metric, segment)
+    finally:
+      self.lock.release()
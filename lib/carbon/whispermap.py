@@ -0,0 +1,334 @@
+"""Updates whisper files mapped into memory.
+
+whisper.update_many() reads the base point of every archive it writes to,
+and the neighbouring points of every interval it propagates, with a seek()
+and a read() each, then seeks and writes again. Files with many archives
+thus cost dozens of system calls per update. Mapping the file turns all of
+these into memory accesses, which only fault once per page.
+
+MappedWhisperFile.update_many() writes the same bytes as whisper's, which
+the tests check, so files stay readable by whisper and graphite-web.
+VectorizedWhisperFile goes further for backfills and other updates of many
+points, doing their writes and propagation with NumPy, if installed."""
+import mmap
+import time
+import struct
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import whisper
+
+from carbon.filecache import FileCache
+
+
+metadataStruct = struct.Struct(whisper.metadataFormat)
+archiveInfoStruct = struct.Struct(whisper.archiveInfoFormat)
+pointStruct = struct.Struct(whisper.pointFormat)
+pointSize = pointStruct.size
+if numpy is not None:
+  pointDtype = numpy.dtype([('interval', '>u4'), ('value', '>f8')])
+
+
+class MappedWhisperFile(object):
+  "A whisper file mapped into memory, with its header parsed once"
+  def __init__(self, path):
+    self.name = path
+    self.fh = open(path, 'r+b')
+    try:
+      self.map = mmap.mmap(self.fh.fileno(), 0)
+      self.header = self._readHeader()
+    except:
+      self.close()
+      raise
+
+  def fileno(self):
+    return self.fh.fileno()
+
+  def close(self):
+    if getattr(self, 'map', None) is not None:
+      self.map.close()
+      self.map = None
+    self.fh.close()
+
+  def _readHeader(self):
+    "Parses the header like whisper.__readHeader()"
+    try:
+      (aggregationType, maxRetention, xff, archiveCount) = metadataStruct.unpack_from(self.map, 0)
+    except struct.error:
+      raise whisper.CorruptWhisperFile("Unable to read header", self.name)
+    if aggregationType not in whisper.aggregationTypeToMethod or not 0 <= xff <= 1:
+      raise whisper.CorruptWhisperFile("Unable to read header", self.name)
+
+    archives = []
+    for i in xrange(archiveCount):
+      try:
+        (offset, secondsPerPoint, points) = archiveInfoStruct.unpack_from(
+          self.map, metadataStruct.size + i * archiveInfoStruct.size)
+      except struct.error:
+        raise whisper.CorruptWhisperFile("Unable to read archive%d metadata" % i, self.name)
+      if offset + points * pointSize > len(self.map):
+        raise whisper.CorruptWhisperFile("Archive%d is truncated" % i, self.name)
+      archives.append({
+        'offset': offset,
+        'secondsPerPoint': secondsPerPoint,
+        'points': points,
+        'retention': secondsPerPoint * points,
+        'size': points * pointSize,
+      })
+
+    return {
+      'aggregationMethod': whisper.aggregationTypeToMethod[aggregationType],
+      'maxRetention': maxRetention,
+      'xFilesFactor': xff,
+      'archives': archives,
+    }
+
+  def update_many(self, points, now=None):
+    """Writes points, sorted newest first, like whisper.file_update_many().
+    Honours whisper.LOCK, and whisper.AUTOFLUSH with an msync()."""
+    if whisper.LOCK:
+      fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+    try:
+      if now is None:
+        now = int(time.time())
+      archives = iter(self.header['archives'])
+      currentArchive = next(archives)
+      currentPoints = []
+
+      for point in points:
+        age = now - point[0]
+        while currentArchive['retention'] < age:
+          if currentPoints:
+            currentPoints.reverse()
+            self._archiveUpdateMany(currentArchive, currentPoints)
+            currentPoints = []
+          currentArchive = next(archives, None)
+          if currentArchive is None:
+            break
+        if currentArchive is None:
+          break # Drop remaining points that don't fit in the database
+        currentPoints.append(point)
+
+      if currentArchive is not None and currentPoints:
+        currentPoints.reverse()
+        self._archiveUpdateMany(currentArchive, currentPoints)
+
+      if whisper.AUTOFLUSH:
+        self.map.flush()
+    finally:
+      if whisper.LOCK:
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+
+  def _archiveUpdateMany(self, archive, points):
+    step = archive['secondsPerPoint']
+    offset = archive['offset']
+    size = archive['size']
+    alignedPoints = [(timestamp - (timestamp % step), value)
+                     for (timestamp, value) in points]
+
+    (baseInterval, baseValue) = pointStruct.unpack_from(self.map, offset)
+    last = len(alignedPoints) - 1
+    for i in xrange(last + 1):
+      # Take the last point of a run with duplicate intervals
+      if i < last and alignedPoints[i][0] == alignedPoints[i + 1][0]:
+        continue
+      (interval, value) = alignedPoints[i]
+      if baseInterval == 0: # This file's first update
+        baseInterval = interval
+      pointOffset = offset + (((interval - baseInterval) // step) * pointSize) % size
+      pointStruct.pack_into(self.map, pointOffset, interval, value)
+
+    higher = archive
+    for lower in self.header['archives']:
+      if lower['secondsPerPoint'] <= step:
+        continue
+      lowerStep = lower['secondsPerPoint']
+      propagateFurther = False
+      for interval in set([timestamp - (timestamp % lowerStep)
+                           for (timestamp, value) in alignedPoints]):
+        if self._propagate(interval, higher, lower):
+          propagateFurther = True
+      if not propagateFurther:
+        break
+      higher = lower
+
+  def _propagate(self, timestamp, higher, lower):
+    "Aggregates the points of higher within the interval of lower at timestamp"
+    lowerIntervalStart = timestamp - (timestamp % lower['secondsPerPoint'])
+    step = higher['secondsPerPoint']
+    offset = higher['offset']
+    size = higher['size']
+
+    (higherBaseInterval, higherBaseValue) = pointStruct.unpack_from(self.map, offset)
+    if higherBaseInterval == 0:
+      firstOffset = 0
+    else:
+      firstOffset = (((lowerIntervalStart - higherBaseInterval) // step) * pointSize) % size
+
+    higherPoints = lower['secondsPerPoint'] // step
+    neighborValues = [None] * higherPoints
+    currentInterval = lowerIntervalStart
+    for i in xrange(higherPoints):
+      (pointTime, value) = pointStruct.unpack_from(
+        self.map, offset + (firstOffset + i * pointSize) % size)
+      if pointTime == currentInterval:
+        neighborValues[i] = value
+      currentInterval += step
+
+    knownValues = [v for v in neighborValues if v is not None]
+    if not knownValues:
+      return False
+    if float(len(knownValues)) / float(len(neighborValues)) < self.header['xFilesFactor']:
+      return False
+
+    aggregateValue = whisper.aggregate(self.header['aggregationMethod'], knownValues, neighborValues)
+    (lowerBaseInterval, lowerBaseValue) = pointStruct.unpack_from(self.map, lower['offset'])
+    if lowerBaseInterval == 0: # First propagated update to this lower archive
+      lowerOffset = lower['offset']
+    else:
+      lowerOffset = lower['offset'] + (((lowerIntervalStart - lowerBaseInterval) //
+                                        lower['secondsPerPoint']) * pointSize) % lower['size']
+    pointStruct.pack_into(self.map, lowerOffset, lowerIntervalStart, aggregateValue)
+    return True
+
+
+class VectorizedWhisperFile(MappedWhisperFile):
+  """A MappedWhisperFile viewing its archives as NumPy arrays, which updates
+  archives receiving at least minPoints points with array operations: the
+  points are scattered to their slots at once, and the intervals of each
+  lower archive they touch are gathered and aggregated as a matrix.
+
+  The same slots are written as by whisper, but sums and averages may differ
+  from whisper's in their last bits, as NumPy adds in a different order."""
+  minPoints = 64 # below which the scalar path is faster, see benchmark_whispermap.py
+
+  def __init__(self, path):
+    MappedWhisperFile.__init__(self, path)
+    self.views = {}
+    for archive in self.header['archives']:
+      self.views[archive['offset']] = numpy.frombuffer(
+        self.map, pointDtype, count=archive['points'], offset=archive['offset'])
+
+  def close(self):
+    # Views must not outlive the map
+    self.views = None
+    MappedWhisperFile.close(self)
+
+  def _archiveUpdateMany(self, archive, points):
+    if len(points) < self.minPoints:
+      return MappedWhisperFile._archiveUpdateMany(self, archive, points)
+
+    step = archive['secondsPerPoint']
+    view = self.views[archive['offset']]
+    timestamps = numpy.fromiter((timestamp for (timestamp, value) in points), numpy.int64, len(points))
+    values = numpy.fromiter((value for (timestamp, value) in points), numpy.float64, len(points))
+    intervals = timestamps - timestamps % step
+
+    # Take the last point of a run with duplicate intervals
+    keep = numpy.ones(len(intervals), bool)
+    keep[:-1] = intervals[:-1] != intervals[1:]
+    keptIntervals = intervals[keep]
+
+    baseInterval = int(view['interval'][0])
+    if baseInterval == 0: # This file's first update
+      baseInterval = int(keptIntervals[0])
+    slots = ((keptIntervals - baseInterval) // step) % archive['points']
+    view['interval'][slots] = keptIntervals
+    view['value'][slots] = values[keep]
+
+    higher = archive
+    for lower in self.header['archives']:
+      if lower['secondsPerPoint'] <= step:
+        continue
+      lowerStep = lower['secondsPerPoint']
+      # Built as a set like whisper does, so that a first propagation to a
+      # lower archive picks the same base interval
+      lowerIntervals = set((intervals - intervals % lowerStep).tolist())
+      if not self._propagateMany(numpy.array(list(lowerIntervals), numpy.int64), higher, lower):
+        break
+      higher = lower
+
+  def _propagateMany(self, lowerIntervals, higher, lower):
+    """Aggregates the points of higher within each of the lowerIntervals of
+    lower, and returns whether any of them was written"""
+    step = higher['secondsPerPoint']
+    lowerStep = lower['secondsPerPoint']
+    higherView = self.views[higher['offset']]
+    lowerView = self.views[lower['offset']]
+    higherPoints = lowerStep // step
+    neighbors = numpy.arange(higherPoints)
+
+    higherBaseInterval = int(higherView['interval'][0])
+    if higherBaseInterval == 0:
+      firstSlots = numpy.zeros(len(lowerIntervals), numpy.int64)
+    else:
+      firstSlots = (lowerIntervals - higherBaseInterval) // step
+    slots = (firstSlots[:, None] + neighbors) % higher['points']
+    known = higherView['interval'][slots] == lowerIntervals[:, None] + neighbors * step
+    values = higherView['value'][slots]
+
+    knownCounts = known.sum(axis=1)
+    propagate = (knownCounts > 0) & (knownCounts / float(higherPoints) >= self.header['xFilesFactor'])
+    if not propagate.any():
+      return False
+    lowerIntervals = lowerIntervals[propagate]
+    known = known[propagate]
+    values = values[propagate]
+    knownCounts = knownCounts[propagate]
+    rows = numpy.arange(len(lowerIntervals))
+
+    method = self.header['aggregationMethod']
+    if method in ('average', 'sum', 'avg_zero'):
+      sums = numpy.where(known, values, 0.0).sum(axis=1)
+      if method == 'average':
+        aggregates = sums / knownCounts
+      elif method == 'sum':
+        aggregates = sums
+      else:
+        aggregates = sums / float(higherPoints)
+    elif method == 'last':
+      aggregates = values[rows, higherPoints - 1 - known[:, ::-1].argmax(axis=1)]
+    elif method == 'max':
+      aggregates = numpy.where(known, values, -numpy.inf).max(axis=1)
+    elif method == 'min':
+      aggregates = numpy.where(known, values, numpy.inf).min(axis=1)
+    elif method == 'absmax':
+      aggregates = values[rows, numpy.where(known, numpy.abs(values), -1.0).argmax(axis=1)]
+    elif method == 'absmin':
+      aggregates = values[rows, numpy.where(known, numpy.abs(values), numpy.inf).argmin(axis=1)]
+    else:
+      raise whisper.InvalidAggregationMethod("Unrecognized aggregation method %s" % method)
+
+    lowerBaseInterval = int(lowerView['interval'][0])
+    if lowerBaseInterval == 0: # First propagated update to this lower archive
+      lowerBaseInterval = int(lowerIntervals[0])
+    lowerSlots = ((lowerIntervals - lowerBaseInterval) // lowerStep) % lower['points']
+    lowerView['interval'][lowerSlots] = lowerIntervals
+    lowerView['value'][lowerSlots] = aggregates
+    return True
+
+
+class MappedFileCache(FileCache):
+  """A FileCache holding its files mapped into memory, and updating them as
+  MappedWhisperFiles, or VectorizedWhisperFiles if vectorize is set. Written
+  pages are left for the kernel to write back, unless whisper.AUTOFLUSH is
+  set or the file is handed to a Syncer."""
+  def __init__(self, maxOpen, vectorize=False):
+    FileCache.__init__(self, maxOpen)
+    self.vectorize = vectorize
+
+  def _open(self, path):
+    if self.vectorize:
+      return VectorizedWhisperFile(path)
+    return MappedWhisperFile(path)
+
+  def _write(self, mapped, points):
+    mapped.update_many(points)
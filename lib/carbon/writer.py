@@ -14,157 +14,705 @@ limitations under the License."""
 
 
 import os
+import sys
 import time
-from os.path import exists, dirname
+import signal
+import traceback
+from os.path import exists, join
+from subprocess import Popen, PIPE
+from threading import Lock, Thread
+from Queue import Queue, Empty
 
-import whisper
 from carbon import state
 from carbon.cache import MetricCache
-from carbon.storage import getFilesystemPath, loadStorageSchemas,\
-    loadAggregationSchemas
+from carbon.database import loadDatabase
+from carbon.index import FileIndex
+from carbon.spill import SpillQueue
+from carbon.wal import WriteAheadLog
+from carbon.snapshot import saveCache
+from carbon.storage import loadStorageSchemas, loadAggregationSchemas
 from carbon.conf import settings
+from carbon.util import TokenBucket, LRUCache, pickle
 from carbon import log, events, instrumentation
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.task import LoopingCall
 from twisted.application.service import Service
 
 
-lastCreateInterval = 0
-createCount = 0
 schemas = loadStorageSchemas()
 agg_schemas = loadAggregationSchemas()
+schemaMatches = None # metric -> (storage schema, aggregation schema)
+schemaDefinitions = None
 CACHE_SIZE_LOW_WATERMARK = settings.MAX_CACHE_SIZE * 0.95
+SPILL_REPLAY_LIMIT = 1000 # metrics replayed per call, every 0.1 second
+CACHE_SNAPSHOT_PATH = join(settings.SNAPSHOT_DIR, 'cache.snapshot')
+
+# I/O budgets shared by all writer threads. Updates and bytes may burst up to
+# one second worth of their rate, creates up to one minute worth.
+updateBucket = TokenBucket(settings.MAX_UPDATES_PER_SECOND,
+                           settings.MAX_UPDATES_PER_SECOND)
+createBucket = TokenBucket(settings.MAX_CREATES_PER_MINUTE,
+                           settings.MAX_CREATES_PER_MINUTE / 60.0)
+bytesBucket = TokenBucket(settings.MAX_WRITE_BYTES_PER_SECOND,
+                          settings.MAX_WRITE_BYTES_PER_SECOND)
+
+database = loadDatabase(settings)
+
+
+
+class UpdateRateController(object):
+  """Adjusts the fill rate of the update token bucket to the fastest rate the
+  disks sustain. While the p99 update latency stays under latencyTarget and
+  the writers are being throttled, the rate is raised by a fixed step every
+  adjustment. When the p99 latency exceeds the target, the rate is halved."""
+  def __init__(self, bucket, minRate, maxRate, latencyTarget):
+    self.bucket = bucket
+    self.minRate = float(minRate)
+    # A rate of 0 sets no limit, like inf
+    self.maxRate = float(maxRate) or float('inf')
+    self.step = self.minRate
+    self.latencyTarget = float(latencyTarget)
+    # Guards what the writer threads report, which adjust() takes in the reactor
+    self.lock = Lock()
+    self.updateTimes = []
+    self.throttled = 0.0
+    self.lastP99 = None
+
+    if self.maxRate == float('inf'):
+      self.rate = self.minRate
+    else:
+      self.rate = self.maxRate
+    self.bucket.setRate(self.rate, self.rate)
+
+  def observe(self, updateTime):
+    try:
+      self.lock.acquire()
+      self.updateTimes.append(updateTime)
+    finally:
+      self.lock.release()
 
+  def addThrottled(self, seconds):
+    try:
+      self.lock.acquire()
+      self.throttled += seconds
+    finally:
+      self.lock.release()
 
-def optimalWriteOrder():
+  def adjust(self):
+    try:
+      self.lock.acquire()
+      updateTimes, self.updateTimes = self.updateTimes, []
+      throttled, self.throttled = self.throttled, 0.0
+    finally:
+      self.lock.release()
+    if not updateTimes:
+      return
+
+    updateTimes.sort()
+    self.lastP99 = updateTimes[int(len(updateTimes) * 0.99)]
+
+    if self.lastP99 > self.latencyTarget:
+      rate = max(self.minRate, self.rate / 2)
+    elif throttled:
+      rate = min(self.maxRate, self.rate + self.step)
+    else:
+      return
+
+    if rate != self.rate:
+      log.debug("Adjusting update rate from %.1f to %.1f (p99 update time %.5f seconds)" %
+                (self.rate, rate, self.lastP99))
+      self.rate = rate
+      self.bucket.setRate(rate, rate)
+
+
+if settings.ADAPTIVE_UPDATE_RATE:
+  rateController = UpdateRateController(updateBucket,
+                                        settings.MIN_UPDATES_PER_SECOND,
+                                        settings.MAX_UPDATES_PER_SECOND,
+                                        settings.UPDATE_LATENCY_TARGET)
+else:
+  rateController = None
+
+if settings.USE_FILE_INDEX and database.extension:
+  fileIndex = FileIndex(settings.LOCAL_DATA_DIR, database.extension,
+                        threads=settings.FILE_INDEX_SCAN_THREADS)
+else:
+  fileIndex = None
+
+# Datapoints of new metrics beyond the create budget, see replaySpilled
+if settings.MAX_SPILL_SIZE:
+  spill = SpillQueue(settings.SPILL_DIR, settings.MAX_SPILL_SIZE)
+else:
+  spill = None
+
+# Handed to the MetricCache by carbon.service
+if settings.ENABLE_WAL:
+  wal = WriteAheadLog(settings.WAL_DIR, settings.WAL_SEGMENT_SIZE,
+                      settings.WAL_FSYNC_INTERVAL)
+else:
+  wal = None
+
+invalidations = {} # writer -> metrics to invalidate before its next write
+
+# Metrics held in the MetricCache until a create thread has created their file
+createQueue = Queue()
+pendingCreates = set()
+pendingCreatesLock = Lock()
+# Metrics replayed from the spill, whose create was paid for when replayed
+replayedCreates = set()
+replayedCreatesLock = Lock()
+
+# The cache shards owned by each writer thread, see WriterService
+writerShards = []
+
+
+def updateSchemaMatches():
+  """Forgets the schemas matched so far if the definition of any schema
+  changed since they were matched"""
+  global schemaMatches, schemaDefinitions
+  definitions = ([schema.definition() for schema in schemas],
+                 [schema.definition() for schema in agg_schemas])
+  if definitions != schemaDefinitions:
+    schemaDefinitions = definitions
+    # Replaced rather than cleared, so a writer thread that was matching
+    # against the former schemas cannot slip its result into the new cache
+    schemaMatches = LRUCache(settings.SCHEMA_MATCH_CACHE_SIZE)
+
+updateSchemaMatches()
+
+
+def findSchema(schemaList, metric):
+  for schema in schemaList:
+    if schema.matches(metric):
+      return schema
+
+
+def getSchemas(metric):
+  """Returns the (storage schema, aggregation schema) that metric matches,
+  either of which is None when no schema matches"""
+  matches = schemaMatches
+  matched = matches.get(metric)
+  if matched is None:
+    matched = (findSchema(schemas, metric), findSchema(agg_schemas, metric))
+    matches.put(metric, matched)
+  return matched
+
+
+def getStorageResolution(metric):
+  """Returns the finest secondsPerPoint of the storage schema matching metric,
+  or None when it matches none"""
+  schema = getSchemas(metric)[0]
+  if schema is not None:
+    return min([archive.secondsPerPoint for archive in schema.archives])
+
+
+def optimalWriteOrder(shards=None):
   """Generates metrics with the most cached values first and applies a soft
   rate limit on new metrics"""
-  global lastCreateInterval
-  global createCount
-  metrics = MetricCache.counts()
-
-  t = time.time()
-  metrics.sort(key=lambda item: item[1], reverse=True)  # by queue size, descending
-  log.debug("Sorted %d cache queues in %.6f seconds" % (len(metrics),
-                                                        time.time() - t))
-
-  for metric, queueSize in metrics:
+  while True:
     if state.cacheTooFull and MetricCache.size < CACHE_SIZE_LOW_WATERMARK:
       events.cacheSpaceAvailable()
 
-    dbFilePath = getFilesystemPath(metric)
-    dbFileExists = exists(dbFilePath)
+    # The cache keeps its queues indexed by length, so this is O(1) rather
+    # than a sort of every queue on each pass.
+    fullest = MetricCache.popFullest(shards)
+    if fullest is None:
+      break
+    (metric, datapoints) = fullest
+
+    dbFilePath = database.getFilesystemPath(metric)
+    if fileIndex is not None:
+      dbFileExists = fileIndex.exists(dbFilePath)
+      # Until the index is ready, a miss was already looked for on disk.
+      # After that, files created outside carbon are only indexed by the
+      # next rebuild.
+      if not dbFileExists and fileIndex.ready and database.exists(metric):
+        fileIndex.add(dbFilePath)
+        dbFileExists = True
+    else:
+      dbFileExists = database.exists(metric)
+
+    if dbFileExists and replayedCreates:
+      # Created since it was spilled, its create is not needed anymore
+      takeReplayedCreate(metric)
 
     if not dbFileExists:
-      createCount += 1
-      now = time.time()
+      if settings.CREATE_THREADS:
+        # Keep the datapoints cached while the file is created in the background
+        MetricCache.hold(metric, datapoints)
+        requestCreate(metric)
+        continue
+      elif not drainCreate(metric):
+        # dropping queued up datapoints for new metrics prevents filling up the entire cache
+        # when a bunch of new metrics are received. They are set aside on disk if possible.
+        if spill is None or not spill.append(metric, datapoints):
+          instrumentation.increment('spill.dropped', len(datapoints))
+        if wal is not None:
+          wal.written(metric)
+        continue
 
-      if now - lastCreateInterval >= 60:
-        lastCreateInterval = now
-        createCount = 1
+    yield (metric, datapoints, dbFilePath, dbFileExists)
 
-      elif createCount >= settings.MAX_CREATES_PER_MINUTE:
-        # dropping queued up datapoints for new metrics prevents filling up the entire cache
-        # when a bunch of new metrics are received.
-        try:
-          MetricCache.pop(metric)
-        except KeyError:
-          pass
 
-        continue
+def getCreateArgs(metric):
+  """Returns the (archiveConfig, xFilesFactor, aggregationMethod) that a new
+  metric is created with in the database"""
+  archiveConfig = None
+  xFilesFactor, aggregationMethod = None, None
+  schema, aggSchema = getSchemas(metric)
 
-    try:  # metrics can momentarily disappear from the MetricCache due to the implementation of MetricCache.store()
-      datapoints = MetricCache.pop(metric)
-    except KeyError:
-      log.msg("MetricCache contention, skipping %s update for now" % metric)
-      continue  # we simply move on to the next metric when this race condition occurs
+  if schema is not None:
+    log.creates('new metric %s matched schema %s' % (metric, schema.name))
+    archiveConfig = [archive.getTuple() for archive in schema.archives]
 
-    yield (metric, datapoints, dbFilePath, dbFileExists)
+  if aggSchema is not None:
+    log.creates('new metric %s matched aggregation schema %s' % (metric, aggSchema.name))
+    xFilesFactor, aggregationMethod = aggSchema.archives
 
+  if not archiveConfig:
+    raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
 
-def writeCachedDataPoints():
-  "Write datapoints until the MetricCache is completely empty"
-  updates = 0
-  lastSecond = 0
+  return (archiveConfig, xFilesFactor, aggregationMethod)
 
-  while MetricCache:
-    dataWritten = False
 
-    for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder():
-      dataWritten = True
+def writeDatapoints(metric, datapoints, dbFilePath, createArgs):
+  """Creates metric in the database when createArgs are given, then writes
+  the datapoints to it. Returns a (metric, dbFilePath, created, pointCount,
+  updateTime, error) tuple where error is a formatted traceback, or None if
+  the write succeeded."""
+  created = False
+  try:
+    if createArgs is not None:
+      database.create(metric, *createArgs)
+      created = True
 
-      if not dbFileExists:
-        archiveConfig = None
-        xFilesFactor, aggregationMethod = None, None
+    t1 = time.time()
+    database.update_many(metric, datapoints)
+    updateTime = time.time() - t1
+  except:
+    return (metric, dbFilePath, created, len(datapoints), None, traceback.format_exc())
 
-        for schema in schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched schema %s' % (metric, schema.name))
-            archiveConfig = [archive.getTuple() for archive in schema.archives]
-            break
+  return (metric, dbFilePath, created, len(datapoints), updateTime, None)
 
-        for schema in agg_schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
-            xFilesFactor, aggregationMethod = schema.archives
-            break
 
-        if not archiveConfig:
-          raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+def commitBatches(writes, conn=None, worker=0):
+  """Commits the writes generated by optimalWriteOrder, generating the list
+  of writeDatapoints results for each batch. Writes are done one at a time in
+  this thread, or sent in batches of WRITER_PROCESS_BATCH_SIZE to the writer
+  process at the other end of conn. Either way the metrics invalidated for
+  the worker since are invalidated in the database first."""
+  if conn is None:
+    batchSize = 1
+  else:
+    batchSize = settings.WRITER_PROCESS_BATCH_SIZE
+  batch = []
 
-        dbDir = dirname(dbFilePath)
+  try:
+    for (metric, datapoints, dbFilePath, dbFileExists) in writes:
+      if dbFileExists:
+        createArgs = None
+      else:
         try:
-            os.makedirs(dbDir, 0755)
-        except OSError as e:
-            log.err("%s" % e)
+          createArgs = getCreateArgs(metric)
+        except:
+          # Reported like a failed write, without failing the batch
+          yield [(metric, dbFilePath, False, len(datapoints), None, traceback.format_exc())]
+          continue
         log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
-                    (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
-        whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
-        instrumentation.increment('creates')
+                    ((dbFilePath,) + createArgs))
+      batch.append( (metric, datapoints, dbFilePath, createArgs) )
+
+      if len(batch) >= batchSize:
+        throttle(batch)
+        results = commit(batch, conn, takeInvalidations(worker))
+        batch = []
+        yield results
+
+    if batch:
+      throttle(batch)
+      results = commit(batch, conn, takeInvalidations(worker))
+      batch = []
+      yield results
+  except:
+    # Typically the writer process died, the popped datapoints of the batch
+    # are written again once it is restarted
+    if batch:
+      log.msg("Putting %d uncommitted metrics back into the cache" % len(batch))
+      putBack(batch)
+    raise
+
+
+def putBack(batch):
+  "Returns the datapoints of an uncommitted batch to the MetricCache"
+  for (metric, datapoints, dbFilePath, createArgs) in batch:
+    MetricCache.hold(metric, datapoints)
+    MetricCache.release(metric)
+
+
+def throttle(batch):
+  """Waits until the update and write bandwidth budgets allow the batch to be
+  committed. Bytes written are estimated from the datapoints being written
+  plus the full size of any file being created."""
+  writeBytes = 0
+  for (metric, datapoints, dbFilePath, createArgs) in batch:
+    if createArgs is None:
+      writeBytes += database.estimateWriteSize(len(datapoints))
+    else:
+      writeBytes += database.estimateWriteSize(len(datapoints), createArgs[0])
+
+  throttled = updateBucket.throttle(len(batch))
+  if throttled:
+    instrumentation.increment('throttle.updates', throttled)
+    if rateController:
+      rateController.addThrottled(throttled)
+  throttled = bytesBucket.throttle(writeBytes)
+  if throttled:
+    instrumentation.increment('throttle.bytes', throttled)
+
+
+def commit(batch, conn=None, invalidated=()):
+  if conn is None:
+    for metric in invalidated:
+      database.invalidate(metric)
+    return [writeDatapoints(*write) for write in batch]
+  conn.send((invalidated, batch))
+  return conn.recv()
+
+
+def invalidateMetric(metric):
+  """Has every writer invalidate metric in the database before its next
+  write, as it was changed behind their back"""
+  for pending in invalidations.values():
+    pending.append(metric)
+
+
+def takeInvalidations(worker):
+  pending = invalidations.get(worker)
+  if not pending:
+    return ()
+  taken = pending[:]
+  # invalidateMetric() may append concurrently
+  del pending[:len(taken)]
+  return taken
+
+
+def writeCachedDataPoints(shards=None, worker=0, conn=None):
+  """Write datapoints until the given shards of the MetricCache, or all of
+  it, are completely empty"""
+  if shards is None:
+    shards = MetricCache.shards
+  # Broken down per writer only when there are several
+  if settings.WRITER_THREADS > 1:
+    updateTimesStat = 'writer.%d.updateTimes' % worker
+  else:
+    updateTimesStat = None
+
+  while any(shards):
+    dataWritten = False
+
+    for results in commitBatches(optimalWriteOrder(shards), conn, worker):
+      dataWritten = True
+
+      for (metric, dbFilePath, created, pointCount, updateTime, error) in results:
+        if wal is not None:
+          wal.written(metric)
+
+        if created:
+          instrumentation.increment('creates')
+          if fileIndex is not None:
+            fileIndex.add(dbFilePath)
+
+        if error is not None:
+          log.msg("Error writing to %s\n%s" % (dbFilePath, error))
+          instrumentation.increment('errors')
+          if fileIndex is not None:
+            # The file may have been removed behind our back
+            fileIndex.forget(dbFilePath)
+          continue
 
-      try:
-        t1 = time.time()
-        whisper.update_many(dbFilePath, datapoints)
-        t2 = time.time()
-        updateTime = t2 - t1
-      except:
-        log.msg("Error writing to %s" % (dbFilePath))
-        log.err()
-        instrumentation.increment('errors')
-      else:
-        pointCount = len(datapoints)
         instrumentation.increment('committedPoints', pointCount)
         instrumentation.append('updateTimes', updateTime)
+        if updateTimesStat is not None:
+          instrumentation.append(updateTimesStat, updateTime)
+        if rateController:
+          rateController.observe(updateTime)
 
         if settings.LOG_UPDATES:
           log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
 
-        # Rate limit update operations
-        thisSecond = int(t2)
-
-        if thisSecond != lastSecond:
-          lastSecond = thisSecond
-          updates = 0
-        else:
-          updates += 1
-          if updates >= settings.MAX_UPDATES_PER_SECOND:
-            time.sleep(int(t2 + 1) - t2)
-
     # Avoid churning CPU when only new metrics are in the cache
     if not dataWritten:
       time.sleep(0.1)
 
 
-def writeForever():
+# Run by the writer processes, with the daemon's settings pickled on stdin,
+# replying on stdout while logging to stderr
+WRITER_SCRIPT = """
+import os
+import sys
+replies = os.fdopen(os.dup(1), 'wb')
+os.dup2(2, 1)
+from carbon.util import pickle
+from carbon.conf import settings
+settings.update(pickle.load(sys.stdin))
+from carbon import log
+log.logToStdout()
+from carbon.writer import writerProcess
+writerProcess(sys.stdin, replies)
+"""
+
+
+def writerProcess(requests, replies):
+  """Main loop of a writer process, which commits the batches its writer
+  thread pickles on requests and pickles their results on replies"""
+  # Shutdown is driven by the parent, see writeForever
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  database.open()
+
+  try:
+    while True:
+      try:
+        message = pickle.load(requests)
+      except EOFError:
+        # The parent went away without telling us
+        return
+      if message is None:
+        return
+
+      (invalidated, batch) = message
+      pickle.dump(commit(batch, invalidated=invalidated), replies, -1)
+      replies.flush()
+  finally:
+    database.close()
+
+
+class WriterProcess(object):
+  """A writer process, started as a fresh interpreter running writerProcess()
+  rather than forked from the threads, sockets and locks of the daemon.
+  Batches are sent to it and their results received with send() and recv(),
+  and what it logs is logged by the daemon."""
+  def __init__(self, worker):
+    self.worker = worker
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    self.process = Popen([sys.executable, '-c', WRITER_SCRIPT],
+                         stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True, env=env)
+    self.pid = self.process.pid
+    self.send(dict(settings))
+    relay = Thread(target=self.relayOutput, name='carbon-writer-%d-output' % worker)
+    relay.setDaemon(True)
+    relay.start()
+
+  def relayOutput(self):
+    for line in iter(self.process.stderr.readline, ''):
+      log.msg("[writer process %d] %s" % (self.worker, line.rstrip('\n')))
+
+  def send(self, message):
+    pickle.dump(message, self.process.stdin, -1)
+    self.process.stdin.flush()
+
+  def recv(self):
+    return pickle.load(self.process.stdout)
+
+  def is_alive(self):
+    return self.process.poll() is None
+
+  def join(self):
+    self.process.wait()
+
+
+def startWriterProcess(worker):
+  process = WriterProcess(worker)
+  log.msg("Started writer process %d with pid %d" % (worker, process.pid))
+  return process
+
+
+def writeForever(shards=None, worker=0):
+  process = None
+  invalidations[worker] = []
+
   while reactor.running:
     try:
-      writeCachedDataPoints()
+      if settings.USE_WRITER_PROCESSES and not (process and process.is_alive()):
+        process = startWriterProcess(worker)
+      writeCachedDataPoints(shards, worker, process)
     except:
       log.err()
 
     time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
 
+  if process is not None and process.is_alive():
+    process.send(None)
+    process.join()
+
+
+def takeReplayedCreate(metric):
+  "Returns whether the create of metric was paid for when it was replayed"
+  try:
+    replayedCreatesLock.acquire()
+    if metric in replayedCreates:
+      replayedCreates.remove(metric)
+      return True
+    return False
+  finally:
+    replayedCreatesLock.release()
+
+
+def drainCreate(metric):
+  """Takes a token from the create budget for metric, unless one was taken
+  when it was replayed. Returns False when the budget is exhausted."""
+  return takeReplayedCreate(metric) or createBucket.drain(1)
+
+
+def requestCreate(metric):
+  try:
+    pendingCreatesLock.acquire()
+    if metric in pendingCreates:
+      return
+    pendingCreates.add(metric)
+  finally:
+    pendingCreatesLock.release()
+  createQueue.put(metric)
+
+
+def createHeldMetric(metric):
+  """Creates a metric held in the MetricCache in the database, then releases
+  it to the writers. Its datapoints are dropped if that fails."""
+  dbFilePath = database.getFilesystemPath(metric)
+  try:
+    try:
+      if not database.exists(metric):
+        createArgs = getCreateArgs(metric)
+        log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
+                    ((dbFilePath,) + createArgs))
+        database.create(metric, *createArgs)
+        instrumentation.increment('creates')
+      if fileIndex is not None:
+        fileIndex.add(dbFilePath)
+      MetricCache.release(metric)
+    except:
+      log.msg("Error creating %s" % dbFilePath)
+      log.err()
+      instrumentation.increment('errors')
+      instrumentation.increment('spill.dropped', len(MetricCache.pop(metric)))
+      if wal is not None:
+        wal.written(metric)
+  finally:
+    try:
+      pendingCreatesLock.acquire()
+      pendingCreates.discard(metric)
+    finally:
+      pendingCreatesLock.release()
+
+
+def dropPendingCreates():
+  try:
+    pendingCreatesLock.acquire()
+    metrics = list(pendingCreates)
+    pendingCreates.clear()
+  finally:
+    pendingCreatesLock.release()
+
+  spilled, dropped = 0, 0
+  for metric in metrics:
+    try:
+      datapoints = MetricCache.pop(metric)
+    except KeyError:
+      continue
+    if spill is not None and spill.append(metric, datapoints):
+      spilled += len(datapoints)
+    else:
+      dropped += len(datapoints)
+    if wal is not None:
+      wal.written(metric)
+  if dropped:
+    instrumentation.increment('spill.dropped', dropped)
+  if metrics:
+    log.msg("Spilled %d and dropped %d datapoints of %d metrics waiting for their file to be created" %
+            (spilled, dropped, len(metrics)))
+
+
+def createForever():
+  """Main loop of a create thread, creating files at no more than
+  MAX_CREATES_PER_MINUTE for the metrics the writer threads requested"""
+  while reactor.running:
+    try:
+      metric = createQueue.get(timeout=1)
+    except Empty:
+      continue
+
+    while reactor.running and not drainCreate(metric):
+      time.sleep(0.1)
+    if not reactor.running:
+      break
+
+    try:
+      createHeldMetric(metric)
+    except:
+      log.err()
+
+  # Creates still pending would hold their datapoints, and thus the writers,
+  # until they are done at MAX_CREATES_PER_MINUTE
+  dropPendingCreates()
+
+
+def readSpilled():
+  """Pops spilled records off the SpillQueue, for up to SPILL_REPLAY_LIMIT
+  metrics. Each takes its create from the budget, so that new metrics cannot
+  use it up and have replayed ones spilled again. Runs in a thread, as it
+  reads the spill from disk."""
+  # Leaves the creates already requested their share of the budget
+  replayable = min(createBucket.tokens - len(pendingCreates), SPILL_REPLAY_LIMIT)
+  records = []
+  while len(records) < replayable:
+    record = spill.pop()
+    if record is None:
+      break
+    records.append(record)
+    # The writers may have taken the last creates in the meantime
+    if not createBucket.drain(1):
+      break
+    try:
+      replayedCreatesLock.acquire()
+      replayedCreates.add(record[0])
+    finally:
+      replayedCreatesLock.release()
+  return records
+
+
+def storeSpilled(records):
+  "Stores the records read by readSpilled back into the MetricCache"
+  MetricCache.storeBatch([(metric, datapoint)
+                          for (metric, datapoints) in records
+                          for datapoint in datapoints])
+  if records:
+    instrumentation.increment('spill.replayed', len(records))
+
+
+def replaySpilled():
+  """Stores spilled datapoints back into the MetricCache, as the create
+  budget allows. Returns a Deferred firing once they are stored."""
+  if state.cacheTooFull:
+    return
+  d = threads.deferToThread(readSpilled)
+  d.addCallback(storeSpilled)
+  d.addErrback(log.err)
+  return d
+
+
+def flushForever():
+  "Main loop of the thread flushing the write-ahead log"
+  while reactor.running:
+    time.sleep(settings.WAL_FLUSH_INTERVAL)
+    try:
+      wal.flush()
+    except:
+      log.err()
+
+  # Whatever is still cached gets replayed at the next start
+  wal.close()
+
 
 def reloadStorageSchemas():
   global schemas
@@ -173,6 +721,7 @@ def reloadStorageSchemas():
   except:
     log.msg("Failed to reload storage schemas")
     log.err()
+  updateSchemaMatches()
 
 
 def reloadAggregationSchemas():
@@ -182,30 +731,94 @@ def reloadAggregationSchemas():
   except:
     log.msg("Failed to reload aggregation schemas")
     log.err()
+  updateSchemaMatches()
 
 
 def shutdownModifyUpdateSpeed():
     try:
         settings.MAX_UPDATES_PER_SECOND = settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN
+        if rateController:
+            rateController.maxRate = rateController.rate = settings.MAX_UPDATES_PER_SECOND
+        updateBucket.setRate(settings.MAX_UPDATES_PER_SECOND, settings.MAX_UPDATES_PER_SECOND)
         log.msg("Carbon shutting down.  Changed the update rate to: " + str(settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN))
     except KeyError:
         log.msg("Carbon shutting down.  Update rate not changed")
 
 
+def snapshotCache():
+  "Saves the cache for the next start instead of writing it out"
+  events.pauseReceivingMetrics()
+  try:
+    if not exists(settings.SNAPSHOT_DIR):
+      os.makedirs(settings.SNAPSHOT_DIR, 0755)
+    items = saveCache(MetricCache, CACHE_SNAPSHOT_PATH)
+  except:
+    log.msg("Failed to save a snapshot of the cache, its datapoints were kept in it")
+    log.err()
+    return
+
+  if wal is not None:
+    for (metric, datapoints) in items:
+      wal.written(metric)
+
+
 class WriterService(Service):
 
     def __init__(self):
         self.storage_reload_task = LoopingCall(reloadStorageSchemas)
         self.aggregation_reload_task = LoopingCall(reloadAggregationSchemas)
+        if rateController:
+            self.rate_control_task = LoopingCall(rateController.adjust)
+        else:
+            self.rate_control_task = None
+        if spill is not None:
+            self.spill_replay_task = LoopingCall(replaySpilled)
+        else:
+            self.spill_replay_task = None
+        if fileIndex is not None and settings.FILE_INDEX_RECONCILE_INTERVAL:
+            self.file_index_task = LoopingCall(reactor.callInThread, fileIndex.rebuild)
+        else:
+            self.file_index_task = None
 
     def startService(self):
         self.storage_reload_task.start(60, False)
         self.aggregation_reload_task.start(60, False)
+        if self.rate_control_task:
+            self.rate_control_task.start(settings.UPDATE_RATE_ADJUST_INTERVAL, False)
         reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
-        reactor.callInThread(writeForever)
+        if settings.CACHE_SNAPSHOT_ON_SHUTDOWN:
+            reactor.addSystemEventTrigger('before', 'shutdown', snapshotCache)
+        if not settings.USE_WRITER_PROCESSES:
+            database.open()
+            # By then the writer threads are done
+            reactor.addSystemEventTrigger('after', 'shutdown', database.close)
+        if self.spill_replay_task:
+            self.spill_replay_task.start(0.1, False)
+        if self.file_index_task:
+            self.file_index_task.start(settings.FILE_INDEX_RECONCILE_INTERVAL)
+        elif fileIndex is not None:
+            reactor.callInThread(fileIndex.rebuild)
+
+        # Writer threads own disjoint sets of cache shards, so no two of them
+        # ever write to the same metric at once.
+        writerShards[:] = MetricCache.partition(settings.WRITER_THREADS)
+        # Keep the reactor's default of 10 pool threads free for other uses
+        reactor.suggestThreadPoolSize(len(writerShards) + settings.CREATE_THREADS + 11)
+        for worker, shards in enumerate(writerShards):
+          reactor.callInThread(writeForever, shards, worker)
+        for i in range(settings.CREATE_THREADS):
+          reactor.callInThread(createForever)
+        if wal is not None:
+          reactor.callInThread(flushForever)
         Service.startService(self)
 
     def stopService(self):
         self.storage_reload_task.stop()
         self.aggregation_reload_task.stop()
+        if self.rate_control_task:
+            self.rate_control_task.stop()
+        if self.spill_replay_task:
+            self.spill_replay_task.stop()
+        if self.file_index_task:
+            self.file_index_task.stop()
         Service.stopService(self)